@@ -1,3 +1,5 @@
 from .dataset_mapper import *
 from .tools import add_dataset_config, register_datasets
-from .datasets import VisualGenomeTrainData
\ No newline at end of file
+from .datasets import VisualGenomeTrainData, MaskStore, MaskStoreWriter
+from .build import build_scenegraph_train_loader, build_scenegraph_test_loader
+from .prefetcher import DataPrefetcher
\ No newline at end of file
@@ -0,0 +1,61 @@
+import torch
+
+from detectron2.data import (
+    DatasetCatalog,
+    build_detection_test_loader,
+    build_detection_train_loader,
+    build_batch_data_loader
+)
+from detectron2.data.common import MapDataset
+from detectron2.data.samplers import InferenceSampler, TrainingSampler
+from detectron2.data.build import trivial_batch_collator
+
+def _get_lazy_dataset(dataset_names, filter_empty=False):
+    datasets = []
+    for dataset_name in dataset_names:
+        dataset = DatasetCatalog.get(dataset_name)
+        assert isinstance(dataset, torch.utils.data.Dataset), "Dataset '{}' is not a map-style dataset, disable DATASETS.VISUAL_GENOME.LAZY_LOADING".format(dataset_name)
+        if filter_empty:
+            dataset = dataset.filter_empty()
+        assert len(dataset), "Dataset '{}' is empty!".format(dataset_name)
+        datasets.append(dataset)
+    return datasets[0] if len(datasets) == 1 else torch.utils.data.ConcatDataset(datasets)
+
+def build_scenegraph_train_loader(cfg, mapper):
+    """
+    build_detection_train_loader that also accepts the map-style datasets registered with
+    DATASETS.VISUAL_GENOME.LAZY_LOADING, without materializing their dicts
+    """
+    if not cfg.DATASETS.VISUAL_GENOME.LAZY_LOADING:
+        return build_detection_train_loader(cfg, mapper=mapper)
+
+    dataset = _get_lazy_dataset(cfg.DATASETS.TRAIN, filter_empty=cfg.DATALOADER.FILTER_EMPTY_ANNOTATIONS)
+    sampler_name = cfg.DATALOADER.SAMPLER_TRAIN
+    if sampler_name != "TrainingSampler":
+        raise ValueError("Training sampler {} is not supported with lazy loading".format(sampler_name))
+    sampler = TrainingSampler(len(dataset))
+    return build_batch_data_loader(
+        MapDataset(dataset, mapper),
+        sampler,
+        cfg.SOLVER.IMS_PER_BATCH,
+        aspect_ratio_grouping=cfg.DATALOADER.ASPECT_RATIO_GROUPING,
+        num_workers=cfg.DATALOADER.NUM_WORKERS,
+    )
+
+def build_scenegraph_test_loader(cfg, dataset_name, mapper):
+    """
+    build_detection_test_loader that also accepts the map-style datasets registered with
+    DATASETS.VISUAL_GENOME.LAZY_LOADING
+    """
+    if not cfg.DATASETS.VISUAL_GENOME.LAZY_LOADING:
+        return build_detection_test_loader(cfg, dataset_name, mapper=mapper)
+
+    dataset = MapDataset(_get_lazy_dataset([dataset_name]), mapper)
+    sampler = InferenceSampler(len(dataset))
+    batch_sampler = torch.utils.data.sampler.BatchSampler(sampler, 1, drop_last=False)
+    return torch.utils.data.DataLoader(
+        dataset,
+        num_workers=cfg.DATALOADER.NUM_WORKERS,
+        batch_sampler=batch_sampler,
+        collate_fn=trivial_batch_collator,
+    )
@@ -8,30 +8,56 @@ from PIL import Image
 from detectron2.data import detection_utils as utils
 from detectron2.data import transforms as T
 from detectron2.structures.instances import Instances
+from detectron2.structures import BitMasks, Boxes, BoxMode, PolygonMasks, polygons_to_bitmask
 from detectron2.data import DatasetCatalog, MetadataCatalog, MapDataset, DatasetFromList, DatasetMapper
-from collections import defaultdict
 from imantics import Polygons, Mask
+from .image_cache import ImageCache
+import pycocotools.mask as mask_util
 
 class SceneGraphDatasetMapper(DatasetMapper):
     def __init__(self, cfg, is_train=True):
         super(SceneGraphDatasetMapper, self).__init__(cfg, is_train=is_train)
         self.is_train=is_train
         self.filter_duplicate_relations = cfg.DATASETS.VISUAL_GENOME.FILTER_DUPLICATE_RELATIONS
-    
-    def __call__(self, dataset_dict):
+        self.image_cache = None
+        if cfg.DATASETS.IMAGE_CACHE and is_train:
+            self.image_cache = ImageCache(cfg.DATASETS.IMAGE_CACHE)
+            assert self.image_cache.meta['format'] == self.image_format, "Image cache {} is in format {}, not {}".format(cfg.DATASETS.IMAGE_CACHE, self.image_cache.meta['format'], self.image_format)
+            assert self.image_cache.meta['min_size'] >= max(cfg.INPUT.MIN_SIZE_TRAIN), "Images of the cache {} are smaller than INPUT.MIN_SIZE_TRAIN".format(cfg.DATASETS.IMAGE_CACHE)
+            assert self.image_cache.meta['max_size'] >= cfg.INPUT.MAX_SIZE_TRAIN, "Images of the cache {} are smaller than INPUT.MAX_SIZE_TRAIN".format(cfg.DATASETS.IMAGE_CACHE)
+
+    def read_image(self, dataset_dict):
         """
-        Args:
-            dataset_dict (dict): Metadata of one image, in Detectron2 Dataset format.
+        Read the image of dataset_dict, from the image cache when it has it
         Returns:
-            dict: a format that builtin models in detectron2 accept
+            image (array)
+            cache_transform (Transform): scaling from the original image to the cached one, whose
+                size may be different, None if the image was decoded from its file
         """
-        dataset_dict = copy.deepcopy(dataset_dict)
+        if self.image_cache is not None and dataset_dict["file_name"] in self.image_cache:
+            image, (h, w) = self.image_cache.read(dataset_dict["file_name"])
+            dataset_dict['width'] = w
+            dataset_dict['height'] = h
+            return image, T.ScaleTransform(h, w, image.shape[0], image.shape[1])
+
         image = utils.read_image(dataset_dict["file_name"], format=self.image_format)
         h, w, _ = image.shape
         if w != dataset_dict['width'] or h != dataset_dict['height']:
             dataset_dict['width'] = w
             dataset_dict['height'] = h
         utils.check_image_size(dataset_dict, image)
+        return image, None
+
+    def __call__(self, dataset_dict):
+        """
+        Args:
+            dataset_dict (dict): Metadata of one image, in Detectron2 Dataset format.
+        Returns:
+            dict: a format that builtin models in detectron2 accept
+        """
+        # Only the top level is modified, the annotations are read but shared with the dataset
+        dataset_dict = dict(dataset_dict)
+        image, cache_transform = self.read_image(dataset_dict)
         
         if "sem_seg_file_name" in dataset_dict:
             sem_seg_gt = utils.read_image(dataset_dict.pop("sem_seg_file_name"), "L").squeeze(2)
@@ -40,6 +66,9 @@ class SceneGraphDatasetMapper(DatasetMapper):
         
         aug_input = T.AugInput(image, sem_seg=sem_seg_gt)
         transforms = self.augmentations(aug_input)
+        if cache_transform is not None:
+            # The annotations are in the coordinates of the original image
+            transforms = T.TransformList([cache_transform]) + transforms
         image, sem_seg_gt = aug_input.image, aug_input.sem_seg
         image_shape = image.shape[:2]  # h, w
 
@@ -61,36 +90,20 @@ class SceneGraphDatasetMapper(DatasetMapper):
         rel_present = False
         if "relations" in dataset_dict:
             if self.filter_duplicate_relations and self.is_train:
-                relation_dict = defaultdict(list)
-                for object_0, object_1, relation in dataset_dict["relations"]:
-                    relation_dict[(object_0,object_1)].append(relation)
-                dataset_dict["relations"] = [(k[0], k[1], np.random.choice(v)) for k,v in relation_dict.items()]
+                dataset_dict["relations"] = sample_unique_relations(dataset_dict["relations"])
                 
-            dataset_dict["relations"] = torch.as_tensor(np.ascontiguousarray(dataset_dict["relations"]))
+            dataset_dict["relations"] = torch.as_tensor(np.array(dataset_dict["relations"]))
             rel_present = True
  
         if "annotations" in dataset_dict:
-            for anno in dataset_dict["annotations"]:
-                if not self.use_instance_mask:
-                    anno.pop("segmentation", None)
-                if not self.use_keypoint:
-                    anno.pop("keypoints", None)
-
-            # USER: Implement additional transformations if you have other types of data
-            annos = [
-                utils.transform_instance_annotations(
-                    obj, transforms, image_shape, keypoint_hflip_indices=self.keypoint_hflip_indices
-                )
-                for obj in dataset_dict.pop("annotations")
-                if obj.get("iscrowd", 0) == 0
-            ]
-            instances = utils.annotations_to_instances(
-                annos, image_shape, mask_format=self.instance_mask_format
+            annos = [obj for obj in dataset_dict.pop("annotations") if obj.get("iscrowd", 0) == 0]
+            instances = transform_annotations_to_instances(
+                annos, transforms, image_shape, mask_format=self.instance_mask_format if self.use_instance_mask else None
             )
             
             if rel_present:
                 # Add object attributes
-                instances.gt_attributes = torch.tensor([obj['attribute'] for obj in annos], dtype=torch.int64)
+                instances.gt_attributes = torch.as_tensor(np.array([obj['attribute'] for obj in annos], dtype=np.int64))
 
             if self.recompute_boxes:
                 instances.gt_boxes = instances.gt_masks.get_bounding_boxes()
@@ -105,13 +118,9 @@ class MaskLabelDatasetMapper(SceneGraphDatasetMapper):
         Returns:
             dict: a format that builtin models in detectron2 accept
         """
-        dataset_dict = copy.deepcopy(dataset_dict)
-        image = utils.read_image(dataset_dict["file_name"], format=self.image_format)
-        h, w, _ = image.shape
-        if w != dataset_dict['width'] or h != dataset_dict['height']:
-            dataset_dict['width'] = w
-            dataset_dict['height'] = h
-        utils.check_image_size(dataset_dict, image)
+        # Only the top level is modified, the annotations are read but shared with the dataset
+        dataset_dict = dict(dataset_dict)
+        image, cache_transform = self.read_image(dataset_dict)
         
         if "sem_seg_file_name" in dataset_dict:
             sem_seg_gt = utils.read_image(dataset_dict.pop("sem_seg_file_name"), "L").squeeze(2)
@@ -120,6 +129,9 @@ class MaskLabelDatasetMapper(SceneGraphDatasetMapper):
         
         aug_input = T.AugInput(image, sem_seg=sem_seg_gt)
         transforms = self.augmentations(aug_input)
+        if cache_transform is not None:
+            # The annotations are in the coordinates of the original image
+            transforms = T.TransformList([cache_transform]) + transforms
         image, sem_seg_gt = aug_input.image, aug_input.sem_seg
         image_shape = image.shape[:2]  # h, w
 
@@ -132,28 +144,15 @@ class MaskLabelDatasetMapper(SceneGraphDatasetMapper):
                 dataset_dict, image_shape, transforms, proposal_topk=self.proposal_topk
             )
         
-        dataset_dict["relations"] = torch.as_tensor(np.ascontiguousarray(dataset_dict["relations"]))
+        dataset_dict["relations"] = torch.as_tensor(np.array(dataset_dict["relations"]))
         if "annotations" in dataset_dict:
-            for anno in dataset_dict["annotations"]:
-                if not self.use_instance_mask:
-                    anno.pop("segmentation", None)
-                if not self.use_keypoint:
-                    anno.pop("keypoints", None)
-
-            # USER: Implement additional transformations if you have other types of data
-            annos = [
-                utils.transform_instance_annotations(
-                    obj, transforms, image_shape, keypoint_hflip_indices=self.keypoint_hflip_indices
-                )
-                for obj in dataset_dict.pop("annotations")
-                if obj.get("iscrowd", 0) == 0
-            ]
-            instances = utils.annotations_to_instances(
-                annos, image_shape, mask_format=self.instance_mask_format
+            annos = [obj for obj in dataset_dict.pop("annotations") if obj.get("iscrowd", 0) == 0]
+            instances = transform_annotations_to_instances(
+                annos, transforms, image_shape, mask_format=self.instance_mask_format if self.use_instance_mask else None
             )
             
             # Add object attributes
-            instances.gt_attributes = torch.tensor([obj['attribute'] for obj in annos], dtype=torch.int64)
+            instances.gt_attributes = torch.as_tensor(np.array([obj['attribute'] for obj in annos], dtype=np.int64))
             if self.recompute_boxes:
                 instances.gt_boxes = instances.gt_masks.get_bounding_boxes()
             dataset_dict["empty_index"] = self.nonempty(instances.gt_boxes.tensor.clone()).data.cpu().numpy()
@@ -174,15 +173,10 @@ class ObjectDetectionDatasetMapper(SceneGraphDatasetMapper):
         Returns:
             dict: a format that builtin models in detectron2 accept
         """
-        input_dict = copy.deepcopy(dataset_dict)
-        dataset_dict = copy.deepcopy(dataset_dict)  # it will be modified by code below
+        # Only the top level is modified, the annotations are read but shared with the dataset
+        dataset_dict = dict(dataset_dict)
         # USER: Write your own image loading if it's not from a file
-        image = utils.read_image(dataset_dict["file_name"], format=self.image_format)
-        h, w, _ = image.shape
-        if w != dataset_dict['width'] or h != dataset_dict['height']:
-            dataset_dict['width'] = w
-            dataset_dict['height'] = h
-        utils.check_image_size(dataset_dict, image)
+        image, cache_transform = self.read_image(dataset_dict)
 
         # USER: Remove if you don't do semantic/panoptic segmentation.
         if "sem_seg_file_name" in dataset_dict:
@@ -192,6 +186,9 @@ class ObjectDetectionDatasetMapper(SceneGraphDatasetMapper):
 
         aug_input = T.AugInput(image, sem_seg=sem_seg_gt)
         transforms = self.augmentations(aug_input)
+        if cache_transform is not None:
+            # The annotations are in the coordinates of the original image
+            transforms = T.TransformList([cache_transform]) + transforms
         image, sem_seg_gt = aug_input.image, aug_input.sem_seg
 
         image_shape = image.shape[:2]  # h, w
@@ -216,24 +213,9 @@ class ObjectDetectionDatasetMapper(SceneGraphDatasetMapper):
             return dataset_dict
 
         if "annotations" in dataset_dict:
-            # USER: Modify this if you want to keep them for some reason.
-            for anno in dataset_dict["annotations"]:
-                if not self.use_instance_mask:
-                    anno.pop("segmentation", None)
-                if not self.use_keypoint:
-                    anno.pop("keypoints", None)
-
-            # USER: Implement additional transformations if you have other types of data
-            annos = [
-                utils.transform_instance_annotations(
-                    obj, transforms, image_shape, keypoint_hflip_indices=self.keypoint_hflip_indices
-                )
-                for obj in dataset_dict.pop("annotations")
-                if obj.get("iscrowd", 0) == 0
-            ]
-
-            instances = utils.annotations_to_instances(
-                annos, image_shape, mask_format=self.instance_mask_format
+            annos = [obj for obj in dataset_dict.pop("annotations") if obj.get("iscrowd", 0) == 0]
+            instances = transform_annotations_to_instances(
+                annos, transforms, image_shape, mask_format=self.instance_mask_format if self.use_instance_mask else None
             )
 
             # After transforms such as cropping are applied, the bounding box may no longer
@@ -259,7 +241,8 @@ class MaskRCNNDatasetMapper(DatasetMapper):
         Returns:
             dict: a format that builtin models in detectron2 accept
         """
-        dataset_dict = copy.deepcopy(dataset_dict)
+        # Only the top level is modified, the annotations are read but shared with the dataset
+        dataset_dict = dict(dataset_dict)
         image = utils.read_image(dataset_dict["file_name"], format=self.image_format)
         utils.check_image_size(dataset_dict, image)
         
@@ -277,11 +260,6 @@ class MaskRCNNDatasetMapper(DatasetMapper):
         if sem_seg_gt is not None:
             dataset_dict["sem_seg"] = torch.as_tensor(sem_seg_gt.astype("long"))
 
-        if self.is_train:
-            for idx, annotation in enumerate(dataset_dict['annotations']):
-                annotation['bbox'] = annotation['bbox'].tolist()
-                annotation['segmentation'] = [x.tolist() for x in annotation['segmentation']]
-
         if self.proposal_topk is not None:
             utils.transform_proposals(
                 dataset_dict, image_shape, transforms, proposal_topk=self.proposal_topk
@@ -293,22 +271,9 @@ class MaskRCNNDatasetMapper(DatasetMapper):
             return dataset_dict
  
         if "annotations" in dataset_dict:
-            for anno in dataset_dict["annotations"]:
-                if not self.use_instance_mask:
-                    anno.pop("segmentation", None)
-                if not self.use_keypoint:
-                    anno.pop("keypoints", None)
-
-            # USER: Implement additional transformations if you have other types of data
-            annos = [
-                utils.transform_instance_annotations(
-                    obj, transforms, image_shape, keypoint_hflip_indices=self.keypoint_hflip_indices
-                )
-                for obj in dataset_dict.pop("annotations")
-                if obj.get("iscrowd", 0) == 0
-            ]
-            instances = utils.annotations_to_instances(
-                annos, image_shape, mask_format=self.instance_mask_format
+            annos = [obj for obj in dataset_dict.pop("annotations") if obj.get("iscrowd", 0) == 0]
+            instances = transform_annotations_to_instances(
+                annos, transforms, image_shape, mask_format=self.instance_mask_format if self.use_instance_mask else None
             )
 
             if self.recompute_boxes:
@@ -316,6 +281,101 @@ class MaskRCNNDatasetMapper(DatasetMapper):
             dataset_dict["instances"] = utils.filter_empty_instances(instances)
         return dataset_dict
 
+def sample_unique_relations(relations):
+    """
+    Keep one relation drawn uniformly among the relations of every (subject, object) pair, in
+    the order of the first relation of each pair
+    Args:
+        relations (array): (M, 3) subject, object and predicate
+    """
+    relations = np.asarray(relations).reshape(-1, 3)
+    if len(relations) == 0:
+        return relations
+    # Sorted by pair, in a random order within each pair: the first relation of a pair is a uniform draw
+    order = np.lexsort((np.random.random(len(relations)), relations[:, 1], relations[:, 0]))
+    pairs = relations[order, :2]
+    starts = np.flatnonzero(np.concatenate(([True], (pairs[1:] != pairs[:-1]).any(1))))
+    first_index = np.minimum.reduceat(order, starts)
+    return relations[order[starts[np.argsort(first_index)]]]
+
+def transform_annotations_to_instances(annotations, transforms, image_shape, mask_format="polygon"):
+    """
+    Transform the annotations of one image and build their Instances, with the boxes and
+    polygons of all objects transformed at once instead of utils.transform_instance_annotations
+    and utils.annotations_to_instances per object. The annotations are not modified.
+    Args:
+        annotations (list[dict]): annotations of one image, in Detectron2 Dataset format
+        transforms (TransformList): transforms applied to the image
+        image_shape (tuple): (h, w) of the transformed image
+        mask_format (str): "polygon" or "bitmask", None to ignore the segmentations
+    Returns:
+        Instances: gt_boxes, gt_classes and gt_masks if the annotations have segmentations
+    """
+    boxes = np.array([obj["bbox"] for obj in annotations], dtype=np.float64).reshape(-1, 4)
+    bbox_modes = np.array([obj["bbox_mode"] for obj in annotations], dtype=np.int64)
+    for mode in set(bbox_modes.tolist()) - {BoxMode.XYXY_ABS}:
+        boxes[bbox_modes == mode] = BoxMode.convert(boxes[bbox_modes == mode], BoxMode(mode), BoxMode.XYXY_ABS)
+    # Clip the transformed boxes to the image size
+    boxes = transforms.apply_box(boxes).clip(min=0)
+    boxes = np.minimum(boxes, list(image_shape + image_shape)[::-1])
+
+    target = Instances(image_shape)
+    target.gt_boxes = Boxes(boxes)
+    target.gt_boxes.clip(image_shape)
+    target.gt_classes = torch.tensor([obj["category_id"] for obj in annotations], dtype=torch.int64)
+
+    if mask_format is not None and len(annotations) and "segmentation" in annotations[0]:
+        segms = [obj["segmentation"] for obj in annotations]
+        if isinstance(segms[0], dict):
+            target.gt_masks = decode_rle_masks(segms, transforms, image_shape)
+        else:
+            polygons = transform_polygons(segms, transforms)
+            if mask_format == "polygon":
+                target.gt_masks = PolygonMasks(polygons)
+            else:
+                target.gt_masks = BitMasks(torch.stack([torch.from_numpy(np.ascontiguousarray(polygons_to_bitmask(obj_polygons, *image_shape))) for obj_polygons in polygons]))
+    return target
+
+def transform_polygons(segms, transforms):
+    """
+    Args:
+        segms (list[list[array]]): polygons of every object
+        transforms (TransformList)
+    Returns:
+        list[list[array]]: the transformed polygons of every object, as flat coordinates
+    """
+    if any(isinstance(t, T.CropTransform) for t in transforms.transforms):
+        # Cropping clips the polygons, which are transformed separately
+        return [[p.reshape(-1) for p in transforms.apply_polygons([np.asarray(p, dtype=np.float64).reshape(-1, 2) for p in obj_polygons])]
+                for obj_polygons in segms]
+
+    # Other transforms map every point independently, the coordinates of all polygons are transformed at once
+    num_polygons = [len(obj_polygons) for obj_polygons in segms]
+    polygons = [np.asarray(p, dtype=np.float64).reshape(-1, 2) for obj_polygons in segms for p in obj_polygons]
+    if len(polygons) == 0:
+        return [[] for _ in segms]
+    coords = transforms.apply_coords(np.concatenate(polygons))
+    polygons = [p.reshape(-1) for p in np.split(coords, np.cumsum([len(p) for p in polygons])[:-1])]
+    offsets = np.cumsum([0] + num_polygons).tolist()
+    return [polygons[offsets[i]:offsets[i + 1]] for i in range(len(segms))]
+
+def decode_rle_masks(rles, transforms, image_shape):
+    """
+    Decode the COCO RLE segmentations of a mask store all at once to the transformed image,
+    instead of rasterizing polygons for every object.
+    Args:
+        rles (list[dict]): RLEs of the objects of one image
+        transforms (TransformList): transforms applied to the image
+        image_shape (tuple): (h, w) of the transformed image
+    Returns:
+        BitMasks
+    """
+    if len(rles) == 0:
+        return BitMasks(torch.zeros((0,) + tuple(image_shape), dtype=torch.bool))
+    masks = mask_util.decode(rles).transpose(2, 0, 1)
+    masks = [transforms.apply_segmentation(mask) for mask in masks]
+    return BitMasks(torch.stack([torch.from_numpy(np.ascontiguousarray(mask)) for mask in masks]))
+
 def filter_empty_instances(instances, by_box=True, by_mask=True, box_threshold=1e-5):
     """
     Filter out empty instances in an `Instances` object.
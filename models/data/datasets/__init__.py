@@ -1 +1,2 @@
-from .visual_genome import VisualGenomeTrainData
\ No newline at end of file
+from .visual_genome import VisualGenomeTrainData
+from .mask_store import MaskStore, MaskStoreWriter
\ No newline at end of file
@@ -0,0 +1,291 @@
+"""
+Indexed store of per-instance masks in COCO RLE format.
+
+The RLE counts of all masks are appended to one flat byte file, and per image / per mask
+offsets index into it. A store is a directory, or a directory of per rank stores merged by a
+manifest, that is memory-mapped when read back.
+
+The polygon mask labels are written the same way, one shard of pickled records per rank, and
+merged into the single pickle read by VisualGenomeTrainData.
+"""
+import os
+import glob
+import json
+import pickle
+import shutil
+import numpy as np
+import pycocotools.mask as mask_util
+
+META_FILE = 'meta.json'
+INDEX_FILE = 'index.npz'
+MANIFEST_FILE = 'manifest.json'
+
+
+def is_mask_store(path):
+    return os.path.isfile(os.path.join(path, META_FILE)) or os.path.isfile(os.path.join(path, MANIFEST_FILE)) \
+        or len(glob.glob(os.path.join(path, '*', META_FILE))) > 0
+
+
+def encode_masks(masks):
+    """
+    Args:
+        masks (array): (N, H, W) binary masks
+    Returns:
+        list[dict]: COCO RLEs, with bytes counts
+    """
+    masks = np.asarray(masks, dtype=np.uint8)
+    if masks.shape[0] == 0:
+        return []
+    return mask_util.encode(np.asfortranarray(masks.transpose(1, 2, 0)))
+
+
+def _save_index(path, **columns):
+    # Written through a temporary file, so that an interrupted write leaves the previous index
+    tmp_path = '{}.tmp{}.npz'.format(path, os.getpid())
+    np.savez(tmp_path, **columns)
+    os.replace(tmp_path, path)
+
+
+class MaskStoreWriter(object):
+    """
+    Incrementally writes the masks of each image, in the order they are added. The index is
+    saved by `checkpoint`, and a writer created with resume=True continues after the last
+    checkpoint of an interrupted export.
+    """
+    def __init__(self, output_dir, resume=False):
+        self._output_dir = output_dir
+        os.makedirs(output_dir, exist_ok=True)
+        self._image_ids, self._image_sizes = [], []
+        self._image_offsets, self._mask_offsets = [0], [0]
+        self._empty_index, self._empty_index_offsets = [], [0]
+
+        counts_path = os.path.join(output_dir, 'counts.bin')
+        index_path = os.path.join(output_dir, INDEX_FILE)
+        if resume and os.path.isfile(index_path) and os.path.isfile(counts_path):
+            with np.load(index_path) as index:
+                self._image_ids = index['image_ids'].tolist()
+                self._image_sizes = [tuple(size) for size in index['image_sizes'].tolist()]
+                self._image_offsets = index['image_offsets'].tolist()
+                self._mask_offsets = index['mask_offsets'].tolist()
+                self._empty_index_offsets = index['empty_index_offsets'].tolist()
+                self._empty_index = [index['empty_index'][start:end] for start, end in
+                                     zip(self._empty_index_offsets[:-1], self._empty_index_offsets[1:])]
+            # Masks written after the last checkpoint are not indexed
+            self._counts_file = open(counts_path, 'r+b')
+            self._counts_file.truncate(self._mask_offsets[-1])
+            self._counts_file.seek(0, os.SEEK_END)
+        else:
+            self._counts_file = open(counts_path, 'wb')
+        # The store is incomplete until closed
+        if os.path.isfile(os.path.join(output_dir, META_FILE)):
+            os.remove(os.path.join(output_dir, META_FILE))
+
+    @property
+    def image_ids(self):
+        return self._image_ids
+
+    def add(self, image_id, masks, empty_index):
+        """
+        Args:
+            image_id (int)
+            masks (array): (N, H, W) binary masks, or their RLEs
+            empty_index (array[bool]): objects of the image that have a mask, in the same
+                order as the masks
+        """
+        if isinstance(masks, np.ndarray):
+            height, width = masks.shape[1:]
+            rles = encode_masks(masks)
+        else:
+            rles = masks
+            height, width = rles[0]['size'] if len(rles) else (0, 0)
+        for rle in rles:
+            self._counts_file.write(rle['counts'])
+            self._mask_offsets.append(self._mask_offsets[-1] + len(rle['counts']))
+        self._image_ids.append(image_id)
+        self._image_sizes.append((height, width))
+        self._image_offsets.append(self._image_offsets[-1] + len(rles))
+        empty_index = np.asarray(empty_index, dtype=bool).reshape(-1)
+        self._empty_index.append(empty_index)
+        self._empty_index_offsets.append(self._empty_index_offsets[-1] + len(empty_index))
+
+    def checkpoint(self):
+        # The counts are on disk before the index that refers to them
+        self._counts_file.flush()
+        os.fsync(self._counts_file.fileno())
+        _save_index(
+            os.path.join(self._output_dir, INDEX_FILE),
+            image_ids=np.array(self._image_ids, dtype=np.int64),
+            image_sizes=np.array(self._image_sizes, dtype=np.int64).reshape(-1, 2),
+            image_offsets=np.array(self._image_offsets, dtype=np.int64),
+            mask_offsets=np.array(self._mask_offsets, dtype=np.int64),
+            empty_index=np.concatenate(self._empty_index) if self._empty_index else np.zeros(0, dtype=bool),
+            empty_index_offsets=np.array(self._empty_index_offsets, dtype=np.int64),
+        )
+
+    def close(self):
+        self.checkpoint()
+        self._counts_file.close()
+        # The meta file marks the store as complete
+        with open(os.path.join(self._output_dir, META_FILE), 'w') as f:
+            json.dump({'num_images': len(self._image_ids)}, f)
+
+
+def write_manifest(path, shards=None):
+    """
+    List the complete per rank stores of `path` in its manifest, read by MaskStore
+    Args:
+        shards (list[str]): names of the per rank stores, all the complete ones if None
+    """
+    if shards is None:
+        shards = sorted(os.path.basename(os.path.dirname(p)) for p in glob.glob(os.path.join(path, '*', META_FILE)))
+    num_images = 0
+    for shard in shards:
+        with open(os.path.join(path, shard, META_FILE)) as f:
+            num_images += json.load(f)['num_images']
+    tmp_path = os.path.join(path, '{}.tmp{}'.format(MANIFEST_FILE, os.getpid()))
+    with open(tmp_path, 'w') as f:
+        json.dump({'shards': shards, 'num_images': num_images}, f)
+    os.replace(tmp_path, os.path.join(path, MANIFEST_FILE))
+
+
+def clear_mask_store(path):
+    """
+    Remove the manifest and the per rank stores of an earlier export to `path`
+    """
+    if os.path.isfile(os.path.join(path, MANIFEST_FILE)):
+        os.remove(os.path.join(path, MANIFEST_FILE))
+    for counts_path in glob.glob(os.path.join(path, '*', 'counts.bin')):
+        shutil.rmtree(os.path.dirname(counts_path))
+
+
+def exported_image_ids(path):
+    """
+    Images already written, up to the last checkpoint, by the per rank stores of `path`
+    """
+    image_ids = set()
+    for index_path in glob.glob(os.path.join(path, '*', INDEX_FILE)):
+        with np.load(index_path) as index:
+            image_ids.update(index['image_ids'].tolist())
+    return image_ids
+
+
+class MaskStore(object):
+    """
+    Memory-mapped reader of one or several (e.g. one per rank) stores, indexed by image id
+    """
+    def __init__(self, path):
+        if os.path.isfile(os.path.join(path, META_FILE)):
+            shard_dirs = [path]
+        elif os.path.isfile(os.path.join(path, MANIFEST_FILE)):
+            with open(os.path.join(path, MANIFEST_FILE)) as f:
+                shard_dirs = [os.path.join(path, shard) for shard in json.load(f)['shards']]
+        else:
+            shard_dirs = sorted(os.path.dirname(p) for p in glob.glob(os.path.join(path, '*', META_FILE)))
+        assert len(shard_dirs) > 0, "No mask store found in {}".format(path)
+
+        self._shards = []
+        self._index = {}
+        for shard_idx, shard_dir in enumerate(shard_dirs):
+            with np.load(os.path.join(shard_dir, INDEX_FILE)) as index:
+                shard = dict(index)
+            counts_file = os.path.join(shard_dir, 'counts.bin')
+            shard['counts'] = np.memmap(counts_file, dtype=np.uint8, mode='r') if os.path.getsize(counts_file) else np.zeros(0, dtype=np.uint8)
+            self._shards.append(shard)
+            for idx, image_id in enumerate(shard['image_ids'].tolist()):
+                self._index[image_id] = (shard_idx, idx)
+
+    def __len__(self):
+        return len(self._index)
+
+    def __contains__(self, image_id):
+        return image_id in self._index
+
+    def __getitem__(self, image_id):
+        """
+        Returns:
+            dict: 'rles', the list of COCO RLEs of the image, and 'empty_index'
+        """
+        shard_idx, idx = self._index[image_id]
+        shard = self._shards[shard_idx]
+        height, width = shard['image_sizes'][idx].tolist()
+        start, end = shard['image_offsets'][idx:idx + 2]
+        offsets = shard['mask_offsets'][start:end + 1]
+        rles = [{'size': [height, width], 'counts': shard['counts'][offsets[i]:offsets[i + 1]].tobytes()} for i in range(end - start)]
+        empty_start, empty_end = shard['empty_index_offsets'][idx:idx + 2]
+        return {'rles': rles, 'empty_index': shard['empty_index'][empty_start:empty_end]}
+
+
+def _read_polygon_records(f):
+    # Yields (image_id, record, end position) until the end of the file or a truncated record
+    while True:
+        try:
+            image_id, record = pickle.load(f)
+        except Exception:
+            return
+        yield image_id, record, f.tell()
+
+
+class PolygonShardWriter(object):
+    """
+    Appends the {'polygons', 'empty_index'} records of each image to a pickle stream, in the
+    same interface as MaskStoreWriter. With resume=True the records of an interrupted export
+    are kept, up to the last complete one.
+    """
+    def __init__(self, path, resume=False):
+        self._path = path
+        self._image_ids = []
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        if resume and os.path.isfile(path):
+            end = 0
+            with open(path, 'rb') as f:
+                for image_id, _, end in _read_polygon_records(f):
+                    self._image_ids.append(image_id)
+            self._file = open(path, 'r+b')
+            self._file.truncate(end)
+            self._file.seek(0, os.SEEK_END)
+        else:
+            self._file = open(path, 'wb')
+
+    @property
+    def image_ids(self):
+        return self._image_ids
+
+    def add(self, image_id, polygons, empty_index):
+        pickle.dump((image_id, {'polygons': polygons, 'empty_index': empty_index}), self._file)
+        self._image_ids.append(image_id)
+
+    def checkpoint(self):
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def close(self):
+        self.checkpoint()
+        self._file.close()
+
+
+def polygon_shard_image_ids(shard_dir):
+    """
+    Images already written by the polygon shards of `shard_dir`
+    """
+    image_ids = set()
+    for path in glob.glob(os.path.join(shard_dir, '*.pkl')):
+        with open(path, 'rb') as f:
+            image_ids.update(image_id for image_id, _, _ in _read_polygon_records(f))
+    return image_ids
+
+
+def merge_polygon_shards(shard_dir, output_file):
+    """
+    Merge the polygon shards of `shard_dir` into the {image_id: record} pickle read by
+    VisualGenomeTrainData
+    """
+    image_masks = {}
+    for path in sorted(glob.glob(os.path.join(shard_dir, '*.pkl'))):
+        with open(path, 'rb') as f:
+            for image_id, record, _ in _read_polygon_records(f):
+                image_masks[image_id] = record
+    tmp_file = '{}.tmp{}'.format(output_file, os.getpid())
+    with open(tmp_file, 'wb') as f:
+        pickle.dump(image_masks, f)
+    os.replace(tmp_file, output_file)
+    return len(image_masks)
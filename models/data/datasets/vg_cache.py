@@ -0,0 +1,259 @@
+"""
+Binary cache of the Visual Genome dataset dicts.
+
+The arrays built by VisualGenomeTrainData._load_graphs are stored as flat numpy arrays
+(one .npy file per column) with per-image offsets, polygons and RLE masks in ragged flat
+buffers, and
+memory-mapped when read back, so that loading takes seconds and the pages are shared by
+every process reading the same cache.
+"""
+import os
+import json
+import shutil
+import hashlib
+import numpy as np
+import torch
+
+from detectron2.structures import BoxMode
+
+# Bump when the layout of the cache changes, older caches are then rebuilt
+CACHE_VERSION = 2
+META_FILE = 'meta.json'
+# Per image: image_ids, image_sizes (height, width), image_offsets into the objects and
+# relation_offsets into the relations. Per object: boxes (XYXY_ABS), classes, attributes and
+# polygon_offsets into the polygons, and with RLE masks rle_offsets into the flat rle_counts
+# and rle_sizes (height, width). Per polygon: coord_offsets into the flat coords.
+COLUMNS = ['image_ids', 'image_sizes', 'image_offsets', 'relation_offsets', 'relations', 'boxes',
+           'classes', 'attributes', 'polygon_offsets', 'coord_offsets', 'coords', 'rle_offsets',
+           'rle_sizes', 'rle_counts']
+# Options that only affect how the cache is built or the mask label export, excluded from its key
+CACHE_OPTIONS = ('CACHE_DIR', 'NUM_CACHE_WORKERS', 'LAZY_LOADING', 'MASK_FORMAT', 'NUM_MASK_EXPORT_WORKERS', 'RESUME_MASK_EXPORT')
+
+
+def cache_key(cfg, split, input_files):
+    """
+    Hash of everything the cached dicts depend on: the dataset config, the split and the
+    size and modification time of the input files (of the files they contain for directories,
+    e.g. a mask store).
+    """
+    h = hashlib.sha1()
+    h.update('{}:{}\n'.format(CACHE_VERSION, split).encode())
+    options = sorted((k, v) for k, v in cfg.DATASETS.VISUAL_GENOME.items() if k not in CACHE_OPTIONS)
+    h.update(repr(options).encode())
+    for path in input_files:
+        if path and os.path.isdir(path):
+            files = sorted(os.path.join(root, name) for root, _, names in os.walk(path) for name in names)
+        else:
+            files = [path]
+        if path and all(os.path.isfile(f) for f in files):
+            for f in files:
+                stat = os.stat(f)
+                h.update('{}:{}:{}\n'.format(os.path.abspath(f), stat.st_size, stat.st_mtime_ns).encode())
+        else:
+            h.update('{}:missing\n'.format(path).encode())
+    return h.hexdigest()[:16]
+
+
+def save_columns(columns, meta, cache_dir):
+    """
+    Args:
+        columns (dict[str, array]): the COLUMNS built by VisualGenomeTrainData._load_graphs
+        meta (dict): number of images, file names and mask_format of the objects (None,
+            'polygon' or 'rle')
+        cache_dir (str): output directory. The cache is written to a temporary directory
+            that is renamed to cache_dir once complete, so readers never see a partial cache.
+    """
+    tmp_dir = '{}.tmp{}'.format(cache_dir, os.getpid())
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+    for name in COLUMNS:
+        np.save(os.path.join(tmp_dir, name + '.npy'), np.ascontiguousarray(columns[name]))
+
+    # The meta file marks the cache as complete
+    with open(os.path.join(tmp_dir, META_FILE), 'w') as f:
+        json.dump(dict(meta, version=CACHE_VERSION), f)
+
+    # Replaces a stale or partial cache left by an interrupted run
+    shutil.rmtree(cache_dir, ignore_errors=True)
+    os.rename(tmp_dir, cache_dir)
+
+
+def save_array(path, value):
+    """
+    np.save through a temporary file, so that concurrent readers never see a partial file
+    """
+    tmp_path = '{}.tmp{}.npy'.format(path, os.getpid())
+    np.save(tmp_path, value)
+    os.replace(tmp_path, path)
+
+
+def statistics_file(cache_dir, *params):
+    """
+    File of the dataset statistics computed with the given parameters
+    """
+    key = hashlib.sha1(repr(params).encode()).hexdigest()[:16]
+    return os.path.join(cache_dir, 'statistics_{}.npy'.format(key))
+
+
+def is_valid_cache(cache_dir):
+    meta_file = os.path.join(cache_dir, META_FILE)
+    if not os.path.isfile(meta_file):
+        return False
+    with open(meta_file) as f:
+        return json.load(f).get('version') == CACHE_VERSION
+
+
+def load_columns(cache_dir):
+    """
+    Returns:
+        columns (dict[str, array]): memory-mapped COLUMNS
+        meta (dict)
+    """
+    with open(os.path.join(cache_dir, META_FILE)) as f:
+        meta = json.load(f)
+    columns = {name: np.load(os.path.join(cache_dir, name + '.npy'), mmap_mode='r') for name in COLUMNS}
+    return columns, meta
+
+
+def columns_to_dicts(columns, meta):
+    """
+    Build the dataset dicts in detectron2 format. Relations, attributes and polygons are
+    views of the columns, RLE masks are COCO RLE dicts.
+    """
+    # Python lists are built once for the small per object fields
+    boxes = np.asarray(columns['boxes']).tolist()
+    classes = np.asarray(columns['classes']).tolist()
+    attributes = np.asarray(columns['attributes'])
+    relations = np.asarray(columns['relations'])
+    coords = np.asarray(columns['coords'])
+    image_offsets = np.asarray(columns['image_offsets']).tolist()
+    relation_offsets = np.asarray(columns['relation_offsets']).tolist()
+    polygon_offsets = np.asarray(columns['polygon_offsets']).tolist()
+    coord_offsets = np.asarray(columns['coord_offsets']).tolist()
+    rle_offsets = np.asarray(columns['rle_offsets']).tolist()
+    rle_sizes = np.asarray(columns['rle_sizes']).tolist()
+    rle_counts = np.asarray(columns['rle_counts'])
+    image_ids = np.asarray(columns['image_ids']).tolist()
+    image_sizes = np.asarray(columns['image_sizes']).tolist()
+
+    dataset_dicts = []
+    for idx in range(meta['num_images']):
+        record = {
+            'file_name': meta['file_names'][idx],
+            'image_id': image_ids[idx],
+            'height': image_sizes[idx][0],
+            'width': image_sizes[idx][1],
+            'relations': relations[relation_offsets[idx]:relation_offsets[idx + 1]],
+        }
+        objects = []
+        for obj_idx in range(image_offsets[idx], image_offsets[idx + 1]):
+            obj = {
+                'bbox': boxes[obj_idx],
+                'bbox_mode': BoxMode.XYXY_ABS,
+                'category_id': classes[obj_idx],
+                'attribute': attributes[obj_idx],
+            }
+            if meta['mask_format'] == 'polygon':
+                obj['segmentation'] = [coords[coord_offsets[i]:coord_offsets[i + 1]]
+                                       for i in range(polygon_offsets[obj_idx], polygon_offsets[obj_idx + 1])]
+            elif meta['mask_format'] == 'rle':
+                obj['segmentation'] = {'size': rle_sizes[obj_idx],
+                                       'counts': rle_counts[rle_offsets[obj_idx]:rle_offsets[obj_idx + 1]].tobytes()}
+            objects.append(obj)
+        record['annotations'] = objects
+        dataset_dicts.append(record)
+    return dataset_dicts
+
+
+class LazyVisualGenomeDataset(torch.utils.data.Dataset):
+    """
+    Map-style dataset returning the same dicts as `columns_to_dicts`, read from the cache on
+    demand. Only the per image tables are held in memory, the object, relation and mask
+    columns are memory-mapped by each process the first time it reads a record, i.e. after
+    the DataLoader workers are forked.
+    """
+    def __init__(self, cache_dir, indices=None):
+        """
+        Args:
+            cache_dir (str): a cache written by `save_columns`
+            indices (array[int]): images of the cache in the dataset, all by default
+        """
+        self._cache_dir = cache_dir
+        with open(os.path.join(cache_dir, META_FILE)) as f:
+            meta = json.load(f)
+        self._mask_format = meta['mask_format']
+        # A numpy array of strings avoids the copy-on-read of a list of Python objects in forked workers
+        self._file_names = np.array(meta['file_names'])
+        for name in ['image_ids', 'image_sizes', 'image_offsets', 'relation_offsets']:
+            setattr(self, '_' + name, np.load(os.path.join(cache_dir, name + '.npy')))
+        self._indices = np.arange(meta['num_images']) if indices is None else np.asarray(indices, dtype=np.int64)
+        self._columns = None
+        self._pid = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_columns'] = None
+        state['_pid'] = None
+        return state
+
+    def _get_columns(self):
+        if self._pid != os.getpid():
+            self._columns = {name: np.load(os.path.join(self._cache_dir, name + '.npy'), mmap_mode='r')
+                             for name in COLUMNS[4:]}
+            self._pid = os.getpid()
+        return self._columns
+
+    def filter_empty(self):
+        """
+        Dataset without the images that have no objects
+        """
+        num_objects = np.diff(self._image_offsets)
+        return LazyVisualGenomeDataset(self._cache_dir, self._indices[num_objects[self._indices] > 0])
+
+    def __len__(self):
+        return len(self._indices)
+
+    def __getitem__(self, idx):
+        idx = self._indices[idx]
+        columns = self._get_columns()
+        start, end = self._image_offsets[idx:idx + 2]
+        relation_start, relation_end = self._relation_offsets[idx:idx + 2]
+        record = {
+            'file_name': str(self._file_names[idx]),
+            'image_id': int(self._image_ids[idx]),
+            'height': int(self._image_sizes[idx, 0]),
+            'width': int(self._image_sizes[idx, 1]),
+            'relations': np.array(columns['relations'][relation_start:relation_end]),
+        }
+        boxes = columns['boxes'][start:end].tolist()
+        classes = columns['classes'][start:end].tolist()
+        attributes = np.array(columns['attributes'][start:end])
+        if self._mask_format == 'polygon':
+            polygon_offsets = columns['polygon_offsets'][start:end + 1]
+            coord_offsets = np.array(columns['coord_offsets'][polygon_offsets[0]:polygon_offsets[-1] + 1])
+            coords = np.array(columns['coords'][coord_offsets[0]:coord_offsets[-1]])
+            coord_offsets -= coord_offsets[0]
+            polygon_offsets = polygon_offsets - polygon_offsets[0]
+        elif self._mask_format == 'rle':
+            rle_offsets = np.array(columns['rle_offsets'][start:end + 1])
+            rle_sizes = columns['rle_sizes'][start:end].tolist()
+            rle_counts = columns['rle_counts'][rle_offsets[0]:rle_offsets[-1]].tobytes()
+            rle_offsets -= rle_offsets[0]
+
+        objects = []
+        for obj_idx in range(end - start):
+            obj = {
+                'bbox': boxes[obj_idx],
+                'bbox_mode': BoxMode.XYXY_ABS,
+                'category_id': classes[obj_idx],
+                'attribute': attributes[obj_idx],
+            }
+            if self._mask_format == 'polygon':
+                obj['segmentation'] = [coords[coord_offsets[i]:coord_offsets[i + 1]]
+                                       for i in range(polygon_offsets[obj_idx], polygon_offsets[obj_idx + 1])]
+            elif self._mask_format == 'rle':
+                obj['segmentation'] = {'size': rle_sizes[obj_idx],
+                                       'counts': rle_counts[rle_offsets[obj_idx]:rle_offsets[obj_idx + 1]]}
+            objects.append(obj)
+        record['annotations'] = objects
+        return record
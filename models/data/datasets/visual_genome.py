@@ -5,6 +5,8 @@ from math import floor
 from PIL import Image, ImageDraw
 import random
 import os
+import itertools
+import multiprocessing as mp
 import torch
 import numpy as np
 import pickle
@@ -12,8 +14,13 @@ import yaml
 from detectron2.config import get_cfg
 from detectron2.structures import Instances, Boxes, pairwise_iou, BoxMode
 from detectron2.data import DatasetCatalog, MetadataCatalog
+from fvcore.common.file_io import file_lock
 import logging
 
+import pycocotools.mask as mask_util
+
+from . import vg_cache, mask_store
+
 class VisualGenomeTrainData:
     """
     Register data for Visual Genome training
@@ -57,21 +64,27 @@ class VisualGenomeTrainData:
         """
         Load data in detectron format
         """
-        fileName = "tmp/visual_genome_{}_data_{}{}{}{}{}.pkl".format(self.split, 'masks' if self.mask_exists else '', '_oi' if 'oi' in self.mask_location else '', "_clamped" if self.clamped else "", "_precomp" if self.precompute else "", "_clipped" if self.clipped else "")
-        if os.path.isfile(fileName):
-            #If data has been processed earlier, load that to save time
-            print("loading cached file: ", fileName)
-            with open(fileName, 'rb') as inputFile:
-                dataset_dicts = pickle.load(inputFile)
-        else:
-            #Process data
-            os.makedirs('tmp', exist_ok=True)
-            dataset_dicts = self._process_data()
-            #TODO: this can cause problems, if it is excecuted in a distributed setup
-            print("creating cache file: ", fileName)
-            with open(fileName, 'wb') as inputFile:
-                pickle.dump(dataset_dicts, inputFile)
-        return dataset_dicts
+        input_files = [self.cfg.DATASETS.VISUAL_GENOME.VG_ATTRIBUTE_H5, self.cfg.DATASETS.VISUAL_GENOME.IMAGE_DATA, self.mask_location]
+        key = vg_cache.cache_key(self.cfg, self.split, input_files)
+        cacheDir = os.path.join(self.cfg.DATASETS.VISUAL_GENOME.CACHE_DIR, "visual_genome_{}_{}".format(self.split, key))
+        self.cache_dir = cacheDir
+        if not vg_cache.is_valid_cache(cacheDir):
+            os.makedirs(self.cfg.DATASETS.VISUAL_GENOME.CACHE_DIR, exist_ok=True)
+            # The first process to get the lock builds the cache, the others wait and load it
+            with file_lock(cacheDir):
+                if not vg_cache.is_valid_cache(cacheDir):
+                    #Process data
+                    columns, meta = self._process_data()
+                    print("creating cache: ", cacheDir)
+                    vg_cache.save_columns(columns, meta, cacheDir)
+                    if not self.cfg.DATASETS.VISUAL_GENOME.LAZY_LOADING:
+                        return vg_cache.columns_to_dicts(columns, meta)
+        if self.cfg.DATASETS.VISUAL_GENOME.LAZY_LOADING:
+            # Records are read from the cache by the DataLoader workers
+            return vg_cache.LazyVisualGenomeDataset(cacheDir)
+        #If data has been processed earlier, load that to save time
+        print("loading cached data: ", cacheDir)
+        return vg_cache.columns_to_dicts(*vg_cache.load_columns(cacheDir))
             
     def _process_data(self):
         self.VG_attribute_h5 = h5py.File(self.cfg.DATASETS.VISUAL_GENOME.VG_ATTRIBUTE_H5, 'r')
@@ -87,30 +100,28 @@ class VisualGenomeTrainData:
         assert(len(self.image_data) == 108073)
         self.masks = None
         if self.mask_location != "":
-            try:
-                with open(self.mask_location, 'rb') as f:
-                    self.masks = pickle.load(f)
-            except:
-                pass
-        dataset_dicts = self._load_graphs()
-        return dataset_dicts
+            if mask_store.is_mask_store(self.mask_location):
+                self.masks = mask_store.MaskStore(self.mask_location)
+            else:
+                try:
+                    with open(self.mask_location, 'rb') as f:
+                        self.masks = pickle.load(f)
+                except:
+                    pass
+        return self._load_graphs()
 
     def get_statistics(self, eps=1e-3, bbox_overlap=True):
         num_object_classes = len(MetadataCatalog.get('VG_{}'.format(self.split)).thing_classes) + 1
         num_relation_classes = len(MetadataCatalog.get('VG_{}'.format(self.split)).predicate_classes) + 1
         
-        fg_matrix = np.zeros((num_object_classes, num_object_classes, num_relation_classes), dtype=np.int64)
-        bg_matrix = np.zeros((num_object_classes, num_object_classes), dtype=np.int64)
-        for idx, data in enumerate(self.dataset_dicts):
-            gt_relations = data['relations']
-            gt_classes = np.array([x['category_id'] for x in data['annotations']])
-            gt_boxes = np.array([x['bbox'] for x in data['annotations']])
-            for (o1, o2), rel in zip(gt_classes[gt_relations[:,:2]], gt_relations[:,2]):
-                fg_matrix[o1, o2, rel] += 1
-            for (o1, o2) in gt_classes[np.array(box_filter(gt_boxes, must_overlap=bbox_overlap), dtype=int)]:
-                bg_matrix[o1, o2] += 1
-        bg_matrix += 1
-        fg_matrix[:, :, -1] = bg_matrix
+        # The counts only depend on the cached dataset, they are stored along with it
+        statistics_file = vg_cache.statistics_file(self.cache_dir, num_object_classes, num_relation_classes, bbox_overlap)
+        if os.path.isfile(statistics_file):
+            fg_matrix = np.load(statistics_file)
+        else:
+            columns, _ = vg_cache.load_columns(self.cache_dir)
+            fg_matrix = count_triplets(columns, num_object_classes, num_relation_classes, bbox_overlap=bbox_overlap)
+            vg_cache.save_array(statistics_file, fg_matrix)
         pred_dist = np.log(fg_matrix / fg_matrix.sum(2)[:, :, None] + eps)
 
         result = {
@@ -125,7 +136,8 @@ class VisualGenomeTrainData:
 
     def _load_graphs(self):
         """
-        Parse examples and create dictionaries
+        Parse examples into flat per object and per relation arrays with per image offsets
+        (see vg_cache), all images at once
         """
         data_split = self.VG_attribute_h5['split'][:]
         split_flag = 2 if self.split == 'test' else 0
@@ -156,121 +168,203 @@ class VisualGenomeTrainData:
         all_boxes[:, :2] = all_boxes[:, :2] - all_boxes[:, 2:] / 2
         all_boxes[:, 2:] = all_boxes[:, :2] + all_boxes[:, 2:]
         
-        first_box_index = self.VG_attribute_h5['img_to_first_box'][split_mask]
-        last_box_index = self.VG_attribute_h5['img_to_last_box'][split_mask]
-        first_relation_index = self.VG_attribute_h5['img_to_first_rel'][split_mask]
-        last_relation_index = self.VG_attribute_h5['img_to_last_rel'][split_mask]
+        first_box_index = self.VG_attribute_h5['img_to_first_box'][:][split_mask]
+        last_box_index = self.VG_attribute_h5['img_to_last_box'][:][split_mask]
+        first_relation_index = self.VG_attribute_h5['img_to_first_rel'][:][split_mask]
+        last_relation_index = self.VG_attribute_h5['img_to_last_rel'][:][split_mask]
 
         #Load relation labels
         all_relations = self.VG_attribute_h5['relationships'][:]
         all_relation_predicates = self.VG_attribute_h5['predicates'][:, 0]
         
         image_indexer = np.arange(len(self.image_data))[split_mask]
-        # Iterate over images
-        dataset_dicts = []
-        for idx, _ in enumerate(image_index):
-            record = {}
-            #Get image metadata
-            image_data = self.image_data[image_indexer[idx]]
-            record['file_name'] = os.path.join(self.cfg.DATASETS.VISUAL_GENOME.IMAGES, '{}.jpg'.format(image_data['image_id']))
-            record['image_id'] = image_data['image_id']
-            record['height'] = image_data['height']
-            record['width'] = image_data['width']
-    
-            #Get annotations
-            boxes = all_boxes[first_box_index[idx]:last_box_index[idx] + 1, :]
-            gt_classes = all_labels[first_box_index[idx]:last_box_index[idx] + 1]
-            gt_attributes = all_attributes[first_box_index[idx]:last_box_index[idx] + 1, :]
+        image_ids = np.array([self.image_data[i]['image_id'] for i in image_indexer], dtype=np.int64)
+        image_sizes = np.array([[self.image_data[i]['height'], self.image_data[i]['width']] for i in image_indexer], dtype=np.int64).reshape(-1, 2)
 
-            if first_relation_index[idx] > -1:
-                predicates = all_relation_predicates[first_relation_index[idx]:last_relation_index[idx] + 1]
-                objects = all_relations[first_relation_index[idx]:last_relation_index[idx] + 1] - first_box_index[idx]
-                predicates = predicates - 1
-                relations = np.column_stack((objects, predicates))
-            else:
-                assert not self.cfg.DATASETS.VISUAL_GENOME.FILTER_EMPTY_RELATIONS
-                relations = np.zeros((0, 3), dtype=np.int32)
-            
-            if self.cfg.DATASETS.VISUAL_GENOME.FILTER_NON_OVERLAP and self.split == 'train':
-                # Remove boxes that don't overlap
-                boxes_list = Boxes(boxes)
-                ious = pairwise_iou(boxes_list, boxes_list)
-                relation_boxes_ious = ious[relations[:,0], relations[:,1]]
-                iou_indexes = np.where(relation_boxes_ious > 0.0)[0]
-                if iou_indexes.size > 0:
-                    relations = relations[iou_indexes]
-                else:
-                    #Ignore image
-                    continue
-            #Get masks if possible
-            if self.masks is not None:
-                try:
-                    gt_masks = self.masks[image_data['image_id']]
-                except:
-                    print (image_data['image_id'])
-            record['relations'] = relations
-            objects = []
-            # if len(boxes) != len(gt_masks):
+        # The objects and relations of an image are contiguous ranges of the H5 arrays
+        num_boxes = last_box_index - first_box_index + 1
+        has_relations = first_relation_index > -1
+        assert has_relations.all() or not self.cfg.DATASETS.VISUAL_GENOME.FILTER_EMPTY_RELATIONS
+        num_relations = np.where(has_relations, last_relation_index - first_relation_index + 1, 0)
+        relation_image = np.repeat(np.arange(len(image_index)), num_relations)
+        relation_index = _segment_ranges(first_relation_index, num_relations)
+        relations = np.column_stack((all_relations[relation_index] - first_box_index[relation_image][:, None], all_relation_predicates[relation_index] - 1))
+
+        if self.cfg.DATASETS.VISUAL_GENOME.FILTER_NON_OVERLAP and self.split == 'train':
+            # Remove relations between boxes that don't overlap, and images left without relations
+            subject_boxes = all_boxes[first_box_index[relation_image] + relations[:, 0]]
+            object_boxes = all_boxes[first_box_index[relation_image] + relations[:, 1]]
+            overlap = _box_intersection(subject_boxes, object_boxes) > 0
+            relations, relation_image = relations[overlap], relation_image[overlap]
+            num_relations = np.bincount(relation_image, minlength=len(image_index))
+            keep_image = num_relations > 0
+            image_ids, image_sizes = image_ids[keep_image], image_sizes[keep_image]
+            first_box_index, num_boxes, num_relations = first_box_index[keep_image], num_boxes[keep_image], num_relations[keep_image]
+
+        box_index = _segment_ranges(first_box_index, num_boxes)
+        box_image = np.repeat(np.arange(len(image_ids)), num_boxes)
+        boxes = all_boxes[box_index] / self.cfg.DATASETS.VISUAL_GENOME.BOX_SCALE * image_sizes.max(1)[box_image][:, None]
+        columns = {
+            'image_ids': image_ids,
+            'image_sizes': image_sizes,
+            'boxes': boxes,
+            'classes': all_labels[box_index] - 1,
+            'attributes': all_attributes[box_index],
+            'relation_offsets': _offsets(num_relations),
+            'relations': relations,
+        }
+
+        mask_format = None if self.masks is None else 'rle' if isinstance(self.masks, mask_store.MaskStore) else 'polygon'
+        polygon_lengths, polygons, rles = np.zeros(len(box_index), dtype=np.int64), [], []
+        if mask_format is None:
+            columns['image_offsets'] = _offsets(num_boxes)
+        else:
+            # Objects without a valid mask are removed
+            keep_object, num_segments, segments = self._load_masks(image_ids, num_boxes)
+            for name in ['boxes', 'classes', 'attributes']:
+                columns[name] = columns[name][keep_object]
+            columns['image_offsets'] = _offsets(np.bincount(box_image[keep_object], minlength=len(image_ids)))
+            polygon_lengths = num_segments[keep_object] if mask_format == 'polygon' else np.zeros(keep_object.sum(), dtype=np.int64)
+            polygons = segments if mask_format == 'polygon' else []
+            rles = segments if mask_format == 'rle' else []
+
+        columns['polygon_offsets'] = _offsets(polygon_lengths)
+        columns['coord_offsets'] = _offsets([len(poly) for poly in polygons])
+        columns['coords'] = np.concatenate(polygons).astype(np.float64) if polygons else np.zeros(0, dtype=np.float64)
+        # One RLE per kept object
+        columns['rle_offsets'] = _offsets([len(rle['counts']) for rle in rles])
+        columns['rle_sizes'] = np.array([rle['size'] for rle in rles], dtype=np.int64).reshape(-1, 2)
+        columns['rle_counts'] = np.frombuffer(b''.join(rle['counts'] for rle in rles), dtype=np.uint8)
+
+        meta = {
+            'num_images': len(image_ids),
+            'file_names': [os.path.join(self.cfg.DATASETS.VISUAL_GENOME.IMAGES, '{}.jpg'.format(image_id)) for image_id in image_ids.tolist()],
+            'mask_format': mask_format,
+        }
+        return columns, meta
+
+    def _load_masks(self, image_ids, num_boxes):
+        """
+        Masks of every object read from the mask file: valid polygons (at least 3 points) of
+        a polygon file, or the non empty RLE of a mask store
+        Returns:
+            keep_object (array[bool]): objects with a valid mask
+            num_segments (array[int]): number of polygons or RLEs of every object
+            segments (list): polygons or RLEs of the kept objects, in order
+        """
+        num_workers = self.cfg.DATASETS.VISUAL_GENOME.NUM_CACHE_WORKERS
+        if num_workers <= 1:
+            return self._load_masks_range(image_ids, num_boxes, 0, len(image_ids))
+
+        # Images are split in contiguous shards so that the order of the objects is preserved
+        global _LOAD_MASKS_STATE
+        _LOAD_MASKS_STATE = (self, image_ids, num_boxes)
+        bounds = np.linspace(0, len(image_ids), 4 * num_workers + 1).astype(int)
+        try:
+            with mp.get_context('fork').Pool(num_workers) as pool:
+                shards = pool.map(_load_masks_shard, list(zip(bounds[:-1], bounds[1:])))
+        finally:
+            _LOAD_MASKS_STATE = None
+        keep_object = np.concatenate([shard[0] for shard in shards])
+        num_segments = np.concatenate([shard[1] for shard in shards])
+        segments = list(itertools.chain.from_iterable(shard[2] for shard in shards))
+        return keep_object, num_segments, segments
+
+    def _load_masks_range(self, image_ids, num_boxes, start, end):
+        is_rle = isinstance(self.masks, mask_store.MaskStore)
+        keep_object, num_segments, segments = [], [], []
+        for idx in range(start, end):
+            try:
+                gt_masks = self.masks[int(image_ids[idx])]
+            except:
+                print (image_ids[idx])
             mask_idx = 0
-            for obj_idx in range(len(boxes)):
-                resized_box = boxes[obj_idx] / self.cfg.DATASETS.VISUAL_GENOME.BOX_SCALE * max(record['height'], record['width'])
-                obj = {
-                      "bbox": resized_box.tolist(),
-                      "bbox_mode": BoxMode.XYXY_ABS,
-                      "category_id": gt_classes[obj_idx] - 1,
-                      "attribute": gt_attributes[obj_idx],           
-                }
-                if self.masks is not None:
-                    if gt_masks['empty_index'][obj_idx]:
-                        refined_poly = []
+            for obj_idx in range(num_boxes[idx]):
+                refined_segments = []
+                if gt_masks['empty_index'][obj_idx]:
+                    if is_rle:
+                        rle = gt_masks['rles'][mask_idx]
+                        if mask_util.area(rle) > 0:
+                            refined_segments.append(rle)
+                    else:
                         for poly_idx, poly in enumerate(gt_masks['polygons'][mask_idx]):
                             if len(poly) >= 6:
-                                refined_poly.append(poly)
-                        obj["segmentation"] = refined_poly
-                        mask_idx += 1
-                    else:
-                        obj["segmentation"] = []
-                    if len(obj["segmentation"]) > 0:
-                        objects.append(obj)
-                else:
-                    objects.append(obj)
-            record['annotations'] = objects
-            dataset_dicts.append(record)
-        
-        return dataset_dicts
+                                refined_segments.append(poly)
+                    mask_idx += 1
+                keep_object.append(len(refined_segments) > 0)
+                num_segments.append(len(refined_segments))
+                segments.extend(refined_segments)
+        return np.array(keep_object, dtype=bool), np.array(num_segments, dtype=np.int64), segments
 
-def box_filter(boxes, must_overlap=False):
-    """ Only include boxes that overlap as possible relations. 
-    If no overlapping boxes, use all of them."""
-    n_cands = boxes.shape[0]
+def _segment_ranges(starts, lengths):
+    """
+    Concatenation of the ranges [start, start + length) of every segment
+    """
+    lengths = np.asarray(lengths, dtype=np.int64)
+    offsets = _offsets(lengths)
+    return np.repeat(np.asarray(starts, dtype=np.int64) - offsets[:-1], lengths) + np.arange(offsets[-1], dtype=np.int64)
 
-    overlaps = bbox_overlaps(boxes.astype(np.float), boxes.astype(np.float), to_move=0) > 0
-    np.fill_diagonal(overlaps, 0)
+def _offsets(counts):
+    return np.concatenate(([0], np.cumsum(counts, dtype=np.int64)))
 
-    all_possib = np.ones_like(overlaps, dtype=np.bool)
-    np.fill_diagonal(all_possib, 0)
+def _box_intersection(boxes1, boxes2):
+    """
+    Intersection area of every pair of aligned XYXY boxes
+    """
+    width_height = np.minimum(boxes1[:, 2:], boxes2[:, 2:]) - np.maximum(boxes1[:, :2], boxes2[:, :2])
+    return np.clip(width_height, 0, None).prod(1)
 
-    if must_overlap:
-        possible_boxes = np.column_stack(np.where(overlaps))
+# (dataset, image_ids, num_boxes) of the _load_masks call in progress, inherited by the forked workers
+_LOAD_MASKS_STATE = None
 
-        if possible_boxes.size == 0:
-            possible_boxes = np.column_stack(np.where(all_possib))
-    else:
-        possible_boxes = np.column_stack(np.where(all_possib))
-    return possible_boxes
+def _load_masks_shard(bounds):
+    dataset, image_ids, num_boxes = _LOAD_MASKS_STATE
+    return dataset._load_masks_range(image_ids, num_boxes, *bounds)
 
-def bbox_overlaps(boxes1, boxes2, to_move=1):
+def count_triplets(columns, num_object_classes, num_relation_classes, bbox_overlap=True):
     """
-    boxes1 : numpy, [num_obj, 4] (x1,y1,x2,y2)
-    boxes2 : numpy, [num_obj, 4] (x1,y1,x2,y2)
+    Frequency of the (subject, object, predicate) triplets of a dataset
+    Args:
+        columns (dict[str, array]): dataset in the vg_cache layout
+        bbox_overlap (bool): background pairs are the overlapping boxes of an image, or all
+            of them if none overlap. Otherwise all pairs of boxes are background pairs.
+    Returns:
+        fg_matrix (array): (num_object_classes, num_object_classes, num_relation_classes)
+            counts, where the last predicate counts the background pairs (plus one)
     """
-    #print('boxes1: ', boxes1.shape)
-    #print('boxes2: ', boxes2.shape)
-    num_box1 = boxes1.shape[0]
-    num_box2 = boxes2.shape[0]
-    lt = np.maximum(boxes1.reshape([num_box1, 1, -1])[:,:,:2], boxes2.reshape([1, num_box2, -1])[:,:,:2]) # [N,M,2]
-    rb = np.minimum(boxes1.reshape([num_box1, 1, -1])[:,:,2:], boxes2.reshape([1, num_box2, -1])[:,:,2:]) # [N,M,2]
+    classes = np.asarray(columns['classes'])
+    boxes = np.asarray(columns['boxes'], dtype=np.float64)
+    relations = np.asarray(columns['relations'])
+    image_offsets = np.asarray(columns['image_offsets'])
+    num_objects = np.diff(image_offsets)
+
+    fg_matrix = np.zeros((num_object_classes, num_object_classes, num_relation_classes), dtype=np.int64)
+    bg_matrix = np.zeros((num_object_classes, num_object_classes), dtype=np.int64)
+
+    # Relations are indexed within their image
+    relation_image = np.repeat(np.arange(len(num_objects)), np.diff(columns['relation_offsets']))
+    if (relations[:, :2] >= num_objects[relation_image][:, None]).any():
+        raise IndexError("Relations refer to objects that are not in the dataset")
+    subjects = image_offsets[relation_image] + relations[:, 0]
+    objects = image_offsets[relation_image] + relations[:, 1]
+    np.add.at(fg_matrix, (classes[subjects], classes[objects], relations[:, 2]), 1)
+
+    # Images with the same number of objects are processed as one (images, n, n) batch
+    for n in np.unique(num_objects):
+        if n < 2:
+            continue
+        object_index = image_offsets[:-1][num_objects == n][:, None] + np.arange(n)
+        pair_classes = classes[object_index]
+        not_self = ~np.eye(n, dtype=bool)
+        pairs = np.broadcast_to(not_self, (len(object_index), n, n))
+        if bbox_overlap:
+            image_boxes = boxes[object_index]
+            width_height = np.minimum(image_boxes[:, :, None, 2:], image_boxes[:, None, :, 2:]) - np.maximum(image_boxes[:, :, None, :2], image_boxes[:, None, :, :2])
+            overlaps = (np.clip(width_height, 0, None).prod(3) > 0) & not_self
+            pairs = np.where(overlaps.any((1, 2))[:, None, None], overlaps, pairs)
+        images, o1, o2 = np.nonzero(pairs)
+        np.add.at(bg_matrix, (pair_classes[images, o1], pair_classes[images, o2]), 1)
 
-    wh = (rb - lt + to_move).clip(min=0)  # [N,M,2]
-    inter = wh[:, :, 0] * wh[:, :, 1]  # [N,M]
-    return inter
\ No newline at end of file
+    bg_matrix += 1
+    fg_matrix[:, :, -1] = bg_matrix
+    return fg_matrix
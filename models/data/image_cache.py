@@ -0,0 +1,143 @@
+"""
+Cache of decoded training images, resized to the largest size the training augmentations use.
+
+The images are stored as raw uint8 arrays appended to chunk files of at most CHUNK_SIZE bytes,
+with an index of their chunk, offset and shape, and memory-mapped when read back. Decoding a
+JPEG and resizing it from full resolution is then replaced by a copy of the cached pixels.
+"""
+import os
+import json
+import shutil
+import logging
+import multiprocessing as mp
+import numpy as np
+
+from detectron2.data import detection_utils as utils
+from detectron2.data import transforms as T
+
+META_FILE = 'meta.json'
+INDEX_FILE = 'index.npz'
+CHUNK_SIZE = 4 << 30
+
+
+# (min size, max size, image format) of the build_image_cache call in progress, inherited by the forked workers
+_BUILD_STATE = None
+
+def _resized_image(file_name):
+    min_size, max_size, image_format = _BUILD_STATE
+    image = utils.read_image(file_name, format=image_format)
+    height, width = image.shape[:2]
+    transform = T.ResizeShortestEdge(min_size, max_size).get_transform(image)
+    # Images smaller than the training size are kept as they are, the augmentations upsample them
+    if isinstance(transform, T.ResizeTransform) and transform.new_h * transform.new_w < height * width:
+        image = transform.apply_image(image)
+    return np.ascontiguousarray(image), (height, width)
+
+
+def build_image_cache(file_names, output_dir, min_size, max_size, image_format, num_workers=0):
+    """
+    Args:
+        file_names (list[str]): images to cache
+        output_dir (str): directory of the cache. It is written to a temporary directory
+            renamed to output_dir once complete.
+        min_size, max_size (int): the short edge of the cached images is resized to min_size,
+            unless the long edge would then exceed max_size, as with ResizeShortestEdge
+        image_format (str): format of utils.read_image, i.e. cfg.INPUT.FORMAT
+        num_workers (int): processes decoding and resizing the images
+    """
+    logger = logging.getLogger(__name__)
+    global _BUILD_STATE
+    _BUILD_STATE = (min_size, max_size, image_format)
+    tmp_dir = '{}.tmp{}'.format(output_dir, os.getpid())
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+
+    chunks, offsets, shapes, image_sizes = [], [], [], []
+    chunk_file, chunk_size, num_chunks = None, 0, 0
+    pool = mp.get_context('fork').Pool(num_workers) if num_workers > 0 else None
+    try:
+        images = pool.imap(_resized_image, file_names, chunksize=8) if pool is not None else map(_resized_image, file_names)
+        for idx, (image, image_size) in enumerate(images):
+            if chunk_file is None or chunk_size + image.nbytes > CHUNK_SIZE:
+                if chunk_file is not None:
+                    chunk_file.close()
+                chunk_file = open(os.path.join(tmp_dir, 'images_{:04d}.bin'.format(num_chunks)), 'wb')
+                chunk_size, num_chunks = 0, num_chunks + 1
+            chunk_file.write(image.tobytes())
+            chunks.append(num_chunks - 1)
+            offsets.append(chunk_size)
+            shapes.append(image.shape)
+            image_sizes.append(image_size)
+            chunk_size += image.nbytes
+            if (idx + 1) % 1000 == 0:
+                logger.info("Cached {}/{} images".format(idx + 1, len(file_names)))
+    finally:
+        if pool is not None:
+            pool.terminate()
+        if chunk_file is not None:
+            chunk_file.close()
+        _BUILD_STATE = None
+
+    np.savez(
+        os.path.join(tmp_dir, INDEX_FILE),
+        file_names=np.array(file_names),
+        chunks=np.array(chunks, dtype=np.int64),
+        offsets=np.array(offsets, dtype=np.int64),
+        shapes=np.array(shapes, dtype=np.int64).reshape(-1, 3),
+        image_sizes=np.array(image_sizes, dtype=np.int64).reshape(-1, 2),
+    )
+    # The meta file marks the cache as complete
+    with open(os.path.join(tmp_dir, META_FILE), 'w') as f:
+        json.dump({'num_images': len(file_names), 'min_size': min_size, 'max_size': max_size, 'format': image_format}, f)
+    shutil.rmtree(output_dir, ignore_errors=True)
+    os.rename(tmp_dir, output_dir)
+
+
+class ImageCache(object):
+    """
+    Reader of a cache written by `build_image_cache`, indexed by file name. The chunks are
+    memory-mapped by each process the first time it reads an image, i.e. in the DataLoader
+    workers.
+    """
+    def __init__(self, path):
+        self._path = path
+        with open(os.path.join(path, META_FILE)) as f:
+            self.meta = json.load(f)
+        with np.load(os.path.join(path, INDEX_FILE)) as index:
+            self._index = {name: idx for idx, name in enumerate(index['file_names'].tolist())}
+            self._chunks = index['chunks']
+            self._offsets = index['offsets']
+            self._shapes = index['shapes']
+            self._image_sizes = index['image_sizes']
+        self._chunk_files = None
+        self._pid = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_chunk_files'] = None
+        state['_pid'] = None
+        return state
+
+    def __contains__(self, file_name):
+        return file_name in self._index
+
+    def __len__(self):
+        return len(self._index)
+
+    def read(self, file_name):
+        """
+        Returns:
+            image (array): the cached image, in the format of the cache
+            image_size (tuple): (h, w) of the original image
+        """
+        if self._pid != os.getpid():
+            self._chunk_files = {}
+            self._pid = os.getpid()
+        idx = self._index[file_name]
+        chunk = int(self._chunks[idx])
+        if chunk not in self._chunk_files:
+            self._chunk_files[chunk] = np.memmap(os.path.join(self._path, 'images_{:04d}.bin'.format(chunk)), dtype=np.uint8, mode='r')
+        shape = tuple(self._shapes[idx].tolist())
+        start = int(self._offsets[idx])
+        image = np.array(self._chunk_files[chunk][start:start + int(np.prod(shape))]).reshape(shape)
+        return image, tuple(self._image_sizes[idx].tolist())
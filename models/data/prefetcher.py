@@ -0,0 +1,101 @@
+import time
+import queue
+import threading
+import contextlib
+import torch
+
+try:
+    _nullcontext = contextlib.nullcontext  # python 3.7+
+except AttributeError:
+    @contextlib.contextmanager
+    def _nullcontext(enter_result=None):
+        yield enter_result
+
+
+class _Raised(object):
+    # Exception of the loader, raised again by the consumer
+    def __init__(self, exception):
+        self.exception = exception
+
+
+class DataPrefetcher(object):
+    """
+    Iterate a data loader in a background thread, with up to `depth` batches prepared ahead
+    (2 for double buffering). The images of the batches can be pinned and copied to the GPU
+    asynchronously on a side stream, so that the copy overlaps with the previous step.
+    The time `next` waited for the last batch is `wait_time`.
+    """
+    def __init__(self, data_loader, depth=2, pin_memory=False, device=None):
+        """
+        Args:
+            data_loader (iterable): yields lists of dicts in detectron2 format
+            depth (int): number of batches prepared ahead, 0 reads the loader in the caller thread
+            pin_memory (bool): pin the "image" tensors of the batches
+            device (torch.device): copy the "image" tensors to this (cuda) device
+        """
+        self._iterator = iter(data_loader)
+        self._depth = depth
+        self._pin_memory = pin_memory and torch.cuda.is_available()
+        self._device = torch.device(device) if device is not None else None
+        if self._device is not None and self._device.type == "cuda" and self._device.index is None:
+            # The background thread sets this device, which needs an index
+            self._device = torch.device("cuda", torch.cuda.current_device())
+        self._stream = torch.cuda.Stream(self._device) if self._device is not None and self._device.type == "cuda" else None
+        self.wait_time = 0.0
+        if depth > 0:
+            self._queue = queue.Queue(maxsize=depth)
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+
+    def _prepare(self, batch):
+        if not self._pin_memory and self._stream is None:
+            return batch, None
+        with torch.cuda.stream(self._stream) if self._stream is not None else _nullcontext():
+            for x in batch:
+                image = x.get("image")
+                if image is None:
+                    continue
+                if self._pin_memory:
+                    image = image.pin_memory()
+                if self._stream is not None:
+                    image = image.to(self._device, non_blocking=self._pin_memory)
+                x["image"] = image
+        event = None
+        if self._stream is not None:
+            event = torch.cuda.Event()
+            event.record(self._stream)
+        return batch, event
+
+    def _run(self):
+        try:
+            if self._stream is not None:
+                torch.cuda.set_device(self._device)
+            for batch in self._iterator:
+                self._queue.put(self._prepare(batch))
+            self._queue.put(_Raised(StopIteration()))
+        except Exception as e:
+            self._queue.put(_Raised(e))
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        start = time.perf_counter()
+        if self._depth > 0:
+            item = self._queue.get()
+            if isinstance(item, _Raised):
+                # Raised again by every following call
+                self._queue.put(item)
+                raise item.exception
+        else:
+            item = self._prepare(next(self._iterator))
+        batch, event = item
+        if event is not None:
+            # The copies of the side stream are done before the batch is used, and its memory is
+            # not reused by the side stream while the current stream uses it
+            torch.cuda.current_stream(self._device).wait_event(event)
+            for x in batch:
+                if "image" in x:
+                    x["image"].record_stream(torch.cuda.current_stream(self._device))
+        self.wait_time = time.perf_counter() - start
+        return batch
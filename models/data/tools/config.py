@@ -24,6 +24,12 @@ def add_dataset_config(cfg):
   _C.DATASETS.VISUAL_GENOME.TEST_MASKS = ""
   _C.DATASETS.VISUAL_GENOME.VAL_MASKS = ""
   _C.DATASETS.VISUAL_GENOME.CLIPPED = False
+  _C.DATASETS.VISUAL_GENOME.MASK_FORMAT = 'polygon' # Format of the exported mask labels, 'polygon' (pickle) or 'rle' (memory-mapped mask store directory)
+  _C.DATASETS.VISUAL_GENOME.NUM_MASK_EXPORT_WORKERS = 4 # Processes encoding the exported mask labels during inference, 0 encodes them in the main process
+  _C.DATASETS.VISUAL_GENOME.RESUME_MASK_EXPORT = False # Skip the images already written to the mask label shards by an interrupted export with the same weights, else the shards are cleared
+  _C.DATASETS.VISUAL_GENOME.CACHE_DIR = 'tmp' # Binary caches of the dataset dicts, keyed by a hash of this config and the input files
+  _C.DATASETS.VISUAL_GENOME.NUM_CACHE_WORKERS = 0 # Processes reading the masks of the images (contiguous shards) when building the cache, the graphs are always loaded in the main process. 0 or 1 reads them in the main process
+  _C.DATASETS.VISUAL_GENOME.LAZY_LOADING = False # Register a map-style dataset reading the records from the cache on demand instead of a list of dicts
 
   _C.DATASETS.MSCOCO = CN()
   _C.DATASETS.MSCOCO.ANNOTATIONS = ''
@@ -36,6 +42,10 @@ def add_dataset_config(cfg):
   _C.DATASETS.VISUAL_GENOME.BOX_SCALE = 1024
 
   _C.DATASETS.SEG_DATA_DIVISOR = 1
+  _C.DATASETS.IMAGE_CACHE = '' # Pre-resized training images written by scripts/build_image_cache.py, read by the scene graph mappers instead of decoding the files
+
+  _C.DATALOADER.PREFETCH_DEPTH = 2 # Batches of the VG and COCO loaders prepared ahead by background threads in SceneGraphSegmentationTrainer, 0 reads them in the training loop
+  _C.DATALOADER.PIN_MEMORY = False # Pin the prefetched images and copy them to the GPU on a side stream
 
   _C.DATASETS.TRANSFER = ('coco_train_2014',)
   _C.DATASETS.MASK_TRAIN = ('coco_train_2017',)
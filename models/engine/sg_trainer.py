@@ -16,7 +16,7 @@ from detectron2.data import (
 from detectron2.evaluation import DatasetEvaluators, DatasetEvaluator, print_csv_format, inference_context
 
 from detectron2.engine import HookBase
-from segmentationsg.data import SceneGraphDatasetMapper
+from segmentationsg.data import SceneGraphDatasetMapper, DataPrefetcher, build_scenegraph_train_loader, build_scenegraph_test_loader
 from detectron2.evaluation import (
     COCOEvaluator
 )
@@ -35,11 +35,11 @@ class SceneGraphTrainer(DefaultTrainer):
 
     @classmethod
     def build_train_loader(cls, cfg):
-        return build_detection_train_loader(cfg, mapper=SceneGraphDatasetMapper(cfg, True))
+        return build_scenegraph_train_loader(cfg, SceneGraphDatasetMapper(cfg, True))
 
     @classmethod
     def build_test_loader(cls, cfg, dataset_name):
-        return build_detection_test_loader(cfg, dataset_name, mapper=SceneGraphDatasetMapper(cfg, False))
+        return build_scenegraph_test_loader(cfg, dataset_name, SceneGraphDatasetMapper(cfg, False))
 
     def build_hooks(self):
         """
@@ -131,15 +131,19 @@ class SceneGraphTrainer(DefaultTrainer):
 class SceneGraphSegmentationTrainer(DefaultTrainer):
     def __init__(self, cfg):
         super(SceneGraphSegmentationTrainer, self).__init__(cfg)
-        self.mask_train_loader = iter(self.build_mask_loader(cfg, is_train=True))
+        # Both loaders are read ahead in background threads, the time each step waits for them
+        # is written to the event storage
+        device = cfg.MODEL.DEVICE if cfg.DATALOADER.PIN_MEMORY else None
+        self.data_prefetcher = DataPrefetcher(self._trainer._data_loader_iter, cfg.DATALOADER.PREFETCH_DEPTH, cfg.DATALOADER.PIN_MEMORY, device)
+        self.mask_train_loader = DataPrefetcher(self.build_mask_loader(cfg, is_train=True), cfg.DATALOADER.PREFETCH_DEPTH, cfg.DATALOADER.PIN_MEMORY, device)
 
     @classmethod
     def build_train_loader(cls, cfg):
-        return build_detection_train_loader(cfg, mapper=SceneGraphDatasetMapper(cfg, True))
+        return build_scenegraph_train_loader(cfg, SceneGraphDatasetMapper(cfg, True))
 
     @classmethod
     def build_test_loader(cls, cfg, dataset_name):
-        return build_detection_test_loader(cfg, dataset_name, mapper=SceneGraphDatasetMapper(cfg, False))
+        return build_scenegraph_test_loader(cfg, dataset_name, SceneGraphDatasetMapper(cfg, False))
 
     @classmethod
     def build_mask_loader(cls, cfg, is_train=True):
@@ -257,9 +261,10 @@ class SceneGraphSegmentationTrainer(DefaultTrainer):
         """
         If you want to do something with the data, you can wrap the dataloader.
         """
-        data = next(self._trainer._data_loader_iter)
+        data = next(self.data_prefetcher)
         mask_data = next(self.mask_train_loader)
         data_time = time.perf_counter() - start
+        self.storage.put_scalars(vg_data_wait_time=self.data_prefetcher.wait_time, coco_data_wait_time=self.mask_train_loader.wait_time)
 
         """
         If you want to do something with the losses, you can wrap the model.
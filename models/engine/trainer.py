@@ -5,6 +5,10 @@ import detectron2.utils.comm as comm
 import time 
 import datetime
 import pickle
+import os
+import shutil
+import collections
+import multiprocessing as mp
 from collections import OrderedDict
 from detectron2.utils.logger import log_every_n_seconds
 from detectron2.engine import DefaultTrainer
@@ -18,7 +22,8 @@ from detectron2.evaluation import DatasetEvaluator, print_csv_format, inference_
 from imantics import Mask
 
 from detectron2.engine import HookBase
-from segmentationsg.data import MaskLabelDatasetMapper, ObjectDetectionDatasetMapper, MaskRCNNDatasetMapper
+from segmentationsg.data.datasets import mask_store
+from segmentationsg.data import MaskLabelDatasetMapper, ObjectDetectionDatasetMapper, MaskRCNNDatasetMapper, build_scenegraph_train_loader, build_scenegraph_test_loader
 from detectron2.evaluation import (
     COCOEvaluator,
     DatasetEvaluators
@@ -46,11 +51,11 @@ class MaskLabelTrainer(DefaultTrainer):
 
     @classmethod
     def build_train_loader(cls, cfg):
-        return build_detection_train_loader(cfg, mapper=MaskLabelDatasetMapper(cfg, True))
+        return build_scenegraph_train_loader(cfg, MaskLabelDatasetMapper(cfg, True))
 
     @classmethod
     def build_test_loader(cls, cfg, dataset_name):
-        return build_detection_test_loader(cfg, dataset_name, mapper=MaskLabelDatasetMapper(cfg, False))
+        return build_scenegraph_test_loader(cfg, dataset_name, MaskLabelDatasetMapper(cfg, False))
 
     @classmethod
     def test(cls, cfg, model, evaluators=None):
@@ -58,7 +63,8 @@ class MaskLabelTrainer(DefaultTrainer):
         results = OrderedDict()
         for idx, dataset_name in enumerate(cfg.DATASETS.TEST):
             data_loader = cls.build_test_loader(cfg, dataset_name)
-            results_i = inference_on_dataset_get_mask_labels(model, data_loader, None, cfg.DATASETS.VISUAL_GENOME.TEST_MASKS)
+            results_i = inference_on_dataset_get_mask_labels(model, data_loader, None, cfg.DATASETS.VISUAL_GENOME.TEST_MASKS, cfg.DATASETS.VISUAL_GENOME.MASK_FORMAT,
+                                                             cfg.DATASETS.VISUAL_GENOME.NUM_MASK_EXPORT_WORKERS, cfg.DATASETS.VISUAL_GENOME.RESUME_MASK_EXPORT)
             results[dataset_name] = results_i
             if comm.is_main_process():
                 assert isinstance(
@@ -125,11 +131,11 @@ class ObjectDetectorTrainer(DefaultTrainer):
 
     @classmethod
     def build_train_loader(cls, cfg):
-        return build_detection_train_loader(cfg, mapper=ObjectDetectionDatasetMapper(cfg, True))
+        return build_scenegraph_train_loader(cfg, ObjectDetectionDatasetMapper(cfg, True))
 
     @classmethod
     def build_test_loader(cls, cfg, dataset_name):
-        return build_detection_test_loader(cfg, dataset_name, mapper=ObjectDetectionDatasetMapper(cfg, False))
+        return build_scenegraph_test_loader(cfg, dataset_name, ObjectDetectionDatasetMapper(cfg, False))
     
     @classmethod
     def build_evaluator(cls, cfg, dataset_name):
@@ -192,11 +198,11 @@ class ObjectDetectorTrainerWithCoco(DefaultTrainer):
 
     @classmethod
     def build_train_loader(cls, cfg):
-        return build_detection_train_loader(cfg, mapper=ObjectDetectionDatasetMapper(cfg, True))
+        return build_scenegraph_train_loader(cfg, ObjectDetectionDatasetMapper(cfg, True))
 
     @classmethod
     def build_test_loader(cls, cfg, dataset_name):
-        return build_detection_test_loader(cfg, dataset_name, mapper=ObjectDetectionDatasetMapper(cfg, False))
+        return build_scenegraph_test_loader(cfg, dataset_name, ObjectDetectionDatasetMapper(cfg, False))
 
     @classmethod
     def build_mask_loader(cls, cfg, is_train=True):
@@ -513,7 +519,44 @@ def inference_on_dataset_with_coco(model, data_loader, evaluator, mode='sg'):
         results = {}
     return results
 
-def inference_on_dataset_get_mask_labels(model, data_loader, evaluator, mask_h5_path=""):
+class _EncodedMasks(object):
+    # Result of the masks encoded in the main process, with the interface of an AsyncResult
+    def __init__(self, value):
+        self._value = value
+
+    def ready(self):
+        return True
+
+    def get(self):
+        return self._value
+
+def _encode_mask_labels(job):
+    """
+    Encode the masks of one image, in the processes of the export pool
+    Args:
+        job (tuple): mask format, bit-packed masks and their (N, H, W) shape
+    """
+    mask_format, packed_masks, shape = job
+    masks = np.unpackbits(packed_masks, count=int(np.prod(shape))).reshape(shape)
+    if mask_format == 'rle':
+        return mask_store.encode_masks(masks)
+    return [Mask(mask.astype(bool)).polygons().segmentation for mask in masks]
+
+def inference_on_dataset_get_mask_labels(model, data_loader, evaluator, mask_h5_path="", mask_format='polygon',
+                                         num_workers=0, resume=False, checkpoint_period=1000):
+    """
+    Predict the masks of the dataset and export them as mask labels. The masks are encoded by
+    a pool of `num_workers` processes while the model runs, and written incrementally by every
+    rank to its own shard, so that an interrupted export can be resumed.
+    Args:
+        mask_h5_path (str): output file of the polygon pickle, or output directory of the mask
+            store. The polygon shards are written to mask_h5_path + '.shards'.
+        mask_format (str): 'polygon' or 'rle'
+        num_workers (int): encoding processes, 0 encodes the masks in the main process
+        resume (bool): skip the images already in the shards of an interrupted export, else
+            the shards of an earlier export are removed. A complete export is never resumed
+        checkpoint_period (int): images between two checkpoints of the shards
+    """
     num_devices = comm.get_world_size()
     logger = logging.getLogger(__name__)
     logger.info("Start inference on {} images".format(len(data_loader)))
@@ -527,39 +570,88 @@ def inference_on_dataset_get_mask_labels(model, data_loader, evaluator, mask_h5_
     num_warmup = min(5, total - 1)
     start_time = time.perf_counter()
     total_compute_time = 0
-    
-    image_masks = {}
-    with inference_context(model), torch.no_grad():
-        for idx, inputs in enumerate(data_loader):
-            if idx == num_warmup:
-                start_time = time.perf_counter()
-                total_compute_time = 0
 
-            start_compute_time = time.perf_counter()
-            outputs = model(inputs)
-            if torch.cuda.is_available():
-                torch.cuda.synchronize()
-            total_compute_time += time.perf_counter() - start_compute_time
-            
-            #Convert Masks to RLEs
-            for idx, x in enumerate(inputs):
-                # rles = [mask_util.encode(np.array(mask[:, :, None], order="F", dtype="uint8"))[0] for mask in outputs[idx]['instances'].pred_masks.data.cpu().numpy()]
-                # for rle in rles:
-                #     rle["counts"] = rle["counts"].decode("utf-8")
-                polygons = [Mask(np.array(mask)).polygons().segmentation for mask in outputs[idx]['instances'].pred_masks.data.cpu().numpy()]
-                image_masks[inputs[idx]['image_id']] = {'polygons': polygons, 'empty_index': inputs[idx]['empty_index']}
-            iters_after_start = idx + 1 - num_warmup * int(idx >= num_warmup)
-            seconds_per_img = total_compute_time / iters_after_start
-            if idx >= num_warmup * 2 or seconds_per_img > 5:
-                total_seconds_per_img = (time.perf_counter() - start_time) / iters_after_start
-                eta = datetime.timedelta(seconds=int(total_seconds_per_img * (total - idx - 1)))
-                log_every_n_seconds(
-                    logging.INFO,
-                    "Inference done {}/{}. {:.4f} s / img. ETA={}".format(
-                        idx + 1, total, seconds_per_img, str(eta)
-                    ),
-                    n=5,
-                )
+    shard_name = 'rank{:03d}'.format(comm.get_rank())
+    if mask_format == 'rle':
+        shard_dir = mask_h5_path
+        # The manifest is written once all the ranks are done
+        resume = resume and not os.path.isfile(os.path.join(mask_h5_path, mask_store.MANIFEST_FILE))
+    else:
+        # The shards are removed once merged
+        shard_dir = mask_h5_path + '.shards'
+    comm.synchronize()
+    if not resume and comm.is_main_process():
+        # Stale shards, e.g. of more ranks, would be read back with the new ones
+        if mask_format == 'rle':
+            mask_store.clear_mask_store(mask_h5_path)
+        else:
+            shutil.rmtree(shard_dir, ignore_errors=True)
+    comm.synchronize()
+    if mask_format == 'rle':
+        done_image_ids = mask_store.exported_image_ids(mask_h5_path) if resume else set()
+        mask_writer = mask_store.MaskStoreWriter(os.path.join(mask_h5_path, shard_name), resume=resume)
+    else:
+        done_image_ids = mask_store.polygon_shard_image_ids(shard_dir) if resume else set()
+        mask_writer = mask_store.PolygonShardWriter(os.path.join(shard_dir, shard_name + '.pkl'), resume=resume)
+    if len(done_image_ids):
+        logger.info("Resuming the mask export, {} images already exported".format(len(done_image_ids)))
+
+    # The masks are moved to the workers bit-packed, at most max_pending images are in flight
+    # so that the memory stays bounded when the encoding is slower than the inference
+    pool = mp.get_context('fork').Pool(num_workers) if num_workers > 0 else None
+    max_pending = 4 * num_workers
+    pending = collections.deque()
+
+    def write_ready(flush=False):
+        while pending and (flush or len(pending) > max_pending or pending[0][2].ready()):
+            image_id, empty_index, result = pending.popleft()
+            mask_writer.add(image_id, result.get(), empty_index)
+            if len(mask_writer.image_ids) % checkpoint_period == 0:
+                mask_writer.checkpoint()
+
+    try:
+        with inference_context(model), torch.no_grad():
+            for idx, inputs in enumerate(data_loader):
+                if idx == num_warmup:
+                    start_time = time.perf_counter()
+                    total_compute_time = 0
+                inputs = [x for x in inputs if x['image_id'] not in done_image_ids]
+                if len(inputs) == 0:
+                    continue
+
+                start_compute_time = time.perf_counter()
+                outputs = model(inputs)
+                if torch.cuda.is_available():
+                    torch.cuda.synchronize()
+                total_compute_time += time.perf_counter() - start_compute_time
+
+                for x, output in zip(inputs, outputs):
+                    pred_masks = output['instances'].pred_masks.data.cpu().numpy()
+                    job = (mask_format, np.packbits(pred_masks), pred_masks.shape)
+                    if pool is not None:
+                        result = pool.apply_async(_encode_mask_labels, (job,))
+                    else:
+                        result = _EncodedMasks(_encode_mask_labels(job))
+                    pending.append((x['image_id'], x['empty_index'], result))
+                write_ready()
+
+                iters_after_start = idx + 1 - num_warmup * int(idx >= num_warmup)
+                seconds_per_img = total_compute_time / iters_after_start
+                if idx >= num_warmup * 2 or seconds_per_img > 5:
+                    total_seconds_per_img = (time.perf_counter() - start_time) / iters_after_start
+                    eta = datetime.timedelta(seconds=int(total_seconds_per_img * (total - idx - 1)))
+                    log_every_n_seconds(
+                        logging.INFO,
+                        "Inference done {}/{}. {:.4f} s / img. ETA={}".format(
+                            idx + 1, total, seconds_per_img, str(eta)
+                        ),
+                        n=5,
+                    )
+        write_ready(flush=True)
+    finally:
+        if pool is not None:
+            pool.terminate()
+    mask_writer.close()
 
     # Measure the time only for this worker (before the synchronization barrier)
     total_time = time.perf_counter() - start_time
@@ -576,17 +668,15 @@ def inference_on_dataset_get_mask_labels(model, data_loader, evaluator, mask_h5_
             total_compute_time_str, total_compute_time / (total - num_warmup), num_devices
         )
     )
-    if comm.get_world_size() > 1:
-        comm.synchronize()
-        gathered_masks = comm.gather(image_masks, dst=0)
-        all_image_masks = {}
-        for gathered_mask in gathered_masks:
-            all_image_masks.update(gathered_mask)
-        if comm.is_main_process():
-            with open(mask_h5_path, 'wb') as outFile:
-                pickle.dump(all_image_masks, outFile)
-    else:
-        with open(mask_h5_path, 'wb') as outFile:
-            pickle.dump(image_masks, outFile)
+    # Every rank wrote its own shard, the main process merges them
+    comm.synchronize()
+    if comm.is_main_process():
+        if mask_format == 'rle':
+            mask_store.write_manifest(mask_h5_path, ['rank{:03d}'.format(rank) for rank in range(num_devices)])
+        else:
+            num_images = mask_store.merge_polygon_shards(shard_dir, mask_h5_path)
+            shutil.rmtree(shard_dir)
+            logger.info("Merged the mask labels of {} images into {}".format(num_images, mask_h5_path))
+    comm.synchronize()
 
     return {}
\ No newline at end of file
@@ -1,5 +1,6 @@
 from .coco_evaluation import *
 from .evaluator import scenegraph_inference_on_dataset
 from .sg_evaluation import SceneGraphEvaluator
+from .scenegraph_dump import SceneGraphDump, SceneGraphDumpWriter
 
 
@@ -0,0 +1,188 @@
+"""
+Columnar dump of scene graph predictions and ground truths.
+
+Each column is a flat binary file that is appended to while the evaluator processes images,
+and memory-mapped when read back. Columns of the same group share one (num_images + 1,)
+offsets array, so the rows of image i are column[offsets[i]:offsets[i + 1]].
+"""
+import os
+import glob
+import json
+import numpy as np
+
+from fvcore.common.file_io import PathManager
+
+# group -> {column: (dtype, trailing shape)}. A None trailing shape is taken from the first image.
+DUMP_COLUMNS = {
+    'objects': {
+        'pred_boxes': ('float32', (4,)),
+        'pred_classes': ('int64', ()),
+        'pred_scores': ('float32', ()),
+    },
+    'relations': {
+        'rel_pair_idxs': ('int64', (2,)),
+        'pred_rel_scores': ('float32', None),
+    },
+    'gt_objects': {
+        'gt_boxes': ('float32', (4,)),
+        'gt_classes': ('int64', ()),
+    },
+    'gt_relations': {
+        'gt_relations': ('int64', (3,)),
+    },
+}
+
+META_FILE = 'meta.json'
+MANIFEST_FILE = 'manifest.json'
+
+
+class SceneGraphDumpWriter(object):
+    """
+    Incrementally writes the (ground_truth, prediction) pairs built by SceneGraphEvaluator.process
+    """
+    def __init__(self, output_dir, topk=100):
+        """
+        Args:
+            output_dir (str): directory of the dump, one per rank
+            topk (int): number of relations kept per image. Relations are sorted by their
+                triplet score, so these are the top scoring ones. 0 keeps all of them.
+        """
+        self._output_dir = output_dir
+        self._topk = topk
+        PathManager.mkdirs(output_dir)
+        # The dump is incomplete until closed
+        if PathManager.exists(os.path.join(output_dir, META_FILE)):
+            PathManager.rm(os.path.join(output_dir, META_FILE))
+
+        self._files = {}
+        self._shapes = {}
+        self._counts = {group: [0] for group in DUMP_COLUMNS}
+        self._image_ids = []
+        for group, columns in DUMP_COLUMNS.items():
+            for name, (dtype, shape) in columns.items():
+                self._files[name] = PathManager.open(os.path.join(output_dir, name + '.bin'), 'wb')
+                self._shapes[name] = shape
+
+    def _write(self, group, columns):
+        num_rows = None
+        for name, value in columns.items():
+            dtype, _ = DUMP_COLUMNS[group][name]
+            value = np.ascontiguousarray(value, dtype=dtype)
+            if self._shapes[name] is None:
+                self._shapes[name] = value.shape[1:]
+            assert value.shape[1:] == tuple(self._shapes[name]), "Inconsistent shape {} for column {}".format(value.shape, name)
+            assert num_rows is None or value.shape[0] == num_rows, "Columns of group {} have different lengths".format(group)
+            num_rows = value.shape[0]
+            self._files[name].write(value.tobytes())
+        self._counts[group].append(self._counts[group][-1] + num_rows)
+
+    def add(self, ground_truth, prediction):
+        topk = self._topk if self._topk > 0 else None
+        instances = prediction['instances']
+        self._image_ids.append(prediction['image_id'])
+        self._write('objects', {
+            'pred_boxes': instances.pred_boxes.tensor.numpy(),
+            'pred_classes': instances.pred_classes.numpy(),
+            'pred_scores': instances.scores.numpy(),
+        })
+        self._write('relations', {
+            'rel_pair_idxs': prediction['rel_pair_idxs'][:topk].numpy(),
+            'pred_rel_scores': prediction['pred_rel_scores'][:topk].numpy(),
+        })
+        self._write('gt_objects', {
+            'gt_boxes': ground_truth['gt_boxes'].tensor.numpy(),
+            'gt_classes': ground_truth['labels'].numpy(),
+        })
+        self._write('gt_relations', {
+            'gt_relations': ground_truth['relation_tuple'].numpy(),
+        })
+
+    def close(self):
+        for f in self._files.values():
+            f.close()
+        meta = {'num_images': len(self._image_ids), 'topk': self._topk, 'columns': {}}
+        for group, columns in DUMP_COLUMNS.items():
+            np.save(os.path.join(self._output_dir, group + '_offsets.npy'), np.array(self._counts[group], dtype=np.int64))
+            for name, (dtype, _) in columns.items():
+                shape = self._shapes[name] if self._shapes[name] is not None else ()
+                meta['columns'][name] = {'group': group, 'dtype': dtype, 'shape': [self._counts[group][-1]] + list(shape)}
+        np.save(os.path.join(self._output_dir, 'image_ids.npy'), np.array(self._image_ids, dtype=np.int64))
+        # The meta file marks the dump as complete
+        with PathManager.open(os.path.join(self._output_dir, META_FILE), 'w') as f:
+            json.dump(meta, f)
+
+
+def write_manifest(path, shards):
+    """
+    List the per rank dumps of `path` written by the current run, so that SceneGraphDump
+    ignores the dumps left by earlier runs (e.g. with more ranks)
+    Args:
+        shards (list[str]): directory names of the per rank dumps
+    """
+    with PathManager.open(os.path.join(path, MANIFEST_FILE), 'w') as f:
+        json.dump({'shards': shards}, f)
+
+
+class SceneGraphDump(object):
+    """
+    Memory-mapped reader for the dumps of one or several ranks, indexed by image
+    """
+    def __init__(self, path):
+        """
+        Args:
+            path (str): a dump directory, or a directory containing one dump per rank, listed by
+                its manifest if any
+        """
+        if os.path.isfile(os.path.join(path, META_FILE)):
+            shard_dirs = [path]
+        elif os.path.isfile(os.path.join(path, MANIFEST_FILE)):
+            with PathManager.open(os.path.join(path, MANIFEST_FILE)) as f:
+                shard_dirs = [os.path.join(path, shard) for shard in json.load(f)['shards']]
+        else:
+            shard_dirs = sorted(os.path.dirname(p) for p in glob.glob(os.path.join(path, '*', META_FILE)))
+        assert len(shard_dirs) > 0, "No scene graph dump found in {}".format(path)
+
+        self._shards = [self._open_shard(shard_dir) for shard_dir in shard_dirs]
+        self._shard_starts = np.cumsum([0] + [len(shard['image_ids']) for shard in self._shards])
+        # Relations kept per image when the dumps were written, 0 if all of them were
+        topks = [shard['topk'] for shard in self._shards]
+        self.topk = 0 if 0 in topks else max(topks)
+
+    @staticmethod
+    def _open_shard(shard_dir):
+        with PathManager.open(os.path.join(shard_dir, META_FILE)) as f:
+            meta = json.load(f)
+        shard = {'image_ids': np.load(os.path.join(shard_dir, 'image_ids.npy')), 'topk': meta.get('topk', 0)}
+        for group in DUMP_COLUMNS:
+            shard[group + '_offsets'] = np.load(os.path.join(shard_dir, group + '_offsets.npy'))
+        for name, column in meta['columns'].items():
+            shape = tuple(column['shape'])
+            if shape[0] == 0:
+                # Empty files can not be memory-mapped
+                shard[name] = np.zeros(shape, dtype=column['dtype'])
+            else:
+                shard[name] = np.memmap(os.path.join(shard_dir, name + '.bin'), dtype=column['dtype'], mode='r', shape=shape)
+        return shard
+
+    def __len__(self):
+        return int(self._shard_starts[-1])
+
+    def __getitem__(self, idx):
+        if idx < 0:
+            idx += len(self)
+        if not 0 <= idx < len(self):
+            raise IndexError("Image index {} out of range".format(idx))
+        shard_idx = int(np.searchsorted(self._shard_starts, idx, side='right')) - 1
+        shard = self._shards[shard_idx]
+        local_idx = idx - self._shard_starts[shard_idx]
+
+        record = {'image_id': int(shard['image_ids'][local_idx])}
+        for group, columns in DUMP_COLUMNS.items():
+            start, end = shard[group + '_offsets'][local_idx:local_idx + 2]
+            for name in columns:
+                record[name] = shard[name][start:end]
+        return record
+
+    def __iter__(self):
+        for idx in range(len(self)):
+            yield self[idx]
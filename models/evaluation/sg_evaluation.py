@@ -6,8 +6,9 @@ import torch
 import numpy as np
 import json
 from tqdm import tqdm
-from functools import reduce
 import itertools
+import glob
+import multiprocessing as mp
 
 from abc import ABC, abstractmethod
 
@@ -21,14 +22,30 @@ from detectron2.evaluation import COCOEvaluator
 from detectron2.structures.boxes import pairwise_iou, Boxes
 from detectron2.utils.registry import Registry
 
-from .utils import intersect_2d, argsort_desc
+from .utils import intersect_2d, argsort_desc, pairwise_box_iou, TripletIndex
+from .scenegraph_dump import SceneGraphDumpWriter, SceneGraphDump, write_manifest
 
 
 SCENEGRAPH_METRIC_REGISTRY = Registry("SCENEGRAPH_METRIC_REGISTRY")
 
+# (evaluator, evaluate_image) shared with forked evaluation workers
+_SHARD_STATE = None
+
+def _evaluate_scenegraph_shard(bounds):
+    """
+    Compute the metric containers of images [start, end) in a forked worker
+    """
+    evaluator, evaluate_image = _SHARD_STATE
+    start, end = bounds
+    torch.set_num_threads(1)
+    evaluator._register_evaluator_containers()
+    for i in range(start, end):
+        evaluate_image(i)
+    return evaluator._evaluators['SGRecall'].result_dict
+
 class SceneGraphEvaluator(DatasetEvaluator):
 
-    def __init__(self, dataset_name, cfg, distributed, output_dir=None, metrics=None):
+    def __init__(self, dataset_name, cfg, distributed, output_dir=None, metrics=None, evaluate_detections=True):
         """
         Args:
             dataset_name (str): name of the dataset to be evaluated.
@@ -51,6 +68,8 @@ class SceneGraphEvaluator(DatasetEvaluator):
                    format. #TODO: fix the commnent after implementation
             metrics (tuple): The metrics using which the scene graphs performance should be evaluated
                 Options: ('SGRecall', 'SGNoGraphConstraintRecall', 'SGZeroShotRecall', 'SGPairAccuracy', 'SGMeanRecall')
+            evaluate_detections (bool): if False, skip the COCO box evaluation (e.g. when only
+                recomputing scene graph metrics with evaluate_dump)
         """
 
         SGMETRICS = ('SGRecall', 'SGNoGraphConstraintRecall', 'SGZeroShotRecall', 'SGPairAccuracy', 'SGMeanRecall')
@@ -58,7 +77,21 @@ class SceneGraphEvaluator(DatasetEvaluator):
         self._mode = self._mode_from_config(cfg)
         self._distributed = distributed
         self._output_dir = output_dir
+        self._dataset_name = dataset_name
         self.cfg = cfg
+        # Compute the per image statistics on every rank (and optionally a local process pool)
+        # and only reduce the metric containers, instead of gathering all predictions on rank 0
+        self._sharded = cfg.TEST.RELATION.SHARDED_EVALUATION
+        self._num_workers = cfg.TEST.RELATION.NUM_EVAL_WORKERS
+        # Update the metric containers in process() and only keep the top scoring relations for the dump
+        self._streaming = cfg.TEST.RELATION.STREAMING_EVALUATION
+        self._dump_topk = cfg.TEST.RELATION.DUMP_TOPK
+        # 'pth' pickles all predictions at the end of evaluation, 'columnar' writes them to
+        # memory-mappable flat arrays while processing (see scenegraph_dump.py)
+        assert cfg.TEST.RELATION.DUMP_FORMAT in ('pth', 'columnar'), "Unknown dump format {}".format(cfg.TEST.RELATION.DUMP_FORMAT)
+        # Streaming evaluation keeps no per image record in memory, its dumps are always columnar
+        self._dump_columnar = cfg.TEST.RELATION.DUMP_FORMAT == 'columnar' or self._streaming
+        self._dump_writer = None
 
         self._cpu_device = torch.device("cpu")
         self._logger = logging.getLogger('detectron2')
@@ -73,8 +106,10 @@ class SceneGraphEvaluator(DatasetEvaluator):
         self._logger.info("Following metrics will be use for evaluation")
         self._logger.info("{}".format(self._metrics))
 
-        self.detection_evaluator = COCOEvaluator(dataset_name, cfg, distributed, output_dir)
-        self.detection_evaluator._tasks =  ("bbox",)
+        self.detection_evaluator = None
+        if evaluate_detections:
+            self.detection_evaluator = COCOEvaluator(dataset_name, cfg, distributed, output_dir)
+            self.detection_evaluator._tasks =  ("bbox",)
         #Register a filed for each of the metric
         self._evaluators = build_scenegraph_evaluators(self._metrics, cfg, {}, dataset_name)
         # self._register_evaluator_containers()
@@ -83,11 +118,26 @@ class SceneGraphEvaluator(DatasetEvaluator):
 
         self._ground_truths = []
         self._predictions = []
-        self._zero_shot_triplets = self._get_zero_shot_triplets() - 1
+        self._num_images = 0
+        # (sub, obj, pred) triplets, indexed once instead of compared against every GT triplet
+        self._zero_shot_triplets = TripletIndex(self._get_zero_shot_triplets() - 1)
+        self._global_container = None
 
     def reset(self):
-        self.detection_evaluator.reset()
+        if self.detection_evaluator is not None:
+            self.detection_evaluator.reset()
         self._register_evaluator_containers()
+        self._ground_truths = []
+        self._predictions = []
+        self._num_images = 0
+        if self._streaming:
+            self._global_container = self._prepare_global_container()
+        if self._dump_writer is not None:
+            self._dump_writer.close()
+            self._dump_writer = None
+        if self._output_dir and self._dump_columnar:
+            dump_dir = os.path.join(self._output_dir, "scenegraph_predictions", "rank{:03d}".format(comm.get_rank()))
+            self._dump_writer = SceneGraphDumpWriter(dump_dir, topk=self._dump_topk)
 
     def _get_zero_shot_triplets(self):
         self._logger.info('Loading zero shot triplets')
@@ -113,13 +163,18 @@ class SceneGraphEvaluator(DatasetEvaluator):
 
     def process(self, inputs, outputs):
         # import pdb; pdb.set_trace()
-        for idx, input in enumerate(inputs):
-            height, width = outputs[idx]['instances'].image_size
-            input['instances'] = resize_instance(input['instances'], height, width)
+        for input, output in zip(inputs, outputs):
+            if "instances" in output:
+                height, width = output['instances'].image_size
+                input['instances'] = resize_instance(input['instances'], height, width)
         
-        self.detection_evaluator.process(inputs, outputs)
+        if self.detection_evaluator is not None:
+            self.detection_evaluator.process(inputs, outputs)
 
         for input, output in zip(inputs, outputs):
+            # Images without predicted instances have no scene graph to evaluate
+            if "instances" not in output:
+                continue
             ground_truth = {}
             prediction = {}
 
@@ -128,12 +183,20 @@ class SceneGraphEvaluator(DatasetEvaluator):
             ground_truth['labels'] = input['instances'].gt_classes.to(self._cpu_device) #Ground truth object classes
             ground_truth['rel_pair_idxs'] = input['relations'][:,:2].to(self._cpu_device) #Realtion pair index (shape: (num of relations, 2))
 
-            if "instances" in output:
-                instances = output["instances"].to(self._cpu_device)
-                prediction["image_id"] = input["image_id"]
-                prediction["instances"] = instances
-                prediction['rel_pair_idxs'] = output["rel_pair_idxs"].to(self._cpu_device)
-                prediction['pred_rel_scores'] = output["pred_rel_scores"].to(self._cpu_device)
+            instances = output["instances"].to(self._cpu_device)
+            prediction["image_id"] = input["image_id"]
+            prediction["instances"] = instances
+            prediction['rel_pair_idxs'] = output["rel_pair_idxs"].to(self._cpu_device)
+            prediction['pred_rel_scores'] = output["pred_rel_scores"].to(self._cpu_device)
+
+            if self._dump_writer is not None:
+                self._dump_writer.add(ground_truth, prediction)
+
+            if self._streaming:
+                self.evaluate_relation_of_one_image(ground_truth, prediction, self._global_container, self._num_images)
+                self._num_images += 1
+                # The dump, if any, was written by the columnar writer
+                continue
             
             ground_truth_cp = copy.deepcopy(ground_truth)
             prediction_cp = copy.deepcopy(prediction)
@@ -146,7 +209,18 @@ class SceneGraphEvaluator(DatasetEvaluator):
 
     def evaluate(self):
         #First evaluate the detection precisions
-        result_detector = self.detection_evaluator.evaluate()
+        result_detector = self.detection_evaluator.evaluate() if self.detection_evaluator is not None else OrderedDict()
+
+        if self._dump_writer is not None:
+            self._dump_writer.close()
+            self._dump_writer = None
+            comm.synchronize()
+            if comm.is_main_process():
+                write_manifest(os.path.join(self._output_dir, "scenegraph_predictions"),
+                               ["rank{:03d}".format(rank) for rank in range(comm.get_world_size())])
+
+        if self._sharded or self._streaming:
+            return self._evaluate_sharded(result_detector)
 
         if self._distributed:
             comm.synchronize()
@@ -161,7 +235,7 @@ class SceneGraphEvaluator(DatasetEvaluator):
                 return {}
         else:
             predictions = self._predictions
-            groundtruths = self._ground_truths
+            ground_truths = self._ground_truths
 
         self._logger.info("Predictions Gathered")
 
@@ -169,7 +243,7 @@ class SceneGraphEvaluator(DatasetEvaluator):
             self._logger.warning("[SceneGraphEvaluator] Did not receive valid predictions.")
             return {}
 
-        if self._output_dir:
+        if self._output_dir and not self._dump_columnar:
             PathManager.mkdirs(self._output_dir)
             file_path = os.path.join(self._output_dir, "scenegraph_predictions.pth")
             with PathManager.open(file_path, "wb") as f:
@@ -186,17 +260,55 @@ class SceneGraphEvaluator(DatasetEvaluator):
         
         return result_detector 
 
-    def _evaluate_scenegraphs(self, ground_truths, predictions):
-        
-        # result_detector = None
-        
-        self._logger.info("Computing Scene Graph Metrics")
+    def _evaluate_sharded(self, result_detector):
+        """
+        Every rank computes the scene graph statistics of its own images (or already did so
+        in process() when streaming). Only the metric containers are gathered and merged on
+        the main process.
+        """
+        predictions = self._predictions
+        ground_truths = self._ground_truths
+
+        if self._output_dir and not self._dump_columnar and len(predictions) > 0:
+            PathManager.mkdirs(self._output_dir)
+            file_path = os.path.join(self._output_dir, "scenegraph_predictions_rank{:03d}.pth".format(comm.get_rank()))
+            with PathManager.open(file_path, "wb") as f:
+                torch.save({'groundtruths':ground_truths, 'predictions':predictions}, f)
+
+        if not self._streaming:
+            self._compute_scenegraph_statistics(ground_truths, predictions)
+            self._num_images = len(predictions)
+        num_images = self._num_images
+
+        if self._distributed:
+            comm.synchronize()
+            self._logger.info("Gathering scene graph statistics")
+            shards = comm.gather((self._num_images, self._evaluators['SGRecall'].result_dict), dst=0)
+            if not comm.is_main_process():
+                return {}
+            self._merge_result_dicts([result_dict for _, result_dict in shards])
+            num_images = sum(num_shard_images for num_shard_images, _ in shards)
+
+        if num_images == 0:
+            self._logger.warning("[SceneGraphEvaluator] Did not receive valid predictions.")
+            return {}
+
+        result_detector['SG'] = self._summarize_scenegraphs()
+
+        if self._output_dir:
+            PathManager.mkdirs(self._output_dir)
+            file_path = os.path.join(self._output_dir, "result_dict.pth")
+            with PathManager.open(file_path, "wb") as f:
+                torch.save(self._evaluators['SGRecall'].result_dict, f)
+
+        return result_detector
+
+    def _prepare_global_container(self):
         num_rel_category = self.cfg.MODEL.ROI_SCENEGRAPH_HEAD.NUM_CLASSES
         multiple_preds = self.cfg.TEST.RELATION.MULTIPLE_PREDS
         iou_thres = self.cfg.TEST.RELATION.IOU_THRESHOLD
+        match_chunk_size = self.cfg.TEST.RELATION.MATCH_CHUNK_SIZE
 
-        self._logger.info("Preparing Global Container")
-        #Prepare Global container
         global_container = {}
         global_container['zeroshot_triplet'] = self._zero_shot_triplets
         global_container['result_dict'] = {}
@@ -204,11 +316,104 @@ class SceneGraphEvaluator(DatasetEvaluator):
         global_container['multiple_preds'] = multiple_preds
         global_container['num_rel_category'] = num_rel_category
         global_container['iou_thres'] = iou_thres
+        global_container['match_chunk_size'] = match_chunk_size
+        return global_container
 
-        
-        for i , (groundtruth, prediction) in tqdm(enumerate(zip(ground_truths, predictions)),desc='Computing recalls'):
-            self.evaluate_relation_of_one_image(groundtruth, prediction, global_container,i)
+    def _merge_result_dicts(self, result_dicts):
+        """
+        Reset the metric containers and fill them with the (ordered) containers computed on each shard
+        """
+        # Shallow copies, the local result_dict may be one of the shards and its containers are replaced below
+        result_dicts = [copy.copy(result_dict) for result_dict in result_dicts]
+        self._register_evaluator_containers()
+        for result_dict in result_dicts:
+            for evaluator in self._evaluators.values():
+                evaluator.merge_result_dict(self._mode, result_dict)
+
+    def _compute_scenegraph_statistics(self, ground_truths, predictions):
+        global_container = self._prepare_global_container()
+        def evaluate_image(i):
+            self.evaluate_relation_of_one_image(ground_truths[i], predictions[i], global_container, i)
+        self._run_scenegraph_statistics(len(predictions), evaluate_image)
+
+    def _compute_dump_statistics(self, dump):
+        global_container = self._prepare_global_container()
+        def evaluate_image(i):
+            self.evaluate_relation_of_dump_record(dump[i], global_container, i)
+        self._run_scenegraph_statistics(len(dump), evaluate_image)
+
+    def _run_scenegraph_statistics(self, num_images, evaluate_image):
+        """
+        Call evaluate_image on every image index, in a local process pool if
+        TEST.RELATION.NUM_EVAL_WORKERS > 0.
+        """
+        self._logger.info("Computing Scene Graph Metrics")
+
+        num_workers = min(self._num_workers, num_images)
+        if num_workers <= 1:
+            for i in tqdm(range(num_images), desc='Computing recalls'):
+                evaluate_image(i)
+            return
+
+        # Workers are forked, so they inherit the predictions instead of receiving pickled copies
+        global _SHARD_STATE
+        _SHARD_STATE = (self, evaluate_image)
+        bounds = np.linspace(0, num_images, num_workers + 1).astype(int)
+        try:
+            with mp.get_context("fork").Pool(num_workers) as pool:
+                result_dicts = pool.map(_evaluate_scenegraph_shard, list(zip(bounds[:-1], bounds[1:])))
+        finally:
+            _SHARD_STATE = None
+        self._merge_result_dicts(result_dicts)
+
+    def evaluate_dump(self, path):
+        """
+        Recompute the scene graph metrics from the predictions dumped by an earlier evaluation,
+        without running the model.
+
+        Args:
+            path (str): the output directory of the evaluation, a columnar dump directory or a
+                "scenegraph_predictions*.pth" file
+                Dumps written with TEST.RELATION.DUMP_TOPK > 0 give the same graph constrained
+                recalls for K <= DUMP_TOPK, but not the same no graph constraint recalls.
+        Returns:
+            dict: the scene graph results, as in evaluate()
+        """
+        self._register_evaluator_containers()
+        if os.path.isdir(os.path.join(path, "scenegraph_predictions")):
+            path = os.path.join(path, "scenegraph_predictions")
+        if os.path.isfile(path):
+            pth_files = [path]
+        elif os.path.isfile(os.path.join(path, "scenegraph_predictions.pth")):
+            pth_files = [os.path.join(path, "scenegraph_predictions.pth")]
+        else:
+            # Sharded evaluations write one file per rank
+            pth_files = sorted(glob.glob(os.path.join(path, "scenegraph_predictions_rank*.pth")))
+
+        if len(pth_files) == 0:
+            dump = SceneGraphDump(path)
+            self._logger.info("Loaded columnar dump of {} images from {}".format(len(dump), path))
+            if dump.topk > 0 and 'SGNoGraphConstraintRecall' in self._metrics:
+                self._logger.warning("The dump only has the top {} relations of each image. The no graph constraint recall "
+                                     "ranks every (pair, predicate) score and can differ from the evaluation that wrote it".format(dump.topk))
+            self._compute_dump_statistics(dump)
+        else:
+            ground_truths, predictions = [], []
+            for file_path in pth_files:
+                with PathManager.open(file_path, "rb") as f:
+                    data = torch.load(f, map_location=self._cpu_device)
+                ground_truths.extend(data['groundtruths'])
+                predictions.extend(data['predictions'])
+            self._logger.info("Loaded predictions of {} images from {}".format(len(predictions), path))
+            self._compute_scenegraph_statistics(ground_truths, predictions)
+
+        return {'SG': self._summarize_scenegraphs()}
+
+    def _evaluate_scenegraphs(self, ground_truths, predictions):
+        self._compute_scenegraph_statistics(ground_truths, predictions)
+        return self._summarize_scenegraphs()
 
+    def _summarize_scenegraphs(self):
         self._logger.info("Scene Graph Metric Evaluation Complete. Computing recall statistics...")
         # ('SGRecall', 'SGNoGraphConstraintRecall', 'SGZeroShotRecall', 'SGPairAccuracy', 'SGMeanRecall')
         if 'SGMeanRecall' in self._evaluators:
@@ -246,9 +451,6 @@ class SceneGraphEvaluator(DatasetEvaluator):
             pred_5ples: the predicted (id0, id1, cls0, cls1, rel)
             pred_triplet_scores: [cls_0score, relscore, cls1_score]
         """
-        #unpack all inputs
-        mode = global_container['mode']
-
         local_container = {}
         local_container['gt_rels'] = groundtruth['relation_tuple'].long().detach().cpu().numpy()
 
@@ -267,6 +469,35 @@ class SceneGraphEvaluator(DatasetEvaluator):
         local_container['pred_boxes'] = prediction['instances'].pred_boxes.tensor.detach().cpu().numpy()                  # (#pred_objs, 4)
         local_container['pred_classes'] = prediction['instances'].pred_classes.long().detach().cpu().numpy()     # (#pred_objs, )
         local_container['obj_scores'] = prediction['instances'].scores.detach().cpu().numpy()              # (#pred_objs, )
+        return self.evaluate_relation_of_local_container(local_container, global_container, i)
+
+    def evaluate_relation_of_dump_record(self, record, global_container, i):
+        """
+        Same as evaluate_relation_of_one_image, for an image record of a SceneGraphDump
+        """
+        local_container = {}
+        local_container['gt_rels'] = np.array(record['gt_relations'], dtype=np.int64)
+
+        # if there is no gt relations for current image, then skip it
+        if len(local_container['gt_rels']) == 0:
+            return
+
+        local_container['gt_boxes'] = np.array(record['gt_boxes'])
+        local_container['gt_classes'] = np.array(record['gt_classes'], dtype=np.int64)
+        local_container['pred_rel_inds'] = np.array(record['rel_pair_idxs'], dtype=np.int64)
+        local_container['rel_scores'] = np.array(record['pred_rel_scores'])
+        local_container['pred_boxes'] = np.array(record['pred_boxes'])
+        local_container['pred_classes'] = np.array(record['pred_classes'], dtype=np.int64)
+        local_container['obj_scores'] = np.array(record['pred_scores'])
+        return self.evaluate_relation_of_local_container(local_container, global_container, i)
+
+    def evaluate_relation_of_local_container(self, local_container, global_container, i):
+        """
+        Update the metric containers with the numpy ground truths and predictions of one image
+        """
+        #unpack all inputs
+        mode = global_container['mode']
+
         # import pdb; pdb.set_trace()
         # to calculate accuracy, only consider those gt pairs
         # This metric is used by "Graphical Contrastive Losses for Scene Graph Parsing" 
@@ -330,6 +561,12 @@ class SceneGraphEvaluation(ABC):
         print("Generate Print String")
         pass
 
+    def merge_result_dict(self, mode, result_dict):
+        """
+        Accumulate the containers of another result_dict (e.g. computed on another shard) into this one
+        """
+        raise NotImplementedError
+
 
 """
 Traditional Recall, implement based on:
@@ -339,15 +576,21 @@ https://github.com/rowanz/neural-motifs
 class SGRecall(SceneGraphEvaluation):
     def __init__(self, cfg, result_dict, dataset_name):
         super(SGRecall, self).__init__(result_dict)
-        
+        self.recall_ks = _recall_ks(cfg)
 
     def register_container(self, mode):
-        self.result_dict[mode + '_recall'] = {20: [], 50: [], 100: []}
+        # Sum of the per image recalls at each K and number of images, the recall is their ratio
+        self.result_dict[mode + '_recall'] = np.zeros(len(self.recall_ks))
+        self.result_dict[mode + '_recall_count'] = 0
+
+    def merge_result_dict(self, mode, result_dict):
+        self.result_dict[mode + '_recall'] += result_dict[mode + '_recall']
+        self.result_dict[mode + '_recall_count'] += result_dict[mode + '_recall_count']
 
     def generate_print_string(self, mode):
         result_str = 'SGG eval: '
-        for k, v in self.result_dict[mode + '_recall'].items():
-            result_str += '    R @ %d: %.4f; ' % (k, np.mean(v))
+        for k, v in zip(self.recall_ks, self.result_dict[mode + '_recall']):
+            result_str += '    R @ %d: %.4f; ' % (k, _mean(v, self.result_dict[mode + '_recall_count']))
         result_str += ' for mode=%s, type=Recall(Main).' % mode
         result_str += '\n'
         return result_str
@@ -382,14 +625,15 @@ class SGRecall(SceneGraphEvaluation):
             pred_triplet_boxes,
             iou_thres,
             phrdet=mode=='phrdet',
+            chunk_size=global_container.get('match_chunk_size'),
         )
         local_container['pred_to_gt'] = pred_to_gt
+        # Shared with the other metrics, a GT triplet is recalled at K iff its rank is < K
+        local_container['gt_hit_ranks'] = _gt_hit_ranks(pred_to_gt, gt_rels.shape[0])
 
-        for k in self.result_dict[mode + '_recall']:
-            # the following code are copied from Neural-MOTIFS
-            match = reduce(np.union1d, pred_to_gt[:k])
-            rec_i = float(len(match)) / float(gt_rels.shape[0])
-            self.result_dict[mode + '_recall'][k].append(rec_i)
+        rec_i = _num_hits_at(local_container['gt_hit_ranks'], self.recall_ks) / float(gt_rels.shape[0])
+        self.result_dict[mode + '_recall'] += rec_i
+        self.result_dict[mode + '_recall_count'] += 1
 
         return local_container
 
@@ -401,14 +645,20 @@ https://github.com/rowanz/neural-motifs
 class SGNoGraphConstraintRecall(SceneGraphEvaluation):
     def __init__(self, cfg, result_dict, dataset_name):
         super(SGNoGraphConstraintRecall, self).__init__(result_dict)
+        self.recall_ks = _recall_ks(cfg)
 
     def register_container(self, mode):
-        self.result_dict[mode + '_recall_nogc'] = {20: [], 50: [], 100: []}
+        self.result_dict[mode + '_recall_nogc'] = np.zeros(len(self.recall_ks))
+        self.result_dict[mode + '_recall_nogc_count'] = 0
+
+    def merge_result_dict(self, mode, result_dict):
+        self.result_dict[mode + '_recall_nogc'] += result_dict[mode + '_recall_nogc']
+        self.result_dict[mode + '_recall_nogc_count'] += result_dict[mode + '_recall_nogc_count']
 
     def generate_print_string(self, mode):
         result_str = 'SGG eval: '
-        for k, v in self.result_dict[mode + '_recall_nogc'].items():
-            result_str += ' ng-R @ %d: %.4f; ' % (k, np.mean(v))
+        for k, v in zip(self.recall_ks, self.result_dict[mode + '_recall_nogc']):
+            result_str += ' ng-R @ %d: %.4f; ' % (k, _mean(v, self.result_dict[mode + '_recall_nogc_count']))
         result_str += ' for mode=%s, type=No Graph Constraint Recall(Main).' % mode
         result_str += '\n'
         return result_str
@@ -423,7 +673,7 @@ class SGNoGraphConstraintRecall(SceneGraphEvaluation):
 
         obj_scores_per_rel = obj_scores[pred_rel_inds].prod(1)
         nogc_overall_scores = obj_scores_per_rel[:,None] * rel_scores[:,:-1] #Backround index at the end
-        nogc_score_inds = argsort_desc(nogc_overall_scores)[:100]
+        nogc_score_inds = argsort_desc(nogc_overall_scores)[:self.recall_ks[-1]]
         nogc_pred_rels = np.column_stack((pred_rel_inds[nogc_score_inds[:,0]], nogc_score_inds[:,1]))#Backround index at the end(removed +1)
         nogc_pred_scores = rel_scores[nogc_score_inds[:,0], nogc_score_inds[:,1]]#Backround index at the end(removed +1)
 
@@ -443,14 +693,15 @@ class SGNoGraphConstraintRecall(SceneGraphEvaluation):
             nogc_pred_triplet_boxes,
             iou_thres,
             phrdet=mode=='phrdet',
+            chunk_size=global_container.get('match_chunk_size'),
         )
 
         local_container['nogc_pred_to_gt'] = nogc_pred_to_gt
+        local_container['nogc_gt_hit_ranks'] = _gt_hit_ranks(nogc_pred_to_gt, gt_rels.shape[0])
 
-        for k in self.result_dict[mode + '_recall_nogc']:
-            match = reduce(np.union1d, nogc_pred_to_gt[:k])
-            rec_i = float(len(match)) / float(gt_rels.shape[0])
-            self.result_dict[mode + '_recall_nogc'][k].append(rec_i)
+        rec_i = _num_hits_at(local_container['nogc_gt_hit_ranks'], self.recall_ks) / float(gt_rels.shape[0])
+        self.result_dict[mode + '_recall_nogc'] += rec_i
+        self.result_dict[mode + '_recall_nogc_count'] += 1
 
         return local_container
 
@@ -462,15 +713,21 @@ Only calculate the triplet that not occurred in the training set
 class SGZeroShotRecall(SceneGraphEvaluation):
     def __init__(self, cfg,  result_dict, dataset_name):
         super(SGZeroShotRecall, self).__init__(result_dict)
+        self.recall_ks = _recall_ks(cfg)
 
     def register_container(self, mode):
-        self.result_dict[mode + '_zeroshot_recall'] = {20: [], 50: [], 100: []} 
-        self.result_dict[mode + '_zs_id'] = {20: [], 50: [], 100: []} 
+        # Only images with zero shot ground truth relations are counted
+        self.result_dict[mode + '_zeroshot_recall'] = np.zeros(len(self.recall_ks))
+        self.result_dict[mode + '_zeroshot_recall_count'] = 0
+
+    def merge_result_dict(self, mode, result_dict):
+        self.result_dict[mode + '_zeroshot_recall'] += result_dict[mode + '_zeroshot_recall']
+        self.result_dict[mode + '_zeroshot_recall_count'] += result_dict[mode + '_zeroshot_recall_count']
 
     def generate_print_string(self, mode):
         result_str = 'SGG eval: '
-        for k, v in self.result_dict[mode + '_zeroshot_recall'].items():
-            result_str += '   zR @ %d: %.4f; ' % (k, np.mean(v))
+        for k, v in zip(self.recall_ks, self.result_dict[mode + '_zeroshot_recall']):
+            result_str += '   zR @ %d: %.4f; ' % (k, _mean(v, self.result_dict[mode + '_zeroshot_recall_count']))
         result_str += ' for mode=%s, type=Zero Shot Recall.' % mode
         result_str += '\n'
         return result_str
@@ -483,23 +740,16 @@ class SGZeroShotRecall(SceneGraphEvaluation):
         sub_id, ob_id, pred_label = gt_rels[:, 0], gt_rels[:, 1], gt_rels[:, 2]
         gt_triplets = np.column_stack((gt_classes[sub_id], gt_classes[ob_id], pred_label))  # num_rel, 3
 
-        self.zeroshot_idx = np.where( intersect_2d(gt_triplets, zeroshot_triplets).sum(-1) > 0 )[0].tolist()
+        self.zeroshot_idx = np.where(zeroshot_triplets.contains(gt_triplets))[0]
 
     def calculate_recall(self, global_container, local_container, mode, i):
-        pred_to_gt = local_container['pred_to_gt']
-
-        for k in self.result_dict[mode + '_zeroshot_recall']:
-            # Zero Shot Recall
-            match = reduce(np.union1d, pred_to_gt[:k])
-            if len(self.zeroshot_idx) > 0:
-                if not isinstance(match, (list, tuple)):
-                    match_list = match.tolist()
-                else:
-                    match_list = match
-                zeroshot_match = len(self.zeroshot_idx) + len(match_list) - len(set(self.zeroshot_idx + match_list))
-                zero_rec_i = float(zeroshot_match) / float(len(self.zeroshot_idx))
-                self.result_dict[mode + '_zeroshot_recall'][k].append(zero_rec_i)
-                self.result_dict[mode + '_zs_id'][k].append(i)
+        if len(self.zeroshot_idx) == 0:
+            return
+        # Zero Shot Recall
+        zeroshot_ranks = local_container['gt_hit_ranks'][self.zeroshot_idx]
+        zero_rec_i = _num_hits_at(zeroshot_ranks, self.recall_ks) / float(len(self.zeroshot_idx))
+        self.result_dict[mode + '_zeroshot_recall'] += zero_rec_i
+        self.result_dict[mode + '_zeroshot_recall_count'] += 1
 
 
 """
@@ -511,17 +761,22 @@ Only used in https://github.com/NVIDIA/ContrastiveLosses4VRD for sgcls and predc
 class SGPairAccuracy(SceneGraphEvaluation):
     def __init__(self, cfg, result_dict, dataset_name):
         super(SGPairAccuracy, self).__init__(result_dict)
+        self.recall_ks = _recall_ks(cfg)
 
     def register_container(self, mode):
-        self.result_dict[mode + '_accuracy_hit'] = {20: [], 50: [], 100: []}
-        self.result_dict[mode + '_accuracy_count'] = {20: [], 50: [], 100: []}
+        # Total number of matched (at each K) and ground truth relations
+        self.result_dict[mode + '_accuracy_hit'] = np.zeros(len(self.recall_ks))
+        self.result_dict[mode + '_accuracy_count'] = 0.0
+
+    def merge_result_dict(self, mode, result_dict):
+        self.result_dict[mode + '_accuracy_hit'] += result_dict[mode + '_accuracy_hit']
+        self.result_dict[mode + '_accuracy_count'] += result_dict[mode + '_accuracy_count']
 
     def generate_print_string(self, mode):
         result_str = 'SGG eval: '
-        for k, v in self.result_dict[mode + '_accuracy_hit'].items():
-            a_hit = np.mean(v)
-            a_count = np.mean(self.result_dict[mode + '_accuracy_count'][k])
-            result_str += '    A @ %d: %.4f; ' % (k, a_hit/a_count)
+        for k, v in zip(self.recall_ks, self.result_dict[mode + '_accuracy_hit']):
+            a_count = self.result_dict[mode + '_accuracy_count']
+            result_str += '    A @ %d: %.4f; ' % (k, _mean(v, a_count))
         result_str += ' for mode=%s, type=TopK Accuracy.' % mode
         result_str += '\n'
         return result_str
@@ -535,21 +790,13 @@ class SGPairAccuracy(SceneGraphEvaluation):
         pred_to_gt = local_container['pred_to_gt']
         gt_rels = local_container['gt_rels']
 
-        for k in self.result_dict[mode + '_accuracy_hit']:
-            # to calculate accuracy, only consider those gt pairs
-            # This metric is used by "Graphical Contrastive Losses for Scene Graph Parsing" 
-            # for sgcls and predcls
-            if mode != 'sgdet':
-                gt_pair_pred_to_gt = []
-                for p, flag in zip(pred_to_gt, self.pred_pair_in_gt):
-                    if flag:
-                        gt_pair_pred_to_gt.append(p)
-                if len(gt_pair_pred_to_gt) > 0:
-                    gt_pair_match = reduce(np.union1d, gt_pair_pred_to_gt[:k])
-                else:
-                    gt_pair_match = []
-                self.result_dict[mode + '_accuracy_hit'][k].append(float(len(gt_pair_match)))
-                self.result_dict[mode + '_accuracy_count'][k].append(float(gt_rels.shape[0]))
+        # to calculate accuracy, only consider those gt pairs
+        # This metric is used by "Graphical Contrastive Losses for Scene Graph Parsing" 
+        # for sgcls and predcls
+        if mode != 'sgdet':
+            gt_pair_ranks = _gt_hit_ranks(pred_to_gt, gt_rels.shape[0], keep=self.pred_pair_in_gt)
+            self.result_dict[mode + '_accuracy_hit'] += _num_hits_at(gt_pair_ranks, self.recall_ks)
+            self.result_dict[mode + '_accuracy_count'] += float(gt_rels.shape[0])
 
 
 """
@@ -563,13 +810,18 @@ class SGMeanRecall(SceneGraphEvaluation):
         self.num_rel = cfg.MODEL.ROI_SCENEGRAPH_HEAD.NUM_CLASSES
         self.print_detail = print_detail
         self.rel_name_list = MetadataCatalog.get(dataset_name).predicate_classes # remove __background__
+        self.recall_ks = _recall_ks(cfg)
 
     def register_container(self, mode):
-        #self.result_dict[mode + '_recall_hit'] = {20: [0]*self.num_rel, 50: [0]*self.num_rel, 100: [0]*self.num_rel}
-        #self.result_dict[mode + '_recall_count'] = {20: [0]*self.num_rel, 50: [0]*self.num_rel, 100: [0]*self.num_rel}
-        self.result_dict[mode + '_mean_recall'] = {20: 0.0, 50: 0.0, 100: 0.0}
-        self.result_dict[mode + '_mean_recall_collect'] = {20: [[] for i in range(self.num_rel)], 50: [[] for i in range(self.num_rel)], 100: [[] for i in range(self.num_rel)]}
-        self.result_dict[mode + '_mean_recall_list'] = {20: [], 50: [], 100: []}
+        self.result_dict[mode + '_mean_recall'] = {k: 0.0 for k in self.recall_ks.tolist()}
+        # (#K, num_rel) sum of the per image recalls of each predicate, and number of images containing each predicate
+        self.result_dict[mode + '_mean_recall_collect'] = np.zeros((len(self.recall_ks), self.num_rel))
+        self.result_dict[mode + '_mean_recall_count'] = np.zeros(self.num_rel)
+        self.result_dict[mode + '_mean_recall_list'] = {k: [] for k in self.recall_ks.tolist()}
+
+    def merge_result_dict(self, mode, result_dict):
+        self.result_dict[mode + '_mean_recall_collect'] += result_dict[mode + '_mean_recall_collect']
+        self.result_dict[mode + '_mean_recall_count'] += result_dict[mode + '_mean_recall_count']
 
     def generate_print_string(self, mode):
         result_str = 'SGG eval: '
@@ -580,7 +832,7 @@ class SGMeanRecall(SceneGraphEvaluation):
         if self.print_detail:
             # import ipdb; ipdb.set_trace()
             result_str += '----------------------- Details ------------------------\n'
-            for n, r in zip(self.rel_name_list, self.result_dict[mode + '_mean_recall_list'][100]):
+            for n, r in zip(self.rel_name_list, self.result_dict[mode + '_mean_recall_list'][int(self.recall_ks[-1])]):
                 result_str += '({}:{:.4f}) '.format(str(n), r)
             result_str += '\n'
             result_str += '--------------------------------------------------------\n'
@@ -588,44 +840,33 @@ class SGMeanRecall(SceneGraphEvaluation):
         return result_str
 
     def collect_mean_recall_items(self, global_container, local_container, mode):
-        pred_to_gt = local_container['pred_to_gt']
         gt_rels = local_container['gt_rels']
-
-        for k in self.result_dict[mode + '_mean_recall_collect']:
-            # the following code are copied from Neural-MOTIFS
-            match = reduce(np.union1d, pred_to_gt[:k])
-            # NOTE: by kaihua, calculate Mean Recall for each category independently
-            # this metric is proposed by: CVPR 2019 oral paper "Learning to Compose Dynamic Tree Structures for Visual Contexts"
-            recall_hit = [0] * self.num_rel
-            recall_count = [0] * self.num_rel
-            for idx in range(gt_rels.shape[0]):
-                local_label = gt_rels[idx,2]
-                recall_count[int(local_label)] += 1
-                recall_count[0] += 1
-
-            for idx in range(len(match)):
-                local_label = gt_rels[int(match[idx]),2]
-                recall_hit[int(local_label)] += 1
-                recall_hit[0] += 1
-            
-            for n in range(self.num_rel):
-                if recall_count[n] > 0:
-                    self.result_dict[mode + '_mean_recall_collect'][k][n].append(float(recall_hit[n] / recall_count[n]))
+        gt_labels = gt_rels[:, 2]
+        num_ks = len(self.recall_ks)
+
+        # NOTE: by kaihua, calculate Mean Recall for each category independently
+        # this metric is proposed by: CVPR 2019 oral paper "Learning to Compose Dynamic Tree Structures for Visual Contexts"
+        # (#K, #gt) whether each GT triplet is matched within the top K predictions
+        hit = local_container['gt_hit_ranks'][None, :] < self.recall_ks[:, None]
+        hit_inds = (np.arange(num_ks)[:, None] * self.num_rel + gt_labels[None, :])[hit]
+        recall_hit = np.bincount(hit_inds, minlength=num_ks * self.num_rel).reshape(num_ks, self.num_rel)
+        recall_count = np.bincount(gt_labels, minlength=self.num_rel)
+        # As in the original implementation (where index 0 was the background), every GT also counts towards index 0
+        recall_hit[:, 0] += hit.sum(1)
+        recall_count[0] += gt_rels.shape[0]
+
+        valid = recall_count > 0
+        self.result_dict[mode + '_mean_recall_collect'][:, valid] += recall_hit[:, valid] / recall_count[valid]
+        self.result_dict[mode + '_mean_recall_count'][valid] += 1
  
 
     def calculate_mean_recall(self, mode):
-        for k, v in self.result_dict[mode + '_mean_recall'].items():
-            sum_recall = 0
-            num_rel_no_bg = self.num_rel
-            for idx in range(num_rel_no_bg):
-                if len(self.result_dict[mode + '_mean_recall_collect'][k][idx]) == 0:
-                    tmp_recall = 0.0
-                else:
-                    tmp_recall = np.mean(self.result_dict[mode + '_mean_recall_collect'][k][idx])
-                self.result_dict[mode + '_mean_recall_list'][k].append(tmp_recall)
-                sum_recall += tmp_recall
-
-            self.result_dict[mode + '_mean_recall'][k] = sum_recall / float(num_rel_no_bg)
+        count = self.result_dict[mode + '_mean_recall_count']
+        recall = np.zeros_like(self.result_dict[mode + '_mean_recall_collect'])
+        np.divide(self.result_dict[mode + '_mean_recall_collect'], count[None, :], out=recall, where=count[None, :] > 0)
+        for k, k_recall in zip(self.recall_ks.tolist(), recall):
+            self.result_dict[mode + '_mean_recall_list'][k] = k_recall.tolist()
+            self.result_dict[mode + '_mean_recall'][k] = float(k_recall.mean())
         return
 
 
@@ -657,6 +898,49 @@ class SGAccumulateRecall(SceneGraphEvaluation):
         return 
 
 
+def _mean(total, count, empty=float('nan')):
+    """
+    Mean from an accumulated sum and count, `empty` if nothing was accumulated
+    """
+    if count == 0:
+        return empty
+    return float(total) / float(count)
+
+def _recall_ks(cfg):
+    """
+    Sorted K values at which the recall metrics are computed
+    """
+    return np.array(sorted(set(cfg.TEST.RELATION.RECALL_K)), dtype=np.int64)
+
+def _gt_hit_ranks(pred_to_gt, num_gt, keep=None):
+    """
+    Rank of the first prediction matching each GT triplet, so that a GT is recalled
+    at K iff its rank is < K. Unmatched GT triplets get the maximum int64 value.
+    Parameters:
+        pred_to_gt [List of List] : matching GT's of each prediction, see _compute_pred_matches
+        num_gt (int) : number of GT triplets
+        keep (#pred, ) : optional boolean mask, only the kept predictions are ranked
+    Returns:
+        ranks (#gt, )
+    """
+    ranks = np.full(num_gt, np.iinfo(np.int64).max, dtype=np.int64)
+    num_matches = [len(x) for x in pred_to_gt]
+    pred_ranks = np.arange(len(pred_to_gt), dtype=np.int64)
+    if keep is not None:
+        pred_ranks = np.cumsum(keep) - 1
+        num_matches = np.where(keep, num_matches, 0)
+        pred_to_gt = itertools.compress(pred_to_gt, keep)
+    pred_inds = np.repeat(pred_ranks, num_matches)
+    gt_inds = np.fromiter(itertools.chain.from_iterable(pred_to_gt), dtype=np.int64, count=pred_inds.shape[0])
+    np.minimum.at(ranks, gt_inds, pred_inds)
+    return ranks
+
+def _num_hits_at(ranks, ks):
+    """
+    Number of ranks < k for every k in ks
+    """
+    return np.searchsorted(np.sort(ranks), ks, side='left')
+
 def _triplet(relations, classes, boxes, predicate_scores=None, class_scores=None):
     """
     format relations of (sub_id, ob_id, pred_label) into triplets of (sub_label, pred_label, ob_label)
@@ -748,43 +1032,49 @@ def resize_instance(results, output_height, output_width, mask_threshold=0.5):
 
 
 def _compute_pred_matches(gt_triplets, pred_triplets,
-                 gt_boxes, pred_boxes, iou_thres, phrdet=False):
+                 gt_boxes, pred_boxes, iou_thres, phrdet=False, chunk_size=None):
     """
     Given a set of predicted triplets, return the list of matching GT's for each of the
-    given predictions
+    given predictions.
+    Subject and object IoUs are computed for all GT x pred triplet pairs in a single pass.
+    chunk_size (int): optional number of GT triplets processed per pass, to keep the
+        (#gt, #pred) intermediates bounded. None or 0 matches all GT triplets at once.
     Return:
         pred_to_gt [List of List]
     """
-    # This performs a matrix multiplication-esque thing between the two arrays
-    # Instead of summing, we want the equality, so we reduce in that way
-    # The rows correspond to GT triplets, columns to pred triplets
-    keeps = intersect_2d(gt_triplets, pred_triplets)
-    gt_has_match = keeps.any(1)
-    pred_to_gt = [[] for x in range(pred_boxes.shape[0])]
-    for gt_ind, gt_box, keep_inds in zip(np.where(gt_has_match)[0],
-                                         gt_boxes[gt_has_match],
-                                         keeps[gt_has_match],
-                                         ):
-        boxes = pred_boxes[keep_inds]
-        if phrdet:
-            # Evaluate where the union box > 0.5
-            gt_box_union = gt_box.reshape((2, 4))
-            gt_box_union = np.concatenate((gt_box_union.min(0)[:2], gt_box_union.max(0)[2:]), 0)
+    num_gt = gt_triplets.shape[0]
+    if not chunk_size or chunk_size <= 0:
+        chunk_size = max(num_gt, 1)
 
-            box_union = boxes.reshape((-1, 2, 4))
-            box_union = np.concatenate((box_union.min(1)[:,:2], box_union.max(1)[:,2:]), 1)
+    if phrdet:
+        # Evaluate where the union box > 0.5
+        gt_boxes = gt_boxes.reshape((-1, 2, 4))
+        gt_boxes = np.concatenate((gt_boxes.min(1)[:, :2], gt_boxes.max(1)[:, 2:]), 1)
+        pred_boxes_union = pred_boxes.reshape((-1, 2, 4))
+        pred_boxes_union = np.concatenate((pred_boxes_union.min(1)[:, :2], pred_boxes_union.max(1)[:, 2:]), 1)
 
-            inds = pairwise_iou(gt_box_union[None], box_union)[0] >= iou_thres
+    pred_to_gt = [[] for x in range(pred_boxes.shape[0])]
+    for start in range(0, num_gt, chunk_size):
+        end = min(start + chunk_size, num_gt)
+        # The rows correspond to GT triplets, columns to pred triplets
+        keeps = intersect_2d(gt_triplets[start:end], pred_triplets)
+        # Only compute IoUs against the predictions whose labels match some GT in this chunk
+        pred_inds = np.where(keeps.any(0))[0]
+        if pred_inds.shape[0] == 0:
+            continue
+        keeps = keeps[:, pred_inds]
 
+        if phrdet:
+            hits = pairwise_box_iou(gt_boxes[start:end], pred_boxes_union[pred_inds]) >= iou_thres
         else:
-            #FIXME Check for indexing
-            sub_iou = pairwise_iou(Boxes(gt_box[None,:4]), Boxes(boxes[:, :4]))[0]
-            obj_iou = pairwise_iou(Boxes(gt_box[None,4:]), Boxes(boxes[:, 4:]))[0]
-
-            inds = ((sub_iou >= iou_thres) & (obj_iou >= iou_thres)).numpy()
-            
-        for i in np.where(keep_inds)[0][inds]:
-            pred_to_gt[i].append(int(gt_ind))
+            sub_iou = pairwise_box_iou(gt_boxes[start:end, :4], pred_boxes[pred_inds, :4])
+            obj_iou = pairwise_box_iou(gt_boxes[start:end, 4:], pred_boxes[pred_inds, 4:])
+            hits = (sub_iou >= iou_thres) & (obj_iou >= iou_thres)
+
+        # nonzero is row-major, so every pred's list is filled in increasing GT order
+        gt_hit, pred_hit = np.nonzero(keeps & hits)
+        for gt_ind, pred_ind in zip((gt_hit + start).tolist(), pred_inds[pred_hit].tolist()):
+            pred_to_gt[pred_ind].append(gt_ind)
     return pred_to_gt
 
 
@@ -0,0 +1,70 @@
+# Parity tests for the vectorized triplet matcher against the original per-GT loop
+
+import numpy as np
+import pytest
+from detectron2.structures.boxes import pairwise_iou, Boxes
+
+from .sg_evaluation import _compute_pred_matches
+from .utils import intersect_2d
+
+
+def _compute_pred_matches_reference(gt_triplets, pred_triplets,
+                 gt_boxes, pred_boxes, iou_thres):
+    """
+    Original implementation, matching one GT triplet at a time
+    """
+    keeps = intersect_2d(gt_triplets, pred_triplets)
+    gt_has_match = keeps.any(1)
+    pred_to_gt = [[] for x in range(pred_boxes.shape[0])]
+    for gt_ind, gt_box, keep_inds in zip(np.where(gt_has_match)[0],
+                                         gt_boxes[gt_has_match],
+                                         keeps[gt_has_match],
+                                         ):
+        boxes = pred_boxes[keep_inds]
+        sub_iou = pairwise_iou(Boxes(gt_box[None,:4]), Boxes(boxes[:, :4]))[0]
+        obj_iou = pairwise_iou(Boxes(gt_box[None,4:]), Boxes(boxes[:, 4:]))[0]
+        inds = ((sub_iou >= iou_thres) & (obj_iou >= iou_thres)).numpy()
+        for i in np.where(keep_inds)[0][inds]:
+            pred_to_gt[i].append(int(gt_ind))
+    return pred_to_gt
+
+
+def _random_boxes(rng, num_boxes, size=600):
+    xy = rng.uniform(0, size, size=(num_boxes, 2))
+    wh = rng.uniform(1, size / 2, size=(num_boxes, 2))
+    return np.concatenate((xy, xy + wh), 1).astype(np.float32)
+
+
+def _random_triplets(rng, num_gt=25, num_pred=100, num_objs=12, num_classes=4, num_predicates=3):
+    gt_classes = rng.randint(num_classes, size=num_objs)
+    gt_obj_boxes = _random_boxes(rng, num_objs)
+    gt_pairs = rng.randint(num_objs, size=(num_gt, 2))
+    gt_triplets = np.column_stack((gt_classes[gt_pairs[:, 0]], rng.randint(num_predicates, size=num_gt), gt_classes[gt_pairs[:, 1]]))
+    gt_boxes = np.column_stack((gt_obj_boxes[gt_pairs[:, 0]], gt_obj_boxes[gt_pairs[:, 1]]))
+
+    # Predictions are jittered copies of the GT so that a fair share of them matches
+    src = rng.randint(num_gt, size=num_pred)
+    pred_triplets = gt_triplets[src].copy()
+    flip = rng.rand(num_pred) < 0.3
+    pred_triplets[flip, 1] = rng.randint(num_predicates, size=flip.sum())
+    pred_boxes = (gt_boxes[src] + rng.normal(scale=30, size=(num_pred, 8))).astype(np.float32)
+    return gt_triplets, pred_triplets, gt_boxes, pred_boxes
+
+
+@pytest.mark.parametrize("seed", range(5))
+@pytest.mark.parametrize("chunk_size", [None, 1, 7])
+def test_compute_pred_matches_parity(seed, chunk_size):
+    rng = np.random.RandomState(seed)
+    gt_triplets, pred_triplets, gt_boxes, pred_boxes = _random_triplets(rng)
+
+    expected = _compute_pred_matches_reference(gt_triplets, pred_triplets, gt_boxes, pred_boxes, 0.5)
+    result = _compute_pred_matches(gt_triplets, pred_triplets, gt_boxes, pred_boxes, 0.5, chunk_size=chunk_size)
+    assert result == expected
+    assert any(len(x) > 0 for x in result)
+
+
+def test_compute_pred_matches_no_label_match():
+    rng = np.random.RandomState(0)
+    gt_triplets, pred_triplets, gt_boxes, pred_boxes = _random_triplets(rng)
+    result = _compute_pred_matches(gt_triplets, pred_triplets + 100, gt_boxes, pred_boxes, 0.5)
+    assert result == [[] for _ in range(pred_boxes.shape[0])]
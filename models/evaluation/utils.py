@@ -24,3 +24,59 @@ def argsort_desc(scores):
              need to get the score.
     """
     return np.column_stack(np.unravel_index(np.argsort(-scores.ravel()), scores.shape))
+
+def pairwise_box_iou(boxes1, boxes2):
+    """
+    Numpy counterpart of detectron2's `pairwise_iou` for XYXY boxes. Computed in float32 so
+    that thresholding agrees with the torch implementation.
+    :param boxes1: [m1, 4] numpy array
+    :param boxes2: [m2, 4] numpy array
+    :return: [m1, m2] float32 array of IoU values
+    """
+    boxes1 = np.asarray(boxes1, dtype=np.float32)
+    boxes2 = np.asarray(boxes2, dtype=np.float32)
+    area1 = (boxes1[:, 2] - boxes1[:, 0]) * (boxes1[:, 3] - boxes1[:, 1])
+    area2 = (boxes2[:, 2] - boxes2[:, 0]) * (boxes2[:, 3] - boxes2[:, 1])
+
+    width_height = np.minimum(boxes1[:, None, 2:], boxes2[:, 2:]) - np.maximum(boxes1[:, None, :2], boxes2[:, :2])
+    width_height = np.clip(width_height, 0, None)
+    inter = width_height.prod(axis=2)
+    union = area1[:, None] + area2 - inter
+    iou = np.zeros_like(inter)
+    np.divide(inter, union, out=iou, where=inter > 0)
+    return iou
+
+def pack_triplets(triplets, bits=21):
+    """
+    Encodes each row of a [m, 3] integer array into a single int64 key, `bits` bits per column
+    :param triplets: [m, 3] numpy array of non negative labels, each smaller than 2 ** bits
+    :return: [m] int64 array of keys
+    """
+    triplets = np.asarray(triplets, dtype=np.int64).reshape(-1, 3)
+    mask = (1 << bits) - 1
+    return ((triplets[:, 0] & mask) << (2 * bits)) | ((triplets[:, 1] & mask) << bits) | (triplets[:, 2] & mask)
+
+class TripletIndex(object):
+    """
+    Set of triplets (e.g. the zero shot or the tail triplets) stored as sorted packed keys,
+    so that membership queries cost a binary search per queried triplet.
+    """
+    def __init__(self, triplets):
+        """
+        :param triplets: [m, 3] numpy array, in the same column order as the queried triplets
+        """
+        self.keys = np.unique(pack_triplets(triplets))
+
+    def __len__(self):
+        return self.keys.shape[0]
+
+    def contains(self, triplets):
+        """
+        :param triplets: [n, 3] numpy array
+        :return: [n] bool array, True for the triplets in the index
+        """
+        keys = pack_triplets(triplets)
+        if len(self) == 0:
+            return np.zeros(keys.shape[0], dtype=bool)
+        pos = np.minimum(np.searchsorted(self.keys, keys), len(self) - 1)
+        return self.keys[pos] == keys
@@ -1,7 +1,10 @@
 import sys
 import os
 import torch
+import contextlib
 import logging
+from torch import nn
+from torch.nn import functional as F
 import numpy as np
 from detectron2.modeling import META_ARCH_REGISTRY, GeneralizedRCNN
 from detectron2.modeling.proposal_generator import build_proposal_generator
@@ -16,6 +19,13 @@ from detectron2.modeling.backbone import Backbone, build_backbone
 from ..backbone import *
 import cv2
 
+try:
+    _nullcontext = contextlib.nullcontext  # python 3.7+
+except AttributeError:
+    @contextlib.contextmanager
+    def _nullcontext(enter_result=None):
+        yield enter_result
+
 @META_ARCH_REGISTRY.register()
 class SceneGraphRCNN(GeneralizedRCNN):
     @configurable
@@ -171,6 +181,36 @@ class SceneGraphRCNN(GeneralizedRCNN):
 
 @META_ARCH_REGISTRY.register()
 class SceneGraphSegmentationRCNN(SceneGraphRCNN):
+    @configurable
+    def __init__(self, *, joint_backbone_forward=False, **kwargs):
+        super(SceneGraphSegmentationRCNN, self).__init__(**kwargs)
+        self.joint_backbone_forward = joint_backbone_forward
+        if joint_backbone_forward and any(isinstance(m, nn.modules.batchnorm._BatchNorm) for m in self.backbone.modules()):
+            logging.getLogger('detectron2').log(logging.WARN, "MODEL.JOINT_BACKBONE_FORWARD: the BatchNorm statistics of the backbone are computed over the VG and COCO images together")
+
+    @classmethod
+    def from_config(cls, cfg):
+        ret = super().from_config(cfg)
+        ret['joint_backbone_forward'] = cfg.MODEL.JOINT_BACKBONE_FORWARD
+        return ret
+
+    def _joint_backbone(self, images, mask_images):
+        """
+        Run the backbone once over the images of both batches, padded to a common size, and
+        split the features back per batch
+        """
+        # Both sizes are multiples of the size divisibility, so is their maximum
+        height = max(images.tensor.shape[-2], mask_images.tensor.shape[-2])
+        width = max(images.tensor.shape[-1], mask_images.tensor.shape[-1])
+        tensor = torch.cat([F.pad(x.tensor, (0, width - x.tensor.shape[-1], 0, height - x.tensor.shape[-2])) for x in (images, mask_images)])
+        # Without trainable parameters no activation needs to be kept for the backward pass
+        frozen = not any(param.requires_grad for param in self.backbone.parameters())
+        with torch.no_grad() if frozen else _nullcontext():
+            joint_features = self.backbone(tensor)
+        features = {k: v[:len(images)] for k, v in joint_features.items()}
+        mask_features = {k: v[len(images):] for k, v in joint_features.items()}
+        return features, mask_features
+
     def forward(self, batched_inputs, mask_batched_inputs=None, segmentation_step=False):
         if not self.training:
             return self.inference(batched_inputs, segmentation_step=segmentation_step)
@@ -183,7 +223,12 @@ class SceneGraphSegmentationRCNN(SceneGraphRCNN):
             gt_instances = None
             gt_relations = None
 
-        features = self.backbone(images.tensor)
+        if self.joint_backbone_forward and mask_batched_inputs is not None:
+            mask_images = self.preprocess_image(mask_batched_inputs)
+            features, mask_features = self._joint_backbone(images, mask_images)
+        else:
+            mask_images, mask_features = None, None
+            features = self.backbone(images.tensor)
 
         if self.proposal_generator:
             proposals, _ = self.proposal_generator(images, features, gt_instances)
@@ -194,14 +239,14 @@ class SceneGraphSegmentationRCNN(SceneGraphRCNN):
             proposal_losses = {}
 
         if mask_batched_inputs is not None:
-            mask_images = self.preprocess_image(mask_batched_inputs)
+            if mask_images is None:
+                mask_images = self.preprocess_image(mask_batched_inputs)
+                mask_features = self.backbone(mask_images.tensor)
             if "instances" in mask_batched_inputs[0]:
                 mask_gt_instances = [x["instances"].to(self.device) for x in mask_batched_inputs]
             else:
                 mask_gt_instances = None
 
-            mask_features = self.backbone(mask_images.tensor)
-
             if self.proposal_generator:
                 mask_proposals, _ = self.proposal_generator(mask_images, mask_features, mask_gt_instances)
                 mask_proposal_losses = {}
@@ -11,6 +11,7 @@ def add_scenegraph_config(cfg):
     _C.MODEL.SCENEGRAPH_ON = True
     _C.MODEL.ROI_BOX_HEAD.TRAIN_ON_PRED_BOXES = True
     _C.MODEL.USE_MASK_ON_NODE = False
+    _C.MODEL.JOINT_BACKBONE_FORWARD = False # SceneGraphSegmentationRCNN: one backbone forward over the VG and COCO training batches, padded to a common size
     _C.MODEL.ROI_HEADS.OBJECTNESS_THRESH = 0.3
     _C.MODEL.GROUP_NORM = CN()
     _C.MODEL.GROUP_NORM.DIM_PER_GP = -1
@@ -94,6 +95,18 @@ def add_scenegraph_config(cfg):
     _C.TEST.RELATION.LATER_NMS_PREDICTION_THRES = 0.3 
     _C.TEST.RELATION.MULTIPLE_PREDS = False
     _C.TEST.RELATION.IOU_THRESHOLD = 0.5
+    _C.TEST.RELATION.RECALL_K = [20, 50, 100] # K of all recall metrics (R@K, mR@K, ...), e.g. list(range(1, 101)) for recall curves
+    _C.TEST.RELATION.MATCH_CHUNK_SIZE = 0 # number of GT triplets matched per pass during evaluation, 0 to match all at once
+    _C.TEST.RELATION.SHARDED_EVALUATION = False # compute scene graph metrics on every rank and only reduce the metric containers
+    _C.TEST.RELATION.NUM_EVAL_WORKERS = 0 # local processes used to compute scene graph metrics, 0 to compute them in the main process
+    _C.TEST.RELATION.STREAMING_EVALUATION = False # update the scene graph metrics in process() instead of storing every prediction
+    _C.TEST.RELATION.DUMP_TOPK = 100 # relations kept per image in columnar dumps, 0 to keep all. Re-evaluating a dump gives the same graph constrained recalls for K <= DUMP_TOPK, but not the same no graph constraint recalls unless 0
+    _C.TEST.RELATION.DUMP_FORMAT = 'pth' # 'pth' to pickle all predictions at the end of evaluation, 'columnar' to write memory-mappable arrays while processing. The streaming evaluator always writes columnar dumps
+    _C.TEST.RELATION.MAX_PAIRS_PER_IMAGE = 0 # candidate object pairs sent to the union feature extractor and the predictor per image, 0 to keep all pairs
+    _C.TEST.RELATION.PAIR_SCORER = 'ObjectnessPairScorer' # ranks the candidate pairs when MAX_PAIRS_PER_IMAGE is set, 'ObjectnessPairScorer' or 'FrequencyPairScorer'
+    _C.TEST.RELATION.PAIR_BLOCK_SIZE = 256 # subjects whose candidate pairs are scored at once when MAX_PAIRS_PER_IMAGE is set
+    _C.TEST.RELATION.MAX_RELS_PER_IMAGE = 0 # relations of the highest triple scores kept in the predictions of each image, 0 to keep all. At least max(RECALL_K) keeps the graph constrained recalls, but not the no graph constraint recalls unless 0
+    _C.TEST.RELATION.REL_SCORE_THRESH = 0.0 # relations of lower triple scores are removed from the predictions, except the best one of each image
 
 
     _C.DATASETS.VISUAL_GENOME.CLIPPED = False
\ No newline at end of file
@@ -8,6 +8,23 @@ from .make_layers import make_fc
 from ..motif.utils_motifs import obj_edge_vectors, center_x, sort_by_score, to_onehot, get_dropout_mask, encode_box_info, cat
 
 
+def aggregate_rel_messages(obj_count, sub_global_inds, obj_global_inds, pre_out, pre_in):
+    """
+    Sum the messages of each relation into its subject and object, i.e.
+    sub2rel @ pre_out + obj2rel @ pre_in without the (obj_count x rel_count) mapping matrices.
+
+    Args:
+        obj_count (int): number of objects of the batch
+        sub_global_inds, obj_global_inds (Tensor[long]): (R,) subject and object of each relation
+        pre_out, pre_in (Tensor): (R, D) messages to the subjects and to the objects
+    Returns:
+        Tensor: (obj_count, D) vertex context
+    """
+    vert_ctx = pre_out.new_zeros(obj_count, pre_out.shape[1])
+    vert_ctx = vert_ctx.index_add(0, sub_global_inds, pre_out)
+    return vert_ctx.index_add(0, obj_global_inds, pre_in)
+
+
 class IMPContext(nn.Module):
     def __init__(self, config, num_obj, num_rel, in_channels, hidden_dim=512, num_iter=3):
         super(IMPContext, self).__init__()
@@ -57,8 +74,6 @@ class IMPContext(nn.Module):
         rel_count = rel_rep.shape[0]
 
         # generate sub-rel-obj mapping
-        sub2rel = torch.zeros(obj_count, rel_count).to(obj_rep.device).float()
-        obj2rel = torch.zeros(obj_count, rel_count).to(obj_rep.device).float()
         obj_offset = 0
         rel_offset = 0
         sub_global_inds = []
@@ -67,14 +82,10 @@ class IMPContext(nn.Module):
             num_rel = pair_idx.shape[0]
             sub_idx = pair_idx[:,0].contiguous().long().view(-1) + obj_offset
             obj_idx = pair_idx[:,1].contiguous().long().view(-1) + obj_offset
-            rel_idx = torch.arange(num_rel).to(obj_rep.device).long().view(-1) + rel_offset
 
             sub_global_inds.append(sub_idx)
             obj_global_inds.append(obj_idx)
 
-            sub2rel[sub_idx, rel_idx] = 1.0
-            obj2rel[obj_idx, rel_idx] = 1.0
-
             obj_offset += num_obj
             rel_offset += num_rel
 
@@ -102,7 +113,7 @@ class IMPContext(nn.Module):
             # Compute vertex context
             pre_out = self.out_edge_w_fc(torch.cat((sub_vert, edge_factor[i]), 1)) * edge_factor[i]
             pre_in = self.in_edge_w_fc(torch.cat((obj_vert, edge_factor[i]), 1)) * edge_factor[i]
-            vert_ctx = sub2rel @ pre_out + obj2rel @ pre_in
+            vert_ctx = aggregate_rel_messages(obj_count, sub_global_inds, obj_global_inds, pre_out, pre_in)
             vert_factor.append(self.node_gru(vert_ctx, vert_factor[i]))
 
         if self.mode == 'predcls':
@@ -123,7 +134,6 @@ class IMPSegmentationContext(IMPContext):
 
     def forward(self, x, proposals, union_features, rel_pair_idxs, logger=None, mask_box_features=None, masks=None, segmentation_step=False, return_masks=False):
         num_objs = [len(b) for b in proposals]
-        import ipdb; ipdb.set_trace()
         obj_rep = self.obj_unary(x)
         obj_count = obj_rep.shape[0]
         if not segmentation_step:
@@ -131,8 +141,6 @@ class IMPSegmentationContext(IMPContext):
             rel_count = rel_rep.shape[0]
 
             # generate sub-rel-obj mapping
-            sub2rel = torch.zeros(obj_count, rel_count).to(obj_rep.device).float()
-            obj2rel = torch.zeros(obj_count, rel_count).to(obj_rep.device).float()
             obj_offset = 0
             rel_offset = 0
             sub_global_inds = []
@@ -141,14 +149,10 @@ class IMPSegmentationContext(IMPContext):
                 num_rel = pair_idx.shape[0]
                 sub_idx = pair_idx[:,0].contiguous().long().view(-1) + obj_offset
                 obj_idx = pair_idx[:,1].contiguous().long().view(-1) + obj_offset
-                rel_idx = torch.arange(num_rel).to(obj_rep.device).long().view(-1) + rel_offset
 
                 sub_global_inds.append(sub_idx)
                 obj_global_inds.append(obj_idx)
 
-                sub2rel[sub_idx, rel_idx] = 1.0
-                obj2rel[obj_idx, rel_idx] = 1.0
-
                 obj_offset += num_obj
                 rel_offset += num_rel
 
@@ -176,7 +180,7 @@ class IMPSegmentationContext(IMPContext):
             # Compute vertex context
             pre_out = self.out_edge_w_fc(torch.cat((sub_vert, edge_factor[i]), 1)) * edge_factor[i]
             pre_in = self.in_edge_w_fc(torch.cat((obj_vert, edge_factor[i]), 1)) * edge_factor[i]
-            vert_ctx = sub2rel @ pre_out + obj2rel @ pre_in
+            vert_ctx = aggregate_rel_messages(obj_count, sub_global_inds, obj_global_inds, pre_out, pre_in)
             vert_factor.append(self.node_gru(vert_ctx, vert_factor[i]))
 
         if self.mode == 'predcls':
@@ -0,0 +1,97 @@
+# Parity tests for the scatter-based IMP message aggregation against the dense sub2rel / obj2rel matmuls
+
+from types import SimpleNamespace
+
+import pytest
+import torch
+
+from detectron2.structures import Instances
+
+from . import model_imp
+from .model_imp import IMPContext, IMPSegmentationContext, aggregate_rel_messages
+
+
+def _aggregate_rel_messages_reference(obj_count, sub_global_inds, obj_global_inds, pre_out, pre_in):
+    """
+    Original implementation, with dense (obj_count x rel_count) mapping matrices
+    """
+    rel_count = pre_out.shape[0]
+    rel_idx = torch.arange(rel_count)
+    sub2rel = torch.zeros(obj_count, rel_count)
+    obj2rel = torch.zeros(obj_count, rel_count)
+    sub2rel[sub_global_inds, rel_idx] = 1.0
+    obj2rel[obj_global_inds, rel_idx] = 1.0
+    return sub2rel @ pre_out + obj2rel @ pre_in
+
+
+def _random_pairs(generator, num_objs):
+    # Global subject / object indices of all ordered pairs of some objects of each image
+    sub_global_inds, obj_global_inds = [], []
+    obj_offset = 0
+    for num_obj in num_objs:
+        pairs = torch.cartesian_prod(torch.arange(num_obj), torch.arange(num_obj))
+        pairs = pairs[pairs[:, 0] != pairs[:, 1]]
+        pairs = pairs[torch.randperm(pairs.shape[0], generator=generator)[:max(1, pairs.shape[0] // 2)]]
+        sub_global_inds.append(pairs[:, 0] + obj_offset)
+        obj_global_inds.append(pairs[:, 1] + obj_offset)
+        obj_offset += num_obj
+    return torch.cat(sub_global_inds), torch.cat(obj_global_inds)
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_aggregate_rel_messages_parity(seed):
+    generator = torch.Generator().manual_seed(seed)
+    num_objs = torch.randint(2, 20, (3,), generator=generator).tolist()
+    # Objects without any relation get a zero context
+    num_objs.append(1)
+    obj_count = sum(num_objs)
+    sub_global_inds, obj_global_inds = _random_pairs(generator, num_objs)
+    pre_out = torch.randn(sub_global_inds.shape[0], 16, generator=generator, requires_grad=True)
+    pre_in = torch.randn(sub_global_inds.shape[0], 16, generator=generator, requires_grad=True)
+
+    vert_ctx = aggregate_rel_messages(obj_count, sub_global_inds, obj_global_inds, pre_out, pre_in)
+    grads = torch.autograd.grad(vert_ctx.pow(2).sum(), (pre_out, pre_in))
+    expected = _aggregate_rel_messages_reference(obj_count, sub_global_inds, obj_global_inds, pre_out, pre_in)
+    expected_grads = torch.autograd.grad(expected.pow(2).sum(), (pre_out, pre_in))
+
+    assert vert_ctx.shape == (obj_count, 16)
+    assert torch.allclose(vert_ctx, expected, atol=1e-5)
+    for grad, expected_grad in zip(grads, expected_grads):
+        assert torch.allclose(grad, expected_grad, atol=1e-5)
+
+
+def _config(mode):
+    roi_scenegraph_head = SimpleNamespace(CONTEXT_POOLING_DIM=24, USE_GT_BOX=mode != 'sgdet', USE_GT_OBJECT_LABEL=mode == 'predcls')
+    return SimpleNamespace(MODEL=SimpleNamespace(ROI_SCENEGRAPH_HEAD=roi_scenegraph_head))
+
+
+def _random_batch(generator, num_objs, num_obj_classes, in_channels, pooling_dim):
+    proposals = [Instances((64, 64), pred_classes=torch.randint(0, num_obj_classes, (num_obj,), generator=generator)) for num_obj in num_objs]
+    sub_global_inds, obj_global_inds = _random_pairs(generator, num_objs)
+    # Per image pair indices, local to the objects of each image
+    obj_offsets = torch.cumsum(torch.tensor([0] + num_objs[:-1]), 0)
+    img_inds = torch.repeat_interleave(torch.arange(len(num_objs)), torch.tensor(num_objs))[sub_global_inds]
+    rel_pair_idxs = torch.stack((sub_global_inds, obj_global_inds), dim=1) - obj_offsets[img_inds][:, None]
+    rel_pair_idxs = list(rel_pair_idxs.split(torch.bincount(img_inds, minlength=len(num_objs)).tolist()))
+    x = torch.randn(sum(num_objs), in_channels, generator=generator)
+    union_features = torch.randn(sub_global_inds.shape[0], pooling_dim, generator=generator)
+    return x, proposals, union_features, rel_pair_idxs
+
+
+@pytest.mark.parametrize("context_class", [IMPContext, IMPSegmentationContext])
+@pytest.mark.parametrize("mode", ['sgdet', 'predcls'])
+def test_imp_context_forward_parity(context_class, mode, monkeypatch):
+    torch.manual_seed(0)
+    generator = torch.Generator().manual_seed(0)
+    context = context_class(_config(mode), num_obj=10, num_rel=5, in_channels=16, hidden_dim=32, num_iter=3)
+    x, proposals, union_features, rel_pair_idxs = _random_batch(generator, [5, 2, 8], 11, 16, 24)
+
+    obj_dists, rel_dists = context(x, proposals, union_features, rel_pair_idxs)
+    # The original forward, with the dense sub2rel / obj2rel matmuls
+    monkeypatch.setattr(model_imp, 'aggregate_rel_messages', _aggregate_rel_messages_reference)
+    expected_obj_dists, expected_rel_dists = context(x, proposals, union_features, rel_pair_idxs)
+
+    assert obj_dists.shape == (15, 11)
+    assert rel_dists.shape == (union_features.shape[0], 6)
+    assert torch.allclose(obj_dists, expected_obj_dists, atol=1e-5)
+    assert torch.allclose(rel_dists, expected_rel_dists, atol=1e-5)
@@ -4,7 +4,7 @@ from torch import nn
 
 from detectron2.structures.instances import Instances
 from detectron2.structures.boxes import Boxes
-from .utils import obj_prediction_nms
+from .utils import batched_obj_prediction_nms
 
 class PostProcessor(nn.Module):
     """
@@ -17,13 +17,23 @@ class PostProcessor(nn.Module):
         self,
         use_gt_box=False,
         later_nms_pred_thres=0.3,
+        max_rels_per_image=0,
+        rel_score_thresh=0.0,
     ):
         """
         Arguments:
+            max_rels_per_image (int): only the relations of the max_rels_per_image highest triple
+                scores are kept, 0 to keep all of them. The graph constrained recalls at
+                K <= max_rels_per_image are unchanged, but the no graph constraint ones rank
+                every predicate of every pair, so they can change unless 0
+            rel_score_thresh (float): relations of lower triple scores are removed, except
+                the highest scoring one
         """
         super(PostProcessor, self).__init__()
         self.use_gt_box = use_gt_box
         self.later_nms_pred_thres = later_nms_pred_thres
+        self.max_rels_per_image = max_rels_per_image
+        self.rel_score_thresh = rel_score_thresh
 
     def forward(self, x, rel_pair_idxs, boxes, img_sizes, segmentation_vis=False):
         """
@@ -40,6 +50,9 @@ class PostProcessor(nn.Module):
         """
         relation_logits, refine_logits = x
         finetune_obj_logits = refine_logits
+        if not self.use_gt_box:
+            # apply late nms for object prediction, to all images at once
+            obj_preds = batched_obj_prediction_nms([box.boxes_per_cls for box in boxes], finetune_obj_logits, self.later_nms_pred_thres, keep_existing=True)
 
         results = []
         for i, (rel_logit, obj_logit, rel_pair_idx, box, img_size) in enumerate(zip(
@@ -54,8 +67,7 @@ class PostProcessor(nn.Module):
             if self.use_gt_box:
                 obj_scores, obj_pred = obj_class_prob[:, :-1].max(dim=1)
             else:
-                # apply late nms for object prediction
-                obj_pred = obj_prediction_nms(box.boxes_per_cls, obj_logit, self.later_nms_pred_thres)
+                obj_pred = obj_preds[i]
                 obj_score_ind = torch.arange(num_obj_bbox, device=obj_logit.device) * num_obj_class + obj_pred
                 obj_scores = obj_class_prob.view(-1)[obj_score_ind]
             
@@ -84,8 +96,15 @@ class PostProcessor(nn.Module):
             rel_class_prob = F.softmax(rel_logit, -1)
             rel_scores, rel_class = rel_class_prob[:, :-1].max(dim=1)
 
-            triple_scores = rel_scores * obj_scores0 * obj_scores1
-            _, sorting_idx = torch.sort(triple_scores.view(-1), dim=0, descending=True)
+            triple_scores = (rel_scores * obj_scores0 * obj_scores1).view(-1)
+            if 0 < self.max_rels_per_image < triple_scores.shape[0]:
+                sorted_scores, sorting_idx = torch.topk(triple_scores, self.max_rels_per_image)
+            else:
+                sorted_scores, sorting_idx = torch.sort(triple_scores, dim=0, descending=True)
+            if self.rel_score_thresh > 0:
+                keep = sorted_scores >= self.rel_score_thresh
+                keep[:1] = True
+                sorting_idx = sorting_idx[keep]
             rel_pair_idx = rel_pair_idx[sorting_idx]
             rel_class_prob = rel_class_prob[sorting_idx]
             rel_labels = rel_class[sorting_idx]
@@ -108,5 +127,7 @@ def build_roi_scenegraph_post_processor(cfg):
     postprocessor = PostProcessor(
         use_gt_box,
         later_nms_pred_thres,
+        max_rels_per_image=cfg.TEST.RELATION.MAX_RELS_PER_IMAGE,
+        rel_score_thresh=cfg.TEST.RELATION.REL_SCORE_THRESH,
     )
     return postprocessor
\ No newline at end of file
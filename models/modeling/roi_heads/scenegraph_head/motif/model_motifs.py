@@ -3,7 +3,7 @@ import torch
 from torch import nn
 from torch.nn.utils.rnn import PackedSequence
 from torch.nn import functional as F
-from ..utils import nms_overlaps
+from ..utils import obj_prediction_nms
 from .utils_motifs import obj_edge_vectors, center_x, sort_by_score, to_onehot, get_dropout_mask, encode_box_info, cat, obj_edge_vectors_segmentation
 from ....roi_heads.mask_head import SGSceneGraphMaskHead
 from detectron2.layers import ShapeSpec, nonzero_tuple
@@ -187,22 +187,7 @@ class DecoderRNN(nn.Module):
 
         # Do NMS here as a post-processing step
         if boxes_for_nms is not None and not self.training:
-            is_overlap = nms_overlaps(boxes_for_nms).view(
-                boxes_for_nms.size(0), boxes_for_nms.size(0), boxes_for_nms.size(1)
-            ).cpu().numpy() >= self.nms_thresh
-
-            out_dists_sampled = F.softmax(torch.cat(out_dists,0), 1).cpu().numpy()
-            out_dists_sampled[:,-1] = 0
-
-            out_commitments = out_commitments[0].new(len(out_commitments)).fill_(0)
-
-            for i in range(out_commitments.size(0)):
-                box_ind, cls_ind = np.unravel_index(out_dists_sampled.argmax(), out_dists_sampled.shape)
-                out_commitments[int(box_ind)] = int(cls_ind)
-                out_dists_sampled[is_overlap[box_ind,:,cls_ind], cls_ind] = 0.0
-                out_dists_sampled[box_ind] = -1.0 # This way we won't re-sample
-
-            out_commitments = out_commitments
+            out_commitments = obj_prediction_nms(boxes_for_nms, torch.cat(out_dists, 0), self.nms_thresh)
         else:
             out_commitments = torch.cat(out_commitments, 0)
 
@@ -305,22 +290,7 @@ class DecoderSegmentationRNN(DecoderRNN):
 
         # Do NMS here as a post-processing step
         if boxes_for_nms is not None and not self.training:
-            is_overlap = nms_overlaps(boxes_for_nms).view(
-                boxes_for_nms.size(0), boxes_for_nms.size(0), boxes_for_nms.size(1)
-            ).cpu().numpy() >= self.nms_thresh
-
-            out_dists_sampled = F.softmax(torch.cat(out_dists,0), 1).cpu().numpy()
-            out_dists_sampled[:,-1] = 0
-
-            out_commitments = out_commitments[0].new(len(out_commitments)).fill_(0)
-
-            for i in range(out_commitments.size(0)):
-                box_ind, cls_ind = np.unravel_index(out_dists_sampled.argmax(), out_dists_sampled.shape)
-                out_commitments[int(box_ind)] = int(cls_ind)
-                out_dists_sampled[is_overlap[box_ind,:,cls_ind], cls_ind] = 0.0
-                out_dists_sampled[box_ind] = -1.0 # This way we won't re-sample
-
-            out_commitments = out_commitments
+            out_commitments = obj_prediction_nms(boxes_for_nms, torch.cat(out_dists, 0), self.nms_thresh)
         else:
             out_commitments = torch.cat(out_commitments, 0)
 
@@ -5,7 +5,55 @@ from torch.nn import functional as F
 import numpy as np
 import numpy.random as npr
 
+from detectron2.data import MetadataCatalog
 from detectron2.structures.boxes import pairwise_iou
+from detectron2.utils.registry import Registry
+
+RELATION_PAIR_SCORER_REGISTRY = Registry("RELATION_PAIR_SCORER_REGISTRY")
+RELATION_PAIR_SCORER_REGISTRY.__doc__ = """
+Scorers of the candidate object pairs, ranking them when only the top
+TEST.RELATION.MAX_PAIRS_PER_IMAGE pairs of an image are kept at test time.
+A scorer is built from the cfg and called with (proposals of an image, subject indices,
+object indices), returning one score per pair.
+"""
+
+def _object_scores(proposal):
+    # Detection score of each object, 1 for ground truth boxes
+    if proposal.has('scores'):
+        return proposal.scores
+    if proposal.has('pred_scores') and proposal.pred_scores.dim() == 2:
+        return proposal.pred_scores[:, :-1].max(1)[0]
+    return torch.ones(len(proposal), device=proposal.pred_boxes.device)
+
+@RELATION_PAIR_SCORER_REGISTRY.register()
+class ObjectnessPairScorer(object):
+    """
+    Product of the detection scores of the subject and the object
+    """
+    def __init__(self, cfg):
+        pass
+
+    def __call__(self, proposal, sub_idxs, obj_idxs):
+        obj_scores = _object_scores(proposal)
+        return obj_scores[sub_idxs] * obj_scores[obj_idxs]
+
+@RELATION_PAIR_SCORER_REGISTRY.register()
+class FrequencyPairScorer(ObjectnessPairScorer):
+    """
+    Product of the detection scores weighted by the probability that the predicted classes of
+    the subject and the object are related, from the predicate distribution of the training set
+    """
+    def __init__(self, cfg):
+        statistics = MetadataCatalog.get(cfg.DATASETS.TRAIN[0]).statistics
+        # The last predicate is the background
+        self.fg_prob = 1.0 - statistics['pred_dist'][:, :, -1].exp()
+
+    def __call__(self, proposal, sub_idxs, obj_idxs):
+        labels = proposal.pred_classes.long()
+        if self.fg_prob.device != labels.device:
+            self.fg_prob = self.fg_prob.to(labels.device)
+        fg_prob = self.fg_prob[labels[sub_idxs], labels[obj_idxs]]
+        return super(FrequencyPairScorer, self).__call__(proposal, sub_idxs, obj_idxs) * fg_prob
 
 class RelationSampling(object):
     #sample relation pair proposals from given sets of bounding boxes
@@ -19,6 +67,9 @@ class RelationSampling(object):
         use_gt_box,
         num_rel_classes,
         test_overlap,
+        max_pairs_per_image=0,
+        pair_scorer=None,
+        pair_block_size=256,
     ):
 
         self.fg_thres = fg_thres
@@ -29,6 +80,9 @@ class RelationSampling(object):
         self.use_gt_box = use_gt_box
         self.num_rel_classes = num_rel_classes
         self.test_overlap = test_overlap
+        self.max_pairs_per_image = max_pairs_per_image
+        self.pair_scorer = pair_scorer
+        self.pair_block_size = pair_block_size
         
 
     def prepare_test_pairs(self, device, proposals):
@@ -36,6 +90,9 @@ class RelationSampling(object):
         rel_pair_idxs = []
         for p in proposals:
             n = len(p)
+            if self.max_pairs_per_image > 0 and n * (n - 1) > self.max_pairs_per_image:
+                rel_pair_idxs.append(self.top_test_pairs(device, p))
+                continue
             cand_matrix = torch.ones((n, n), device=device) - torch.eye(n, device=device)
             # mode==sgdet and require_overlap
             if (not self.use_gt_box) and self.test_overlap:
@@ -49,53 +106,76 @@ class RelationSampling(object):
                 # if there is no candidate pairs, give a placeholder of [[0, 0]]
                 rel_pair_idxs.append(torch.zeros((1, 2), dtype=torch.int64, device=device))
         return rel_pair_idxs
+
+    def top_test_pairs(self, device, proposal):
+        """
+        The max_pairs_per_image candidate pairs of an image with the highest pair_scorer scores,
+        in the order of prepare_test_pairs. The candidates of pair_block_size subjects are scored
+        at once, so that no (n, n) matrix is allocated.
+        """
+        n = len(proposal)
+        arange = torch.arange(n, device=device)
+        top_idxs = torch.zeros((0, 2), dtype=torch.int64, device=device)
+        top_scores = torch.zeros((0,), device=device)
+        for start in range(0, n, self.pair_block_size):
+            end = min(start + self.pair_block_size, n)
+            cand_block = arange[start:end, None] != arange[None]
+            # mode==sgdet and require_overlap
+            if (not self.use_gt_box) and self.test_overlap:
+                cand_block = cand_block & pairwise_iou(proposal.pred_boxes[start:end], proposal.pred_boxes).gt(0)
+            idxs = torch.nonzero(cand_block, as_tuple=False).view(-1, 2)
+            idxs[:, 0] += start
+            scores = self.pair_scorer(proposal, idxs[:, 0], idxs[:, 1]).float()
+            top_idxs = torch.cat((top_idxs, idxs), dim=0)
+            top_scores = torch.cat((top_scores, scores), dim=0)
+            if top_scores.shape[0] > self.max_pairs_per_image:
+                keep = top_scores.topk(self.max_pairs_per_image)[1]
+                top_idxs, top_scores = top_idxs[keep], top_scores[keep]
+        if len(top_idxs) == 0:
+            # if there is no candidate pairs, give a placeholder of [[0, 0]]
+            return torch.zeros((1, 2), dtype=torch.int64, device=device)
+        return top_idxs[torch.sort(top_idxs[:, 0] * n + top_idxs[:, 1])[1]]
     
     def gtbox_relsample(self, boxes, targets, relations):
         assert self.use_gt_box
         num_pos_per_img = int(self.batch_size_per_image * self.positive_fraction)
-        rel_idx_pairs = []
-        rel_labels = []
-        rel_sym_binarys = []
-        
-        for img_id, (box, target, relation) in enumerate(zip(boxes, targets, relations)):
-            device = box.device
-            num_prp = box.tensor.shape[0]
-
+        # All images are sampled at once, with (image, head, tail) indices into matrices padded to the largest image
+        device = boxes[0].device
+        num_imgs = len(boxes)
+        num_prps = [box.tensor.shape[0] for box in boxes]
+        max_prp = max(num_prps)
+        for box, target in zip(boxes, targets):
             assert box.tensor.shape[0] == target.gt_boxes.tensor.shape[0]
-            tgt_relations = relation # [tgt, tgt]
-            # tgt_pair_idxs = torch.nonzero(tgt_rel_matrix > 0)
-            tgt_pair_idxs = tgt_relations[:, :2]
-            assert tgt_pair_idxs.shape[1] == 2
-            tgt_head_idxs = tgt_pair_idxs[:, 0].contiguous().view(-1)
-            tgt_tail_idxs = tgt_pair_idxs[:, 1].contiguous().view(-1)
-            tgt_rel_labs = tgt_relations[:,2].contiguous().view(-1)
-
-            # sym_binary_rels
-            binary_rel = torch.zeros((num_prp, num_prp), device=device).long()
-            binary_rel[tgt_head_idxs, tgt_tail_idxs] = 1
-            binary_rel[tgt_tail_idxs, tgt_head_idxs] = 1
-            rel_sym_binarys.append(binary_rel)
-            
-            rel_possibility = torch.ones((num_prp, num_prp), device=device).long() - torch.eye(num_prp, device=device).long()
-            rel_possibility[tgt_head_idxs, tgt_tail_idxs] = 0
-            tgt_bg_idxs = torch.nonzero(rel_possibility > 0, as_tuple=False)
 
-            # generate fg bg rel_pairs
-            if tgt_pair_idxs.shape[0] > num_pos_per_img:
-                perm = torch.randperm(tgt_pair_idxs.shape[0], device=device)[:num_pos_per_img]
-                tgt_pair_idxs = tgt_pair_idxs[perm]
-                tgt_rel_labs = tgt_rel_labs[perm]
-            num_fg = min(tgt_pair_idxs.shape[0], num_pos_per_img)
+        tgt_relations = torch.cat([relation.long().to(device) for relation in relations], dim=0) # [tgt, tgt]
+        tgt_img_idxs = torch.cat([torch.full((relation.shape[0],), img_id, dtype=torch.int64, device=device) for img_id, relation in enumerate(relations)])
+        tgt_head_idxs = tgt_relations[:, 0].contiguous().view(-1)
+        tgt_tail_idxs = tgt_relations[:, 1].contiguous().view(-1)
+        tgt_rel_labs = tgt_relations[:, 2].contiguous().view(-1)
+
+        # sym_binary_rels
+        binary_rel = torch.zeros((num_imgs, max_prp, max_prp), device=device).long()
+        binary_rel[tgt_img_idxs, tgt_head_idxs, tgt_tail_idxs] = 1
+        binary_rel[tgt_img_idxs, tgt_tail_idxs, tgt_head_idxs] = 1
+        rel_sym_binarys = [binary_rel[img_id, :num_prp, :num_prp] for img_id, num_prp in enumerate(num_prps)]
 
-            num_bg = self.batch_size_per_image - num_fg
-            perm = torch.randperm(tgt_bg_idxs.shape[0], device=device)[:num_bg]
-            tgt_bg_idxs = tgt_bg_idxs[perm]
+        rel_possibility = _padded_pairs(num_prps, device) & ~torch.eye(max_prp, dtype=torch.bool, device=device)
+        rel_possibility[tgt_img_idxs, tgt_head_idxs, tgt_tail_idxs] = False
+        bg_img_idxs, bg_head_idxs, bg_tail_idxs = torch.nonzero(rel_possibility, as_tuple=True)
 
-            img_rel_idxs = torch.cat((tgt_pair_idxs, tgt_bg_idxs), dim=0)
-            img_rel_labels = torch.cat((tgt_rel_labs.long(), torch.full((tgt_bg_idxs.shape[0],), fill_value=self.num_rel_classes, device=device, dtype=torch.long)), dim=0).contiguous().view(-1)
+        # generate fg bg rel_pairs, a random subset of at most num_pos_per_img fg pairs and of the bg pairs filling the batch of each image
+        fg_keep = _rank_in_group(tgt_img_idxs, torch.rand(tgt_img_idxs.shape[0], device=device), num_imgs) < num_pos_per_img
+        num_fg = torch.bincount(tgt_img_idxs[fg_keep], minlength=num_imgs)
+        bg_keep = _rank_in_group(bg_img_idxs, torch.rand(bg_img_idxs.shape[0], device=device), num_imgs) < (self.batch_size_per_image - num_fg)[bg_img_idxs]
 
-            rel_idx_pairs.append(img_rel_idxs)
-            rel_labels.append(img_rel_labels)
+        img_idxs = torch.cat((tgt_img_idxs[fg_keep], bg_img_idxs[bg_keep]), dim=0)
+        rel_triplets = torch.cat((
+            torch.stack((tgt_head_idxs[fg_keep], tgt_tail_idxs[fg_keep], tgt_rel_labs[fg_keep]), dim=1),
+            torch.stack((bg_head_idxs[bg_keep], bg_tail_idxs[bg_keep], torch.full_like(bg_head_idxs[bg_keep], self.num_rel_classes)), dim=1),
+        ), dim=0)
+        img_rel_triplets = _split_by_image(img_idxs, rel_triplets, num_imgs)
+        rel_idx_pairs = [triplets[:, :2] for triplets in img_rel_triplets]
+        rel_labels = [triplets[:, 2].contiguous().view(-1) for triplets in img_rel_triplets]
 
         return boxes, rel_labels, rel_idx_pairs, rel_sym_binarys
     
@@ -110,136 +190,137 @@ class RelationSampling(object):
             targets (list[BoxList]) contain fields: labels
         """
         self.num_pos_per_img = int(self.batch_size_per_image * self.positive_fraction)
-        rel_idx_pairs = []
-        rel_labels = []
-        rel_sym_binarys = []
+        device = proposals[0].pred_boxes.device
+        num_imgs = len(proposals)
+        num_prps = [len(proposal) for proposal in proposals]
+        num_tgts = [len(target) for target in targets]
+        max_prp, max_tgt = max(num_prps), max(num_tgts)
+
+        # The matrices of all images, padded to the largest image
+        tgt_rel_matrix = torch.zeros((num_imgs, max_tgt, max_tgt), dtype=torch.int64, device=device) # [img, tgt, tgt]
+        ious = torch.zeros((num_imgs, max_tgt, max_prp), device=device) # [img, tgt, prp]
+        is_match = torch.zeros((num_imgs, max_tgt, max_prp), dtype=torch.bool, device=device) # [img, tgt, prp]
+        rel_possibility = torch.zeros((num_imgs, max_prp, max_prp), dtype=torch.bool, device=device) # [img, prp, prp]
         for img_id, (proposal, target, relation) in enumerate(zip(proposals, targets, relations)):
-            device = proposal.pred_boxes.device
+            num_prp, num_tgt = num_prps[img_id], num_tgts[img_id]
             prp_box = proposal.pred_boxes
             prp_lab = proposal.pred_classes.long()
             tgt_box = target.gt_boxes
             tgt_lab = target.gt_classes.long()
-            tgt_rel_matrix = torch.zeros(tgt_lab.shape[0],tgt_lab.shape[0]).long().to(device) # [tgt, tgt]
-            tgt_rel_matrix[relation[:,0], relation[:,1]] = relation[:,2]
+            tgt_rel_matrix[img_id, relation[:,0].long(), relation[:,1].long()] = relation[:,2].long()
             # IoU matching
-            ious = pairwise_iou(tgt_box, prp_box)  # [tgt, prp]
-
-            is_match = (tgt_lab[:,None] == prp_lab[None]) & (ious > self.fg_thres) # [tgt, prp]
-            # Proposal self IoU to filter non-overlap
-            prp_self_iou = pairwise_iou(prp_box, prp_box)  # [prp, prp]
+            img_ious = pairwise_iou(tgt_box, prp_box)  # [tgt, prp]
+            ious[img_id, :num_tgt, :num_prp] = img_ious
+            is_match[img_id, :num_tgt, :num_prp] = (tgt_lab[:,None] == prp_lab[None]) & (img_ious > self.fg_thres)
             if self.require_overlap and (not self.use_gt_box):
-                rel_possibility = (prp_self_iou > 0) & (prp_self_iou < 1)  # not self & intersect
+                # Proposal self IoU to filter non-overlap
+                prp_self_iou = pairwise_iou(prp_box, prp_box)  # [prp, prp]
+                img_rel_possibility = (prp_self_iou > 0) & (prp_self_iou < 1)  # not self & intersect
             else:
-                num_prp = prp_box.shape[0]
-                rel_possibility = torch.ones((num_prp, num_prp), device=device).long() - torch.eye(num_prp, device=device).long()
+                img_rel_possibility = ~torch.eye(num_prp, dtype=torch.bool, device=device)
             # only select relations between fg proposals
             #Fix for background class
-            rel_possibility[prp_lab == self.num_rel_classes] = 0
-            rel_possibility[:, prp_lab == self.num_rel_classes] = 0
+            is_fg = prp_lab != self.num_rel_classes
+            rel_possibility[img_id, :num_prp, :num_prp] = img_rel_possibility & is_fg[:, None] & is_fg[None]
 
-            img_rel_triplets, binary_rel = self.motif_rel_fg_bg_sampling(device, tgt_rel_matrix, ious, is_match, rel_possibility)
-            rel_idx_pairs.append(img_rel_triplets[:, :2]) # (num_rel, 2),  (sub_idx, obj_idx)
-            rel_labels.append(img_rel_triplets[:, 2]) # (num_rel, )
-            rel_sym_binarys.append(binary_rel)
+        img_rel_triplets, binary_rels = self.motif_rel_fg_bg_sampling(device, tgt_rel_matrix, ious, is_match, rel_possibility)
+        rel_idx_pairs = [triplets[:, :2] for triplets in img_rel_triplets] # (num_rel, 2),  (sub_idx, obj_idx)
+        rel_labels = [triplets[:, 2] for triplets in img_rel_triplets] # (num_rel, )
+        rel_sym_binarys = [binary_rel[:num_prp, :num_prp] for binary_rel, num_prp in zip(binary_rels, num_prps)]
 
         return proposals, rel_labels, rel_idx_pairs, rel_sym_binarys
     
     def motif_rel_fg_bg_sampling(self, device, tgt_rel_matrix, ious, is_match, rel_possibility):
         """
-        prepare to sample fg relation triplet and bg relation triplet
-        tgt_rel_matrix: # [number_target, number_target]
-        ious:           # [number_target, num_proposal]
-        is_match:       # [number_target, num_proposal]
-        rel_possibility:# [num_proposal, num_proposal]
+        prepare to sample fg relation triplet and bg relation triplet, for all the images of
+        a batch at once. The matrices are padded to the largest image, with no match and no
+        possible relation for the padding.
+        tgt_rel_matrix: # [num_image, number_target, number_target]
+        ious:           # [num_image, number_target, num_proposal]
+        is_match:       # [num_image, number_target, num_proposal]
+        rel_possibility:# [num_image, num_proposal, num_proposal]
+        Returns:
+            list[Tensor]: (num_rel, 3) sampled triplets of each image
+            Tensor: [num_image, num_proposal, num_proposal] binary_rel
         """
-        tgt_pair_idxs = torch.nonzero(tgt_rel_matrix > 0)
-        assert tgt_pair_idxs.shape[1] == 2
-        tgt_head_idxs = tgt_pair_idxs[:, 0].contiguous().view(-1)
-        tgt_tail_idxs = tgt_pair_idxs[:, 1].contiguous().view(-1)
-        tgt_rel_labs = tgt_rel_matrix[tgt_head_idxs, tgt_tail_idxs].contiguous().view(-1)
-
+        num_imgs, _, num_prp = is_match.shape
+        tgt_img_idxs, tgt_head_idxs, tgt_tail_idxs = torch.nonzero(tgt_rel_matrix > 0, as_tuple=True)
+        tgt_rel_labs = tgt_rel_matrix[tgt_img_idxs, tgt_head_idxs, tgt_tail_idxs].contiguous().view(-1)
         num_tgt_rels = tgt_rel_labs.shape[0]
+
         # generate binary prp mask
-        num_prp = is_match.shape[-1]
-        binary_prp_head = is_match[tgt_head_idxs] # num_tgt_rel, num_prp (matched prp head)
-        binary_prp_tail = is_match[tgt_tail_idxs] # num_tgt_rel, num_prp (matched prp head)
-        binary_rel = torch.zeros((num_prp, num_prp), device=device).long()
-
-        fg_rel_triplets = []
-        for i in range(num_tgt_rels):
-            # generate binary prp mask
-            bi_match_head = torch.nonzero(binary_prp_head[i] > 0)
-            bi_match_tail = torch.nonzero(binary_prp_tail[i] > 0)
-
-            num_bi_head = bi_match_head.shape[0]
-            num_bi_tail = bi_match_tail.shape[0]
-            if num_bi_head > 0 and num_bi_tail > 0:
-                bi_match_head = bi_match_head.view(1, num_bi_head).expand(num_bi_tail, num_bi_head).contiguous()
-                bi_match_tail = bi_match_tail.view(num_bi_tail, 1).expand(num_bi_tail, num_bi_head).contiguous()
-                # binary rel only consider related or not, so its symmetric
-                binary_rel[bi_match_head.view(-1), bi_match_tail.view(-1)] = 1
-                binary_rel[bi_match_tail.view(-1), bi_match_head.view(-1)] = 1
-
-            tgt_head_idx = int(tgt_head_idxs[i])
-            tgt_tail_idx = int(tgt_tail_idxs[i])
-            tgt_rel_lab = int(tgt_rel_labs[i])
-            # find matching pair in proposals (might be more than one)
-            prp_head_idxs = torch.nonzero(is_match[tgt_head_idx]).squeeze(1)
-            prp_tail_idxs = torch.nonzero(is_match[tgt_tail_idx]).squeeze(1)
-            num_match_head = prp_head_idxs.shape[0]
-            num_match_tail = prp_tail_idxs.shape[0]
-            if num_match_head <= 0 or num_match_tail <= 0:
-                continue
-            # all combination pairs
-            prp_head_idxs = prp_head_idxs.view(-1,1).expand(num_match_head,num_match_tail).contiguous().view(-1)
-            prp_tail_idxs = prp_tail_idxs.view(1,-1).expand(num_match_head,num_match_tail).contiguous().view(-1)
-            valid_pair = prp_head_idxs != prp_tail_idxs
-            if valid_pair.sum().item() <= 0:
-                continue
-            # remove self-pair
-            # remove selected pair from rel_possibility
-            prp_head_idxs = prp_head_idxs[valid_pair]
-            prp_tail_idxs = prp_tail_idxs[valid_pair]
-            rel_possibility[prp_head_idxs, prp_tail_idxs] = 0
-            # construct corresponding proposal triplets corresponding to i_th gt relation
-            fg_labels = torch.tensor([tgt_rel_lab]*prp_tail_idxs.shape[0], dtype=torch.int64, device=device).view(-1,1)
-            fg_rel_i = cat((prp_head_idxs.view(-1,1), prp_tail_idxs.view(-1,1), fg_labels), dim=-1).to(torch.int64)
-            # select if too many corresponding proposal pairs to one pair of gt relationship triplet
-            # NOTE that in original motif, the selection is based on a ious_score score 
-            if fg_rel_i.shape[0] > self.num_sample_per_gt_rel:
-                ious_score = (ious[tgt_head_idx, prp_head_idxs] * ious[tgt_tail_idx, prp_tail_idxs]).view(-1).detach().cpu().numpy()
-                ious_score = ious_score / ious_score.sum()
-                perm = npr.choice(ious_score.shape[0], p=ious_score, size=self.num_sample_per_gt_rel, replace=False)
-                fg_rel_i = fg_rel_i[perm]
-            if fg_rel_i.shape[0] > 0:
-                fg_rel_triplets.append(fg_rel_i)
-        
+        binary_prp_head = is_match[tgt_img_idxs, tgt_head_idxs] # num_tgt_rel, num_prp (matched prp head)
+        binary_prp_tail = is_match[tgt_img_idxs, tgt_tail_idxs] # num_tgt_rel, num_prp (matched prp tail)
+        # all combination pairs of the matched proposals of each gt relation
+        pair_match = binary_prp_head[:, :, None] & binary_prp_tail[:, None, :] # num_tgt_rel, num_prp, num_prp
+        # binary rel only consider related or not, so its symmetric
+        binary_rel = torch.zeros((num_imgs, num_prp, num_prp), device=device).index_add_(0, tgt_img_idxs, pair_match.float()) > 0
+        # remove self-pair
+        not_self = ~torch.eye(num_prp, dtype=torch.bool, device=device)
+        pair_match &= not_self
+        # remove selected pair from rel_possibility
+        rel_possibility = rel_possibility & ~(binary_rel & not_self)
+        binary_rel = (binary_rel | binary_rel.transpose(1, 2)).long()
+
+        # construct corresponding proposal triplets corresponding to each gt relation
+        fg_rel_idxs, prp_head_idxs, prp_tail_idxs = torch.nonzero(pair_match, as_tuple=True)
+        fg_img_idxs = tgt_img_idxs[fg_rel_idxs]
+        # select if too many corresponding proposal pairs to one pair of gt relationship triplet
+        # NOTE that in original motif, the selection is based on a ious_score score
+        # The pairs are drawn without replacement with probabilities proportional to ious_score, as the
+        # num_sample_per_gt_rel largest u ** (1 / ious_score) keys of their gt relation (Efraimidis and Spirakis)
+        ious_score = ious[fg_img_idxs, tgt_head_idxs[fg_rel_idxs], prp_head_idxs] * ious[fg_img_idxs, tgt_tail_idxs[fg_rel_idxs], prp_tail_idxs]
+        keys = torch.rand_like(ious_score).log() / ious_score
+        keep = _rank_in_group(fg_rel_idxs, keys, num_tgt_rels) < self.num_sample_per_gt_rel
+        fg_img_idxs, prp_head_idxs, prp_tail_idxs = fg_img_idxs[keep], prp_head_idxs[keep], prp_tail_idxs[keep]
+        fg_rel_labs = tgt_rel_labs[fg_rel_idxs[keep]]
+
         # select fg relations
-        if len(fg_rel_triplets) == 0:
-            fg_rel_triplets = torch.zeros((0, 3), dtype=torch.int64, device=device)
-        else:
-            fg_rel_triplets = cat(fg_rel_triplets, dim=0).to(torch.int64)
-            if fg_rel_triplets.shape[0] > self.num_pos_per_img:
-                perm = torch.randperm(fg_rel_triplets.shape[0], device=device)[:self.num_pos_per_img]
-                fg_rel_triplets = fg_rel_triplets[perm]
+        keep = _rank_in_group(fg_img_idxs, torch.rand(fg_img_idxs.shape[0], device=device), num_imgs) < self.num_pos_per_img
+        fg_img_idxs = fg_img_idxs[keep]
+        fg_rel_triplets = torch.stack((prp_head_idxs[keep], prp_tail_idxs[keep], fg_rel_labs[keep]), dim=1)
 
         # select bg relations
-        bg_rel_inds = torch.nonzero(rel_possibility>0).view(-1,2)
-        bg_rel_labs = torch.full((bg_rel_inds.shape[0],), fill_value=self.num_rel_classes, dtype=torch.int64, device=device)
-        bg_rel_triplets = cat((bg_rel_inds, bg_rel_labs.view(-1,1)), dim=-1).to(torch.int64)
-
-        num_neg_per_img = min(self.batch_size_per_image - fg_rel_triplets.shape[0], bg_rel_triplets.shape[0])
-        if bg_rel_triplets.shape[0] > 0:
-            perm = torch.randperm(bg_rel_triplets.shape[0], device=device)[:num_neg_per_img]
-            bg_rel_triplets = bg_rel_triplets[perm]
-        else:
-            bg_rel_triplets = torch.zeros((0, 3), dtype=torch.int64, device=device)
+        bg_img_idxs, bg_head_idxs, bg_tail_idxs = torch.nonzero(rel_possibility, as_tuple=True)
+        num_fg = torch.bincount(fg_img_idxs, minlength=num_imgs)
+        keep = _rank_in_group(bg_img_idxs, torch.rand(bg_img_idxs.shape[0], device=device), num_imgs) < (self.batch_size_per_image - num_fg)[bg_img_idxs]
+        bg_img_idxs = bg_img_idxs[keep]
+        bg_rel_triplets = torch.stack((bg_head_idxs[keep], bg_tail_idxs[keep], torch.full_like(bg_img_idxs, self.num_rel_classes)), dim=1)
 
+        img_rel_triplets = _split_by_image(torch.cat((fg_img_idxs, bg_img_idxs), dim=0), torch.cat((fg_rel_triplets, bg_rel_triplets), dim=0), num_imgs)
         # if both fg and bg is none
-        if fg_rel_triplets.shape[0] == 0 and bg_rel_triplets.shape[0] == 0:
-            bg_rel_triplets = torch.zeros((1, 3), dtype=torch.int64, device=device)
+        img_rel_triplets = [triplets if triplets.shape[0] > 0 else torch.zeros((1, 3), dtype=torch.int64, device=device) for triplets in img_rel_triplets]
+
+        return img_rel_triplets, binary_rel
+
+def _padded_pairs(num_prps, device):
+    # [num_image, max_prp, max_prp] mask of the pairs of proposals of each image
+    max_prp = max(num_prps)
+    is_prp = torch.arange(max_prp, device=device)[None] < torch.as_tensor(num_prps, device=device)[:, None]
+    return is_prp[:, :, None] & is_prp[:, None, :]
+
+def _rank_in_group(groups, keys, num_groups):
+    """
+    Rank of each element among the elements of its group, by decreasing key. Keeping the
+    elements of rank < k with random keys keeps a random subset of k elements of each group.
+    Args:
+        groups (Tensor[long]): (N,) group of each element, in [0, num_groups)
+        keys (Tensor): (N,)
+    """
+    arange = torch.arange(groups.shape[0], device=groups.device)
+    order = torch.argsort(keys, descending=True)
+    # Sorted by group, and by decreasing key within each group
+    order = order[torch.argsort(groups[order] * groups.shape[0] + arange)]
+    group_sizes = torch.bincount(groups, minlength=num_groups)
+    group_starts = torch.cumsum(group_sizes, 0) - group_sizes
+    ranks = torch.empty_like(groups)
+    ranks[order] = arange - group_starts[groups[order]]
+    return ranks
 
-        return cat((fg_rel_triplets, bg_rel_triplets), dim=0), binary_rel
+def _split_by_image(img_idxs, rows, num_imgs):
+    # Rows of each image, in their order in rows
+    order = torch.argsort(img_idxs * img_idxs.shape[0] + torch.arange(img_idxs.shape[0], device=img_idxs.device))
+    return list(rows[order].split(torch.bincount(img_idxs, minlength=num_imgs).tolist(), dim=0))
 
 def cat(tensors, dim=0):
     """
@@ -261,6 +342,9 @@ def build_roi_scenegraph_samp_processor(cfg):
         cfg.MODEL.ROI_SCENEGRAPH_HEAD.USE_GT_BOX,
         cfg.MODEL.ROI_SCENEGRAPH_HEAD.NUM_CLASSES,
         cfg.TEST.RELATION.REQUIRE_OVERLAP,
+        max_pairs_per_image=cfg.TEST.RELATION.MAX_PAIRS_PER_IMAGE,
+        pair_scorer=RELATION_PAIR_SCORER_REGISTRY.get(cfg.TEST.RELATION.PAIR_SCORER)(cfg) if cfg.TEST.RELATION.MAX_PAIRS_PER_IMAGE > 0 else None,
+        pair_block_size=cfg.TEST.RELATION.PAIR_BLOCK_SIZE,
     )
 
     return samp_processor
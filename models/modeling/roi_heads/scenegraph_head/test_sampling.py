@@ -0,0 +1,162 @@
+# Parity tests for the batched relation sampling against the original per image, per gt relation loops
+
+import pytest
+import torch
+
+from detectron2.structures import Boxes, Instances, pairwise_iou
+
+from .sampling import RelationSampling, _rank_in_group
+
+NUM_REL_CLASSES = 50
+# No subsampling, so that the sampled relations are deterministic
+UNLIMITED = 10 ** 6
+
+
+def _detect_relsample_reference(proposal, target, relation, fg_thres, require_overlap):
+    """
+    Original loop over the gt relations of one image, without the subsampling
+    Returns:
+        list[tuple]: sorted (sub, obj, label) triplets
+        Tensor: binary_rel
+    """
+    prp_box = proposal.pred_boxes
+    prp_lab = proposal.pred_classes.long()
+    tgt_lab = target.gt_classes.long()
+    num_prp = len(proposal)
+    tgt_rel_matrix = torch.zeros((tgt_lab.shape[0], tgt_lab.shape[0]), dtype=torch.int64)
+    tgt_rel_matrix[relation[:, 0], relation[:, 1]] = relation[:, 2]
+    ious = pairwise_iou(target.gt_boxes, prp_box)
+    is_match = (tgt_lab[:, None] == prp_lab[None]) & (ious > fg_thres)
+    if require_overlap:
+        prp_self_iou = pairwise_iou(prp_box, prp_box)
+        rel_possibility = ((prp_self_iou > 0) & (prp_self_iou < 1)).long()
+    else:
+        rel_possibility = torch.ones((num_prp, num_prp), dtype=torch.int64) - torch.eye(num_prp, dtype=torch.int64)
+    rel_possibility[prp_lab == NUM_REL_CLASSES] = 0
+    rel_possibility[:, prp_lab == NUM_REL_CLASSES] = 0
+
+    binary_rel = torch.zeros((num_prp, num_prp), dtype=torch.int64)
+    triplets = []
+    for tgt_head_idx, tgt_tail_idx in torch.nonzero(tgt_rel_matrix > 0).tolist():
+        for prp_head_idx in torch.nonzero(is_match[tgt_head_idx]).view(-1).tolist():
+            for prp_tail_idx in torch.nonzero(is_match[tgt_tail_idx]).view(-1).tolist():
+                binary_rel[prp_head_idx, prp_tail_idx] = 1
+                binary_rel[prp_tail_idx, prp_head_idx] = 1
+                if prp_head_idx == prp_tail_idx:
+                    continue
+                rel_possibility[prp_head_idx, prp_tail_idx] = 0
+                triplets.append((prp_head_idx, prp_tail_idx, int(tgt_rel_matrix[tgt_head_idx, tgt_tail_idx])))
+    triplets += [(head, tail, NUM_REL_CLASSES) for head, tail in torch.nonzero(rel_possibility > 0).tolist()]
+    if len(triplets) == 0:
+        triplets = [(0, 0, 0)]
+    return sorted(triplets), binary_rel
+
+
+def _gtbox_relsample_reference(num_prp, relation):
+    binary_rel = torch.zeros((num_prp, num_prp), dtype=torch.int64)
+    binary_rel[relation[:, 0], relation[:, 1]] = 1
+    binary_rel[relation[:, 1], relation[:, 0]] = 1
+    rel_possibility = torch.ones((num_prp, num_prp), dtype=torch.int64) - torch.eye(num_prp, dtype=torch.int64)
+    rel_possibility[relation[:, 0], relation[:, 1]] = 0
+    triplets = [tuple(triplet) for triplet in relation.tolist()]
+    triplets += [(head, tail, NUM_REL_CLASSES) for head, tail in torch.nonzero(rel_possibility > 0).tolist()]
+    return sorted(triplets), binary_rel
+
+
+def _random_boxes(generator, num_boxes):
+    xy = torch.rand(num_boxes, 2, generator=generator) * 300
+    wh = torch.rand(num_boxes, 2, generator=generator) * 150 + 5
+    return torch.cat((xy, xy + wh), dim=1)
+
+
+def _random_relations(generator, num_tgt, num_rel):
+    # Distinct (head, tail) pairs, with foreground labels
+    pairs = torch.cartesian_prod(torch.arange(num_tgt), torch.arange(num_tgt))
+    pairs = pairs[pairs[:, 0] != pairs[:, 1]]
+    pairs = pairs[torch.randperm(pairs.shape[0], generator=generator)[:num_rel]]
+    labels = torch.randint(1, NUM_REL_CLASSES, (pairs.shape[0],), generator=generator)
+    return torch.cat((pairs, labels[:, None]), dim=1)
+
+
+def _random_image(generator, num_tgt, num_prp, num_rel, num_classes=5):
+    tgt_boxes = _random_boxes(generator, num_tgt)
+    tgt_classes = torch.randint(0, num_classes, (num_tgt,), generator=generator)
+    # Jittered copies of the gt boxes, some of them background
+    prp_tgt_idxs = torch.randint(0, num_tgt, (num_prp,), generator=generator)
+    prp_boxes = tgt_boxes[prp_tgt_idxs] + torch.randn(num_prp, 4, generator=generator) * 8
+    prp_boxes[:, 2:] = torch.max(prp_boxes[:, 2:], prp_boxes[:, :2] + 1)
+    prp_classes = tgt_classes[prp_tgt_idxs].clone()
+    prp_classes[torch.rand(num_prp, generator=generator) < 0.2] = NUM_REL_CLASSES
+    proposal = Instances((512, 512), pred_boxes=Boxes(prp_boxes), pred_classes=prp_classes)
+    target = Instances((512, 512), gt_boxes=Boxes(tgt_boxes), gt_classes=tgt_classes)
+    return proposal, target, _random_relations(generator, num_tgt, num_rel)
+
+
+def _sampler(use_gt_box, require_overlap=True):
+    return RelationSampling(
+        fg_thres=0.5,
+        require_overlap=require_overlap,
+        num_sample_per_gt_rel=UNLIMITED,
+        batch_size_per_image=UNLIMITED,
+        positive_fraction=0.5,
+        use_gt_box=use_gt_box,
+        num_rel_classes=NUM_REL_CLASSES,
+        test_overlap=True,
+    )
+
+
+def _sorted_triplets(rel_idx_pairs, rel_labels):
+    return sorted(map(tuple, torch.cat((rel_idx_pairs, rel_labels[:, None]), dim=1).tolist()))
+
+
+@pytest.mark.parametrize("require_overlap", [True, False])
+@pytest.mark.parametrize("seed", range(3))
+def test_detect_relsample_parity(seed, require_overlap):
+    generator = torch.Generator().manual_seed(seed)
+    # Images of different sizes, one without any relation
+    images = [_random_image(generator, 8, 40, 10), _random_image(generator, 3, 12, 2),
+              _random_image(generator, 1, 5, 0), _random_image(generator, 15, 70, 30)]
+    proposals, targets, relations = zip(*images)
+
+    _, rel_labels, rel_idx_pairs, rel_sym_binarys = _sampler(False, require_overlap).detect_relsample(proposals, targets, relations)
+    for proposal, target, relation, labels, pairs, binary_rel in zip(proposals, targets, relations, rel_labels, rel_idx_pairs, rel_sym_binarys):
+        expected_triplets, expected_binary_rel = _detect_relsample_reference(proposal, target, relation, 0.5, require_overlap)
+        assert _sorted_triplets(pairs, labels) == expected_triplets
+        assert binary_rel.dtype == torch.int64
+        assert torch.equal(binary_rel, expected_binary_rel)
+
+
+@pytest.mark.parametrize("seed", range(3))
+def test_gtbox_relsample_parity(seed):
+    generator = torch.Generator().manual_seed(seed)
+    num_prps = [10, 3, 25, 2]
+    boxes = [Boxes(_random_boxes(generator, num_prp)) for num_prp in num_prps]
+    targets = [Instances((512, 512), gt_boxes=box) for box in boxes]
+    relations = [_random_relations(generator, num_prp, num_prp) for num_prp in num_prps]
+
+    _, rel_labels, rel_idx_pairs, rel_sym_binarys = _sampler(True).gtbox_relsample(boxes, targets, relations)
+    for num_prp, relation, labels, pairs, binary_rel in zip(num_prps, relations, rel_labels, rel_idx_pairs, rel_sym_binarys):
+        expected_triplets, expected_binary_rel = _gtbox_relsample_reference(num_prp, relation)
+        assert _sorted_triplets(pairs, labels) == expected_triplets
+        assert torch.equal(binary_rel, expected_binary_rel)
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_rank_in_group(seed):
+    generator = torch.Generator().manual_seed(seed)
+    num_groups = 8
+    # Groups 0 and num_groups - 1 are never drawn, so that they are empty
+    groups = torch.randint(1, num_groups - 1, (100,), generator=generator)
+    keys = torch.rand(100, generator=generator)
+
+    ranks = _rank_in_group(groups, keys, num_groups)
+    for group in range(num_groups):
+        in_group = groups == group
+        # A permutation of the elements of the group, by decreasing key
+        assert sorted(ranks[in_group].tolist()) == list(range(int(in_group.sum())))
+        assert torch.equal(ranks[in_group], torch.argsort(torch.argsort(keys[in_group], descending=True)))
+
+
+def test_rank_in_group_empty():
+    ranks = _rank_in_group(torch.zeros((0,), dtype=torch.int64), torch.zeros((0,)), 3)
+    assert ranks.shape == (0,)
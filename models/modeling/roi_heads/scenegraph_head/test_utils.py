@@ -0,0 +1,65 @@
+# Parity tests for the batched greedy class-wise object NMS against the original NumPy loops
+
+import numpy as np
+import pytest
+import torch
+import torch.nn.functional as F
+
+from .utils import batched_obj_prediction_nms, nms_overlaps, obj_prediction_nms
+
+
+def _obj_prediction_nms_reference(boxes_per_cls, pred_logits, nms_thresh, keep_existing):
+    """
+    Original NumPy loop, of the PostProcessor with keep_existing, else of the motif decoders
+    """
+    num_obj = pred_logits.shape[0]
+    is_overlap = nms_overlaps(boxes_per_cls).view(num_obj, num_obj, boxes_per_cls.size(1)).numpy() >= nms_thresh
+    prob_sampled = F.softmax(pred_logits, 1).numpy()
+    prob_sampled[:, -1] = 0  # set bg to 0
+    pred_label = torch.zeros(num_obj, dtype=torch.int64)
+    for i in range(num_obj):
+        box_ind, cls_ind = np.unravel_index(prob_sampled.argmax(), prob_sampled.shape)
+        if not keep_existing or float(pred_label[int(box_ind)]) <= 0:
+            pred_label[int(box_ind)] = int(cls_ind)
+        prob_sampled[is_overlap[box_ind, :, cls_ind], cls_ind] = 0.0
+        prob_sampled[box_ind] = -1.0 # This way we won't re-sample
+    return pred_label
+
+
+def _random_boxes_per_cls(generator, num_obj, num_cls, jitter):
+    # Jittered copies of a few boxes, so that there are overlaps above and below the threshold
+    xy = torch.rand(max(1, num_obj // 3), 2, generator=generator) * 100
+    wh = torch.rand(max(1, num_obj // 3), 2, generator=generator) * 50 + 5
+    boxes = torch.cat((xy, xy + wh), dim=1)[torch.randint(0, xy.shape[0], (num_obj,), generator=generator)]
+    boxes = boxes[:, None].repeat(1, num_cls, 1) + torch.randn(num_obj, num_cls, 4, generator=generator) * jitter
+    boxes[:, :, 2:] = torch.max(boxes[:, :, 2:], boxes[:, :, :2] + 1)
+    return boxes
+
+
+@pytest.mark.parametrize("keep_existing", [True, False])
+@pytest.mark.parametrize("seed", range(5))
+def test_batched_obj_prediction_nms_parity(seed, keep_existing):
+    generator = torch.Generator().manual_seed(seed)
+    num_cls = 6
+    # Identical boxes of an image suppress each other in every class they are selected for
+    num_objs, jitters = [7, 1, 20, 12], [5.0, 5.0, 10.0, 0.0]
+    boxes_per_cls = [_random_boxes_per_cls(generator, num_obj, num_cls, jitter) for num_obj, jitter in zip(num_objs, jitters)]
+    pred_logits = [torch.randn(num_obj, num_cls, generator=generator) * 3 for num_obj in num_objs]
+
+    pred_labels = batched_obj_prediction_nms(boxes_per_cls, pred_logits, 0.3, keep_existing)
+    for boxes, logits, pred_label in zip(boxes_per_cls, pred_logits, pred_labels):
+        expected = _obj_prediction_nms_reference(boxes, logits, 0.3, keep_existing)
+        assert torch.equal(pred_label, expected)
+        assert torch.equal(obj_prediction_nms(boxes, logits, 0.3, keep_existing), expected)
+
+
+@pytest.mark.parametrize("keep_existing", [True, False])
+def test_obj_prediction_nms_reselected_box(keep_existing):
+    # Three identical boxes, the first two are labelled 1 and 0, which suppresses both classes of
+    # the third one. The first box, whose class 0 was zeroed, is then selected again
+    boxes_per_cls = torch.tensor([[0.0, 0.0, 10.0, 10.0]]).repeat(3, 3, 1)
+    pred_logits = torch.tensor([[0.0, 5.0, 0.0], [5.0, 0.0, 0.0], [0.0, 0.0, 5.0]])
+
+    pred_label = obj_prediction_nms(boxes_per_cls, pred_logits, 0.3, keep_existing)
+    assert torch.equal(pred_label, _obj_prediction_nms_reference(boxes_per_cls, pred_logits, 0.3, keep_existing))
+    assert pred_label.tolist() == ([1, 0, 0] if keep_existing else [0, 0, 0])
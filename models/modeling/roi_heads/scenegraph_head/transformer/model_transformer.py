@@ -7,7 +7,7 @@ import torch.nn.functional as F
 import numpy as np
 from ..motif.utils_motifs import cat
 from ..motif.utils_motifs import obj_edge_vectors, to_onehot, encode_box_info
-from ..utils import nms_overlaps
+from ..utils import batched_obj_prediction_nms
 
 class ScaledDotProductAttention(nn.Module):
     ''' Scaled Dot-Product Attention '''
@@ -287,22 +287,6 @@ class TransformerContext(nn.Module):
 
     def nms_per_cls(self, obj_dists, boxes_per_cls, num_objs):
         obj_dists = obj_dists.split(num_objs, dim=0)
-        obj_preds = []
-        for i in range(len(num_objs)):
-            is_overlap = nms_overlaps(boxes_per_cls[i]).cpu().numpy() >= self.nms_thresh # (#box, #box, #class)
-
-            out_dists_sampled = F.softmax(obj_dists[i], -1).cpu().numpy()
-            #Last index for background
-            out_dists_sampled[:, -1] = -1
-
-            out_label = obj_dists[i].new(num_objs[i]).fill_(0)
-
-            for i in range(num_objs[i]):
-                box_ind, cls_ind = np.unravel_index(out_dists_sampled.argmax(), out_dists_sampled.shape)
-                out_label[int(box_ind)] = int(cls_ind)
-                out_dists_sampled[is_overlap[box_ind,:,cls_ind], cls_ind] = 0.0
-                out_dists_sampled[box_ind] = -1.0 # This way we won't re-sample
-
-            obj_preds.append(out_label.long())
+        obj_preds = batched_obj_prediction_nms(boxes_per_cls, obj_dists, self.nms_thresh)
         obj_preds = torch.cat(obj_preds, dim=0)
         return obj_preds
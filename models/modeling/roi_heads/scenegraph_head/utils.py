@@ -63,28 +63,73 @@ def block_orthogonal(tensor, split_sizes, gain=1.0):
         torch.nn.init.orthogonal_(tensor_copy, gain=gain)
         tensor[block_slice] = tensor_copy[0:sizes[0], 0:sizes[1]]
 
-def obj_prediction_nms(boxes_per_cls, pred_logits, nms_thresh=0.3):
+def obj_prediction_nms(boxes_per_cls, pred_logits, nms_thresh=0.3, keep_existing=False):
     """
     boxes_per_cls:               [num_obj, num_cls, 4]
     pred_logits:                 [num_obj, num_category]
     """
     num_obj = pred_logits.shape[0]
     assert num_obj == boxes_per_cls.shape[0]
-    is_overlap = nms_overlaps(boxes_per_cls).view(boxes_per_cls.size(0), boxes_per_cls.size(0), 
-                              boxes_per_cls.size(1)).cpu().numpy() >= nms_thresh
+    return batched_obj_prediction_nms([boxes_per_cls], [pred_logits], nms_thresh, keep_existing)[0]
 
-    prob_sampled = F.softmax(pred_logits, 1).cpu().numpy()
-    prob_sampled[:, -1] = 0  # set bg to 0
+def batched_obj_prediction_nms(boxes_per_cls, pred_logits, nms_thresh=0.3, keep_existing=False):
+    """
+    Greedy class-wise NMS of obj_prediction_nms, for all the images of a batch at once and on
+    their device. The box / class of highest score of each image is labelled at every step,
+    and only the overlaps of that box with the boxes of that class (as in nms_overlaps) are
+    computed, instead of the [num_obj, num_obj, num_cls] overlaps of all the boxes.
+    Args:
+        boxes_per_cls (list[Tensor]): [num_obj, num_cls, 4] of each image
+        pred_logits (list[Tensor]): [num_obj, num_category] of each image
+        keep_existing (bool): the suppression can zero a class of an already labelled box, which
+            is selected again when no unlabelled box has a higher score. Such a box keeps its
+            first label if True (as in the PostProcessor), else it is relabelled (as in the motif
+            and transformer contexts)
+    Returns:
+        list[Tensor]: [num_obj] predicted labels of each image
+    """
+    num_objs = [logits.shape[0] for logits in pred_logits]
+    num_imgs, max_obj = len(num_objs), max(num_objs)
+    num_category = pred_logits[0].shape[1]
+    device = pred_logits[0].device
+
+    # The images are padded to the largest one, with a -1 score for the padding
+    boxes = boxes_per_cls[0].new_zeros((num_imgs, max_obj) + tuple(boxes_per_cls[0].shape[1:]))
+    prob_sampled = pred_logits[0].new_full((num_imgs, max_obj, num_category), -1.0)
+    for i, (img_boxes, logits) in enumerate(zip(boxes_per_cls, pred_logits)):
+        boxes[i, :num_objs[i]] = img_boxes
+        prob_sampled[i, :num_objs[i]] = F.softmax(logits, 1)
+        prob_sampled[i, :num_objs[i], -1] = 0  # set bg to 0
+    areas = (boxes[:, :, :, 2] - boxes[:, :, :, 0] + 1.0) * (boxes[:, :, :, 3] - boxes[:, :, :, 1] + 1.0)
+
+    img_inds = torch.arange(num_imgs, device=device)
+    obj_inds = torch.arange(max_obj, device=device)
+    is_obj = obj_inds[None] < torch.as_tensor(num_objs, device=device)[:, None]
+    pred_label = torch.zeros((num_imgs, max_obj), device=device, dtype=torch.int64)
+
+    for i in range(max_obj):
+        # Images with all their boxes labelled are left unchanged
+        active = is_obj[:, i]
+        flat_ind = prob_sampled.view(num_imgs, -1).argmax(1)
+        box_ind = flat_ind // num_category
+        cls_ind = flat_ind % num_category
+        box_label = pred_label[img_inds, box_ind]
+        relabel = active & (box_label == 0) if keep_existing else active
+        pred_label[img_inds, box_ind] = torch.where(relabel, cls_ind, box_label)
 
-    pred_label = torch.zeros(num_obj, device=pred_logits.device, dtype=torch.int64)
+        # overlaps of the selected box with the boxes of its class
+        cls_inds = (img_inds[:, None], obj_inds[None], cls_ind[:, None])
+        cls_boxes = boxes[cls_inds] # [num_imgs, max_obj, 4]
+        box = boxes[img_inds, box_ind, cls_ind]
+        max_xy = torch.min(box[:, None, 2:], cls_boxes[:, :, 2:])
+        min_xy = torch.max(box[:, None, :2], cls_boxes[:, :, :2])
+        inter = torch.clamp((max_xy - min_xy + 1.0), min=0)
+        inters = inter[:, :, 0] * inter[:, :, 1]
+        union = -inters + areas[cls_inds] + areas[img_inds, box_ind, cls_ind][:, None]
+        is_overlap = (inters / union >= nms_thresh) & is_obj & active[:, None]
 
-    for i in range(num_obj):
-        box_ind, cls_ind = np.unravel_index(prob_sampled.argmax(), prob_sampled.shape)
-        if float(pred_label[int(box_ind)]) > 0:
-            pass
-        else:
-            pred_label[int(box_ind)] = int(cls_ind)
-        prob_sampled[is_overlap[box_ind,:,cls_ind], cls_ind] = 0.0
-        prob_sampled[box_ind] = -1.0 # This way we won't re-sample
+        prob_sampled[cls_inds] = prob_sampled[cls_inds].masked_fill(is_overlap, 0.0)
+        # This way we won't re-sample
+        prob_sampled[img_inds, box_ind] = torch.where(active[:, None], torch.full_like(prob_sampled[:, 0], -1.0), prob_sampled[img_inds, box_ind])
 
-    return pred_label 
\ No newline at end of file
+    return [pred_label[i, :num_obj] for i, num_obj in enumerate(num_objs)]
@@ -0,0 +1,81 @@
+"""
+Compare the iteration time and peak GPU memory of SceneGraphSegmentationRCNN training steps with
+the VG and COCO batches going through the backbone separately and jointly
+(MODEL.JOINT_BACKBONE_FORWARD), on the same batches. Example:
+
+python benchmark_joint_backbone.py --config-file ../configs/sg_dev_masktransfer.yaml --iters 50 MODEL.WEIGHTS <CHECKPOINT>
+"""
+
+import time
+import logging
+import numpy as np
+import torch
+
+from detectron2.utils.logger import setup_logger
+from detectron2.engine import default_argument_parser
+from detectron2.config import get_cfg
+from detectron2.checkpoint import DetectionCheckpointer
+from detectron2.utils.events import EventStorage
+
+from segmentationsg.engine import SceneGraphSegmentationTrainer
+from segmentationsg.data import add_dataset_config, register_datasets
+from segmentationsg.modeling.roi_heads.scenegraph_head import add_scenegraph_config
+from segmentationsg.modeling import *
+
+from train_SG_segmentation_head import register_coco_data
+
+parser = default_argument_parser()
+parser.add_argument("--iters", type=int, default=50, help="measured iterations of each mode")
+parser.add_argument("--warmup", type=int, default=5, help="iterations run before measuring")
+
+def setup(args):
+    cfg = get_cfg()
+    add_dataset_config(cfg)
+    add_scenegraph_config(cfg)
+    cfg.merge_from_file(args.config_file)
+    cfg.merge_from_list(args.opts)
+    cfg.freeze()
+    register_datasets(cfg)
+    register_coco_data(cfg)
+    setup_logger(name="LSDA")
+    return cfg
+
+def run(model, optimizer, batches):
+    torch.cuda.synchronize()
+    torch.cuda.reset_peak_memory_stats()
+    times = []
+    for data, mask_data in batches:
+        start = time.perf_counter()
+        losses = sum(model(data, mask_batched_inputs=mask_data).values())
+        optimizer.zero_grad()
+        losses.backward()
+        optimizer.step()
+        torch.cuda.synchronize()
+        times.append(time.perf_counter() - start)
+    return times, torch.cuda.max_memory_allocated() / 2 ** 20
+
+def main(args):
+    cfg = setup(args)
+    logger = logging.getLogger("LSDA")
+    model = SceneGraphSegmentationTrainer.build_model(cfg)
+    DetectionCheckpointer(model).load(cfg.MODEL.WEIGHTS)
+    optimizer = SceneGraphSegmentationTrainer.build_optimizer(cfg, model)
+    model.train()
+
+    # The same batches are used by both modes
+    data_loader = iter(SceneGraphSegmentationTrainer.build_train_loader(cfg))
+    mask_loader = iter(SceneGraphSegmentationTrainer.build_mask_loader(cfg, is_train=True))
+    batches = [(next(data_loader), next(mask_loader)) for _ in range(args.warmup + args.iters)]
+
+    with EventStorage():
+        for joint in [False, True]:
+            model.joint_backbone_forward = joint
+            run(model, optimizer, batches[:args.warmup])
+            times, peak_memory = run(model, optimizer, batches[args.warmup:])
+            logger.info("JOINT_BACKBONE_FORWARD={}: {:.4f} s / iter (median {:.4f}), peak memory {:.0f} MiB".format(
+                joint, np.mean(times), np.median(times), peak_memory))
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    print (args)
+    main(args)
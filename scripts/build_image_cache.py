@@ -0,0 +1,48 @@
+"""
+Decode and resize the training images once, into the cache read by the scene graph mappers
+when DATASETS.IMAGE_CACHE is set. The images are resized to max(INPUT.MIN_SIZE_TRAIN) and
+INPUT.MAX_SIZE_TRAIN, so the cache has to be rebuilt when these change. Example:
+
+python build_image_cache.py --config-file ../configs/sg_dev_masktransfer.yaml --output <CACHE_DIR> --num-workers 16
+"""
+
+import logging
+
+from detectron2.utils.logger import setup_logger
+from detectron2.engine import default_argument_parser
+from detectron2.config import get_cfg
+from detectron2.data import DatasetCatalog
+
+from segmentationsg.data import add_dataset_config, register_datasets
+from segmentationsg.data.image_cache import build_image_cache
+from segmentationsg.modeling.roi_heads.scenegraph_head import add_scenegraph_config
+
+parser = default_argument_parser()
+parser.add_argument("--output", required=True, help="directory of the image cache")
+parser.add_argument("--num-workers", type=int, default=0, help="processes decoding and resizing the images")
+
+def setup(args):
+    cfg = get_cfg()
+    add_dataset_config(cfg)
+    add_scenegraph_config(cfg)
+    cfg.merge_from_file(args.config_file)
+    cfg.merge_from_list(args.opts)
+    cfg.freeze()
+    register_datasets(cfg)
+    setup_logger(name="segmentationsg")
+    return cfg
+
+def main(args):
+    cfg = setup(args)
+    file_names = []
+    for dataset_name in cfg.DATASETS.TRAIN:
+        dataset = DatasetCatalog.get(dataset_name)
+        file_names.extend(dataset[idx]['file_name'] for idx in range(len(dataset)))
+    file_names = sorted(set(file_names))
+    logging.getLogger("segmentationsg").info("Caching {} images to {}".format(len(file_names), args.output))
+    build_image_cache(file_names, args.output, max(cfg.INPUT.MIN_SIZE_TRAIN), cfg.INPUT.MAX_SIZE_TRAIN, cfg.INPUT.FORMAT, args.num_workers)
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    print (args)
+    main(args)
@@ -0,0 +1,61 @@
+"""
+Recompute the scene graph metrics from the predictions dumped by an earlier evaluation
+(TEST.RELATION.* options such as IOU_THRESHOLD can be changed through the command line),
+without building the model or loading the dataset. Example:
+
+python evaluate_SG_predictions.py --config-file ../configs/sg_dev_masktransfer.yaml --predictions <OUTPUT_DIR>/inference --num-workers 16 TEST.RELATION.IOU_THRESHOLD 0.7
+"""
+
+import os
+import json
+import logging
+
+import detectron2.utils.comm as comm
+from detectron2.utils.logger import setup_logger
+from detectron2.engine import default_argument_parser
+from detectron2.config import get_cfg
+from detectron2.data import MetadataCatalog
+from detectron2.evaluation import print_csv_format
+
+from segmentationsg.data import add_dataset_config
+from segmentationsg.modeling.roi_heads.scenegraph_head import add_scenegraph_config
+from segmentationsg.evaluation import SceneGraphEvaluator
+
+parser = default_argument_parser()
+parser.add_argument("--predictions", default="", help="columnar dump directory, scenegraph_predictions.pth file or directory of per rank pth files. Defaults to OUTPUT_DIR/inference")
+parser.add_argument("--dataset", default="VG_test", help="name of the dataset the predictions were computed on")
+parser.add_argument("--num-workers", type=int, default=os.cpu_count(), help="processes used to compute the metrics")
+
+def register_metadata(cfg, dataset_name):
+    # Only the predicate names are needed by the metrics, avoid loading the whole dataset
+    mapping_dictionary = json.load(open(cfg.DATASETS.VISUAL_GENOME.MAPPING_DICTIONARY, 'r'))
+    idx_to_predicates = sorted(mapping_dictionary['predicate_to_idx'], key=lambda k: mapping_dictionary['predicate_to_idx'][k])
+    MetadataCatalog.get(dataset_name).set(predicate_classes=idx_to_predicates)
+
+def setup(args):
+    cfg = get_cfg()
+    add_dataset_config(cfg)
+    add_scenegraph_config(cfg)
+    cfg.merge_from_file(args.config_file)
+    cfg.merge_from_list(args.opts)
+    cfg.merge_from_list(['TEST.RELATION.NUM_EVAL_WORKERS', args.num_workers])
+    cfg.freeze()
+    register_metadata(cfg, args.dataset)
+    setup_logger(output=cfg.OUTPUT_DIR, distributed_rank=comm.get_rank(), name="detectron2")
+    return cfg
+
+def main(args):
+    cfg = setup(args)
+    predictions = args.predictions if args.predictions else os.path.join(cfg.OUTPUT_DIR, "inference")
+
+    evaluator = SceneGraphEvaluator(args.dataset, cfg, False, evaluate_detections=False)
+    results = evaluator.evaluate_dump(predictions)
+
+    logging.getLogger('detectron2').info("Evaluation results for {} in csv format:".format(args.dataset))
+    print_csv_format(results)
+    return results
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    print (args)
+    main(args)